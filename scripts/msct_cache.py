@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Persistent cache of the outputs of sct_* scripts.
+#
+# The cache is opt-in: set the environment variable SCT_CACHE_DIR to the cache folder. When a script parses its
+# arguments (msct_parser.Parser.parse), a key is computed from the sources of the toolbox, the content of the input
+# files and the other arguments. If this key is in the cache, the outputs of the previous run are copied back and the
+# script exits immediately. Otherwise, the declared outputs are stored in the cache when the script succeeds: the files
+# of the output options (type 'file_output') and the files in the output folders (types 'folder_creation' and
+# 'folder_output'), if they were created or modified during the run. Scripts without output options are not cached.
+# The least recently used entries are removed when the cache exceeds SCT_CACHE_SIZE (in MB, default: 5000).
+#
+# Only the outputs are restored: what the script prints is not.
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2017 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+import sct_utils as sct
+
+# default maximum size of the cache, in MB
+CACHE_SIZE_DEFAULT = 5000
+MANIFEST_FILE = 'manifest.json'
+
+# hashes of file contents, indexed by (absolute file name, mtime, size)
+_file_hashes = {}
+# hash of the sources of the toolbox, indexed by the folder of the toolbox
+_sources_hashes = {}
+# scripts whose main() is the entry point of a run: the script run from the command line, then the scripts run
+# in-process by sct_utils.run() (see push_entry). Only those can be cached, not scripts called by other scripts.
+_entries = []
+
+
+def get_cache_dir():
+    """
+    :return: cache folder, or None if the cache is disabled
+    """
+    cache_dir = os.environ.get('SCT_CACHE_DIR', '')
+    if cache_dir == '':
+        return None
+    return os.path.abspath(os.path.expanduser(cache_dir))
+
+
+def get_cache_size_max():
+    """
+    :return: maximum size of the cache, in bytes
+    """
+    return float(os.environ.get('SCT_CACHE_SIZE', CACHE_SIZE_DEFAULT)) * 1024 ** 2
+
+
+def get_script_name(file_name):
+    return os.path.splitext(os.path.basename(file_name))[0]
+
+
+def hash_file(fname):
+    """
+    Hash the content of a file (the hash is kept in memory as long as the file is not modified)
+    :param fname: file name
+    :return: hexadecimal sha1
+    """
+    fname = os.path.abspath(fname)
+    stat = os.stat(fname)
+    index = (fname, stat.st_mtime, stat.st_size)
+    if index not in _file_hashes:
+        sha1 = hashlib.sha1()
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(1024 ** 2), b''):
+                sha1.update(block)
+        _file_hashes[index] = sha1.hexdigest()
+    return _file_hashes[index]
+
+
+def hash_folder(path):
+    """
+    Hash the list of files of a folder, with their sizes and modification times (folders such as the template can
+    be large: their content is not read)
+    :param path: folder
+    :return: hexadecimal sha1
+    """
+    list_files = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for fname in sorted(files):
+            stat = os.stat(os.path.join(root, fname))
+            list_files.append((os.path.relpath(os.path.join(root, fname), path), stat.st_size, stat.st_mtime))
+    return hashlib.sha1(repr(list_files)).hexdigest()
+
+
+def hash_sources(path_sct):
+    """
+    Hash the sources of the toolbox: the python files of the scripts folder (sct_* and msct_* modules, which are
+    mostly imported lazily, inside functions) and of the spinalcordtoolbox package, and the version
+    :param path_sct: folder of the toolbox
+    :return: hexadecimal sha1
+    """
+    if path_sct not in _sources_hashes:
+        list_sources = []
+        fname_version = os.path.join(path_sct, 'version.txt')
+        if os.path.isfile(fname_version):
+            list_sources.append(('version.txt', hash_file(fname_version)))
+        for folder in ['scripts', 'spinalcordtoolbox']:
+            for root, dirs, files in os.walk(os.path.join(path_sct, folder)):
+                dirs.sort()
+                for fname in sorted(files):
+                    if fname.endswith('.py'):
+                        fname = os.path.join(root, fname)
+                        list_sources.append((os.path.relpath(fname, path_sct), hash_file(fname)))
+        _sources_hashes[path_sct] = hashlib.sha1(repr(list_sources)).hexdigest()
+    return _sources_hashes[path_sct]
+
+
+def hash_argument(option, value):
+    """
+    :param option: msct_parser.Option
+    :param value: parsed value of the option
+    :return: value used in the cache key: hash of the content for input files and folders, the value otherwise
+    """
+    if isinstance(value, list):
+        type_value = option.type_value[1] if isinstance(option.type_value, list) else option.type_value
+        return [hash_value(type_value, val) for val in value]
+    return hash_value(option.type_value, value)
+
+
+def hash_value(type_value, value):
+    if type_value in ['file', 'image_nifti'] and os.path.isfile(str(value)):
+        return 'file:' + hash_file(value)
+    if type_value == 'folder' and os.path.isdir(str(value)):
+        return 'folder:' + hash_folder(value)
+    return repr(value)
+
+
+def get_key(parser, dictionary):
+    """
+    Compute the cache key of a run
+    :param parser: msct_parser.Parser
+    :param dictionary: parsed arguments
+    :return: hexadecimal sha1, or None if the run can not be cached
+    """
+    if 'msct_image' in sys.modules:
+        # images passed in memory by sct_utils.call() are not files
+        for value in dictionary.values():
+            for val in (value if isinstance(value, list) else [value]):
+                if isinstance(val, str) and sys.modules['msct_image'].is_memory_image(val):
+                    return None
+    fname_script = parser.file_name[:-1] if parser.file_name.endswith('.pyc') else parser.file_name
+    path_sct = os.path.dirname(os.path.dirname(os.path.abspath(fname_script)))
+    list_key = [get_script_name(fname_script), hash_file(fname_script), hash_sources(path_sct)]
+    for name in sorted(dictionary):
+        if name in parser.options:
+            list_key.append((name, hash_argument(parser.options[name], dictionary[name])))
+        else:
+            list_key.append((name, repr(dictionary[name])))
+    return hashlib.sha1(repr(list_key)).hexdigest()
+
+
+def get_outputs(parser, dictionary):
+    """
+    :return: declared outputs of the run: list of output files (options of type 'file_output'), list of output folders
+    (options of type 'folder_creation' or 'folder_output')
+    """
+    list_files_out, list_folders_out = [], []
+    for name, value in dictionary.items():
+        if name not in parser.options:
+            continue
+        type_value = parser.options[name].type_value
+        if isinstance(type_value, list):
+            type_value = type_value[1]
+        for val in (value if isinstance(value, list) else [value]):
+            if type_value == 'file_output':
+                list_files_out.append(os.path.abspath(str(val)))
+            elif type_value in ['folder_creation', 'folder_output']:
+                list_folders_out.append(os.path.abspath(str(val)))
+    return sorted(set(list_files_out)), sorted(set(list_folders_out))
+
+
+def list_files(list_files_out, list_folders_out):
+    """
+    :return: dict of the existing output files and of the files in the output folders (recursive), with their
+    modification time and size
+    """
+    list_fname = [fname for fname in list_files_out if os.path.isfile(fname)]
+    for folder in list_folders_out:
+        for root, dirs, files in os.walk(folder):
+            list_fname += [os.path.join(root, fname) for fname in files]
+    dict_files = {}
+    for fname in list_fname:
+        stat = os.stat(fname)
+        dict_files[fname] = (stat.st_mtime, stat.st_size)
+    return dict_files
+
+
+# ==========================================================================================
+# entry points of the runs
+# ==========================================================================================
+def get_entry():
+    if not _entries:
+        # script run from the command line
+        _entries.append({'script': get_script_name(sys.argv[0]), 'run': None, 'command_line': True})
+    return _entries[-1]
+
+
+def push_entry(script_name):
+    """
+    Declare that the main() of a script is about to be run in-process (see sct_utils.run_main)
+    """
+    get_entry()
+    _entries.append({'script': script_name, 'run': None, 'command_line': False})
+
+
+def pop_entry(success):
+    """
+    End of an in-process run: store its outputs if it succeeded
+    """
+    entry = _entries.pop()
+    if success and entry['run'] is not None:
+        store(entry['run'])
+
+
+def start(parser, dictionary):
+    """
+    Called by msct_parser.Parser.parse(): restore the outputs of the run if they are in the cache (and exit), else
+    record the state of the output folders, so that the outputs can be stored at the end of the run.
+    :param parser: msct_parser.Parser
+    :param dictionary: parsed arguments
+    """
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return
+    entry = get_entry()
+    if entry['script'] != get_script_name(parser.file_name) or entry['run'] is not None:
+        return
+    list_files_out, list_folders_out = get_outputs(parser, dictionary)
+    if not list_files_out and not list_folders_out:
+        # outputs are not declared: they can not be told apart from other files
+        return
+    key = get_key(parser, dictionary)
+    if key is None:
+        return
+    if restore(cache_dir, key):
+        sct.printv('Outputs restored from cache: ' + os.path.join(cache_dir, key), 1, 'info')
+        sys.exit(0)
+
+    entry['run'] = {'cache_dir': cache_dir, 'key': key, 'script': entry['script'], 'cwd': os.getcwd(), 'start': time.time(),
+                    'files_out': list_files_out, 'folders_out': list_folders_out,
+                    'files': list_files(list_files_out, list_folders_out), 'status': 0}
+    if entry['command_line']:
+        watch_exit(entry['run'])
+
+
+def watch_exit(run):
+    """
+    Store the outputs when the process exits, if the script succeeded (exit status 0 and no uncaught exception)
+    """
+    import atexit
+    sys_exit, sys_excepthook = sys.exit, sys.excepthook
+
+    def exit(status=None):
+        run['status'] = status
+        sys_exit(status)
+
+    def excepthook(*args):
+        run['status'] = 1
+        sys_excepthook(*args)
+
+    def store_at_exit():
+        if run['status'] in [None, 0]:
+            store(run)
+
+    sys.exit, sys.excepthook = exit, excepthook
+    atexit.register(store_at_exit)
+
+
+# ==========================================================================================
+# cache entries
+# ==========================================================================================
+def store(run):
+    """
+    Store the declared outputs created or modified during the run
+    :param run: dict created by start()
+    """
+    dict_files = list_files(run['files_out'], run['folders_out'])
+    # files modified before the start of the run are not outputs of the run (mtime can be truncated to the second)
+    time_start = int(run['start'])
+    list_out = sorted([fname for fname, stat in dict_files.items() if run['files'].get(fname) != stat and stat[0] >= time_start])
+    if not list_out:
+        return
+    path_entry = os.path.join(run['cache_dir'], run['key'])
+    if os.path.isdir(path_entry):
+        return
+    path_tmp = path_entry + '.tmp' + str(os.getpid())
+    try:
+        os.makedirs(path_tmp)
+        list_manifest = []
+        for i, fname in enumerate(list_out):
+            shutil.copy(fname, os.path.join(path_tmp, str(i)))
+            # outputs in the working folder are restored relative to the working folder of the next run
+            if fname.startswith(os.path.join(run['cwd'], '')):
+                fname = os.path.relpath(fname, run['cwd'])
+            list_manifest.append([fname, str(i)])
+        manifest = {'script': run['script'], 'files': list_manifest, 'size': sum(dict_files[fname][1] for fname in list_out), 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+        with open(os.path.join(path_tmp, MANIFEST_FILE), 'w') as f:
+            json.dump(manifest, f)
+        os.rename(path_tmp, path_entry)
+    except (IOError, OSError), e:
+        sct.printv('WARNING: Could not store outputs in cache: ' + str(e), 1, 'warning')
+        shutil.rmtree(path_tmp, ignore_errors=True)
+        return
+    evict(run['cache_dir'])
+
+
+def restore(cache_dir, key):
+    """
+    Copy the outputs of a cache entry
+    :return: True if the entry exists
+    """
+    path_entry = os.path.join(cache_dir, key)
+    fname_manifest = os.path.join(path_entry, MANIFEST_FILE)
+    if not os.path.isfile(fname_manifest):
+        return False
+    with open(fname_manifest, 'r') as f:
+        manifest = json.load(f)
+    for fname, fname_cache in manifest['files']:
+        fname = os.path.abspath(fname)
+        if not os.path.isdir(os.path.dirname(fname)):
+            os.makedirs(os.path.dirname(fname))
+        shutil.copy(os.path.join(path_entry, fname_cache), fname)
+    # last use of the entry, for eviction
+    os.utime(path_entry, None)
+    return True
+
+
+def evict(cache_dir):
+    """
+    Remove the least recently used entries until the size of the cache is below SCT_CACHE_SIZE
+    """
+    list_entries = []
+    for key in os.listdir(cache_dir):
+        fname_manifest = os.path.join(cache_dir, key, MANIFEST_FILE)
+        if os.path.isfile(fname_manifest):
+            with open(fname_manifest, 'r') as f:
+                size = json.load(f)['size']
+            list_entries.append((os.path.getmtime(os.path.join(cache_dir, key)), size, key))
+    list_entries.sort()
+    size_total = sum(size for date, size, key in list_entries)
+    size_max = get_cache_size_max()
+    for date, size, key in list_entries:
+        if size_total <= size_max:
+            break
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+        size_total -= size
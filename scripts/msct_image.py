@@ -18,6 +18,14 @@
 import numpy as np
 from scipy.ndimage import map_coordinates
 import math
+import os
+
+# images that are passed between scripts in memory (see sct_utils.call), indexed by absolute file name
+_memory_images = {}
+# absolute file names for which Image.save() keeps the image in memory instead of writing it to disk
+_memory_capture = set()
+# uncompressed copies of the .nii.gz files loaded with mmap=True, indexed by (absolute file name, mtime, size)
+_mmap_cache = {}
 
 
 def striu2mat(striu):
@@ -199,12 +207,17 @@ class Image(object):
 
     """
 
-    def __init__(self, param=None, hdr=None, orientation=None, absolutepath="", dim=None, verbose=1):
+    def __init__(self, param=None, hdr=None, orientation=None, absolutepath="", dim=None, verbose=1, mmap=None):
+        """
+        :param mmap: if True, image files are memory-mapped instead of being loaded in memory (see loadFromPath).
+        If None, memory-mapping is used when the environment variable SCT_IMAGE_MMAP is set to 1.
+        """
         from sct_utils import extract_fname
         from nibabel import Nifti1Header
 
         # initialization of all parameters
         self.im_file = None
+        self._mmap_file = None
         self.data = None
         self.orientation = None
         self.absolutepath = ""
@@ -220,9 +233,14 @@ class Image(object):
 
         self.verbose = verbose
 
-        # load an image from file
+        # load an image from file (or from memory if the file was passed with sct_utils.call)
         if type(param) is str:
-            self.loadFromPath(param, verbose)
+            if is_memory_image(param):
+                self.copy(_memory_images[os.path.abspath(param)])
+            else:
+                if mmap is None:
+                    mmap = os.environ.get('SCT_IMAGE_MMAP', '0') == '1'
+                self.loadFromPath(param, verbose, mmap=mmap)
             self.compute_transform_matrix()
         # copy constructor
         elif isinstance(param, type(self)):
@@ -246,16 +264,46 @@ class Image(object):
         else:
             raise TypeError('Image constructor takes at least one argument.')
 
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        # the data is replaced, it can not be shared anymore with the file mapping (see copy)
+        self._data = data
+        self._mmap_file = None
+
+    def __setstate__(self, state):
+        # images pickled before data was a property
+        if 'data' in state:
+            state['_data'] = state.pop('data')
+        state.setdefault('_mmap_file', None)
+        self.__dict__.update(state)
+
     def __deepcopy__(self, memo):
-        from copy import deepcopy
-        return type(self)(deepcopy(self.data, memo), deepcopy(self.hdr, memo), deepcopy(self.orientation, memo), deepcopy(self.absolutepath, memo), deepcopy(self.dim, memo))
+        im = type(self).__new__(type(self))
+        im.verbose = self.verbose
+        im.copy(self)
+        return im
 
     def copy(self, image=None):
+        """
+        Copy an image. If image is None, return a copy of this image, else copy image into this image.
+        Memory-mapped images whose data has not been modified are copied on write: the file is mapped again instead
+        of copying the data array, so that memory is only used for the voxels that are modified.
+        """
         from copy import deepcopy
         from sct_utils import extract_fname
         if image is not None:
-            self.im_file = deepcopy(image.im_file)
-            self.data = deepcopy(image.data)
+            self.im_file = copy_nifti(image.im_file)
+            if image._mmap_file is not None and not image.is_mmap_modified():
+                self.data = self.im_file.get_data()
+                self._mmap_file = image._mmap_file
+            elif isinstance(image._data, np.memmap):
+                self.data = np.array(image._data)
+            else:
+                self.data = deepcopy(image._data)
             self.dim = deepcopy(image.dim)
             self.hdr = deepcopy(image.hdr)
             self.orientation = deepcopy(image.orientation)
@@ -264,10 +312,47 @@ class Image(object):
         else:
             return deepcopy(self)
 
-    def loadFromPath(self, path, verbose):
+    def is_mmap_modified(self):
+        """
+        Compare the memory-mapped data with the file, slice by slice, to find out if it was modified in place.
+        Voxels that were not modified are read from the page cache: no memory is used for them.
+        :return: True if the data differs from the file (or is not memory-mapped)
+        """
+        from nibabel import load
+        if self._mmap_file is None:
+            return True
+        data_file = load(self._mmap_file, mmap='r').get_data()
+        if data_file.shape != self._data.shape:
+            return True
+        return not all(np.array_equal(data_file[i], self._data[i]) for i in range(data_file.shape[0]))
+
+    def view(self, data=None):
+        """
+        Return an image that shares the data array of this image (or uses data, e.g. a slice of it) instead of copying
+        it. Only the header and the other metadata are copied: modifying the data of the view modifies this image.
+        :param data: data array of the view. Default: data of this image.
+        :return: Image
+        """
+        from copy import deepcopy
+        from sct_utils import extract_fname
+        im = type(self).__new__(type(self))
+        im.verbose = self.verbose
+        im.im_file = self.im_file
+        im.data = self.data if data is None else data
+        im.dim = deepcopy(self.dim)
+        im.hdr = self.hdr.copy()
+        im.orientation = self.orientation
+        im.absolutepath = self.absolutepath
+        im.path, im.file_name, im.ext = extract_fname(self.absolutepath)
+        return im
+
+    def loadFromPath(self, path, verbose, mmap=False):
         """
         This function load an image from an absolute path using nibabel library
         :param path: path of the file from which the image will be loaded
+        :param mmap: if True, the data is memory-mapped in copy-on-write mode: voxels are read from the disk when they
+        are accessed and modifications are kept in memory (the file is never modified). Compressed files are
+        uncompressed once in a temporary folder. The file must not be overwritten while the image is used.
         :return:
         """
         from nibabel import load, spatialimages
@@ -275,11 +360,19 @@ class Image(object):
         from sct_image import get_orientation
 
         # check_file_exist(path, verbose=verbose)
+        fname_mmap = None
         try:
-            self.im_file = load(path)
+            if mmap:
+                fname_mmap = get_uncompressed_nifti(path)
+                self.im_file = load(fname_mmap, mmap='c')
+            else:
+                self.im_file = load(path)
         except spatialimages.ImageFileError:
             printv('Error: make sure ' + path + ' is an image.', 1, 'error')
         self.data = self.im_file.get_data()
+        if isinstance(self._data, np.memmap):
+            # scaled data can not be mapped, in that case nibabel loads it in memory
+            self._mmap_file = fname_mmap
         self.hdr = self.im_file.get_header()
         self.orientation = get_orientation(self)
         self.absolutepath = path
@@ -405,8 +498,12 @@ class Image(object):
         # update header
         if self.hdr:
             self.hdr.set_data_shape(self.data.shape)
-        img = Nifti1Image(self.data, None, self.hdr)
         fname_out = self.path + self.file_name + self.ext
+        if path.abspath(fname_out) in _memory_capture:
+            # output requested in memory by sct_utils.call: do not write it
+            _memory_images[path.abspath(fname_out)] = self.copy()
+            return
+        img = Nifti1Image(self.data, None, self.hdr)
         if path.isfile(fname_out):
             printv('WARNING: File ' + fname_out + ' already exists. Deleting it.', verbose, 'warning')
             remove(fname_out)
@@ -434,11 +531,13 @@ class Image(object):
         data_shape = self.hdr.get_data_shape()
         return data_shape
 
-    def getNonZeroCoordinates(self, sorting=None, reverse_coord=False, coordValue=False):
+    def getNonZeroCoordinates(self, sorting=None, reverse_coord=False, coordValue=False, as_array=False):
         """
         This function return all the non-zero coordinates that the image contains.
         Coordinate list can also be sorted by x, y, z, or the value with the parameter sorting='x', sorting='y', sorting='z' or sorting='value'
         If reverse_coord is True, coordinate are sorted from larger to smaller.
+        If as_array is True, coordinates are returned as a numpy array of size (nb_points * 4) containing [x, y, z, value]
+        instead of a list of Coordinate objects. This is much faster for large label images or segmentations.
         """
         from msct_types import Coordinate
         from sct_utils import printv
@@ -453,64 +552,77 @@ class Image(object):
         try:
             if n_dim == 3:
                 X, Y, Z = (self.data > 0).nonzero()
-                list_coordinates = [Coordinate([X[i], Y[i], Z[i], self.data[X[i], Y[i], Z[i]]]) for i in range(0, len(X))]
+                values = self.data[X, Y, Z]
             elif n_dim == 2:
                 try:
                     X, Y = (self.data > 0).nonzero()
-                    list_coordinates = [Coordinate([X[i], Y[i], 0, self.data[X[i], Y[i]]]) for i in range(0, len(X))]
+                    values = self.data[X, Y]
                 except ValueError:
                     X, Y, Z = (self.data > 0).nonzero()
-                    list_coordinates = [Coordinate([X[i], Y[i], 0, self.data[X[i], Y[i], 0]]) for i in range(0, len(X))]
+                    values = self.data[X, Y, Z]
+                Z = np.zeros(len(X), dtype=X.dtype)
         except Exception, e:
             print 'ERROR', e
             printv('ERROR: Exception ' + str(e) + ' caught while geting non Zeros coordinates', 1, 'error')
 
-        if coordValue:
-            from msct_types import CoordinateValue
-            if n_dim == 3:
-                list_coordinates = [CoordinateValue([X[i], Y[i], Z[i], self.data[X[i], Y[i], Z[i]]]) for i in range(0, len(X))]
-            else:
-                list_coordinates = [CoordinateValue([X[i], Y[i], 0, self.data[X[i], Y[i]]]) for i in range(0, len(X))]
         if sorting is not None:
             if reverse_coord not in [True, False]:
                 raise ValueError('reverse_coord parameter must be a boolean')
 
             if sorting == 'x':
-                list_coordinates = sorted(list_coordinates, key=lambda obj: obj.x, reverse=reverse_coord)
+                key = X
             elif sorting == 'y':
-                list_coordinates = sorted(list_coordinates, key=lambda obj: obj.y, reverse=reverse_coord)
+                key = Y
             elif sorting == 'z':
-                list_coordinates = sorted(list_coordinates, key=lambda obj: obj.z, reverse=reverse_coord)
+                key = Z
             elif sorting == 'value':
-                list_coordinates = sorted(list_coordinates, key=lambda obj: obj.value, reverse=reverse_coord)
+                key = values
             else:
                 raise ValueError("sorting parameter must be either 'x', 'y', 'z' or 'value'")
 
+            # stable sort, so that coordinates with the same key keep their order (as with sorted())
+            key = np.asarray(key, dtype=np.float64)
+            if reverse_coord:
+                key = -key
+            order = np.argsort(key, kind='mergesort')
+            X, Y, Z, values = X[order], Y[order], Z[order], values[order]
+
+        if as_array:
+            return np.column_stack((X, Y, Z, values)).astype(np.float64)
+
+        if coordValue:
+            from msct_types import CoordinateValue
+            coordinate_type = CoordinateValue
+        else:
+            coordinate_type = Coordinate
+        list_coordinates = [coordinate_type([X[i], Y[i], Z[i], values[i]]) for i in range(0, len(X))]
+
         return list_coordinates
 
-    def getCoordinatesAveragedByValue(self):
+    def getCoordinatesAveragedByValue(self, as_array=False):
         """
         This function computes the mean coordinate of group of labels in the image. This is especially useful for label's images.
-        :return: list of coordinates that represent the center of mass of each group of value.
+        :param as_array: if True, return a numpy array of size (nb_labels * 4) containing [x, y, z, value]
+        :return: list of coordinates that represent the center of mass of each group of value, sorted by value.
         """
-        # 1. Extraction of coordinates from all non-null voxels in the image. Coordinates are sorted by value.
-        coordinates = self.getNonZeroCoordinates(sorting='value')
-
-        # 2. Separate all coordinates into groups by value
-        groups = dict()
-        for coord in coordinates:
-            if coord.value in groups:
-                groups[coord.value].append(coord)
-            else:
-                groups[coord.value] = [coord]
+        from msct_types import Coordinate
+
+        # 1. Extraction of coordinates from all non-null voxels in the image.
+        coordinates = self.getNonZeroCoordinates(as_array=True)
 
-        # 3. Compute the center of mass of each group of voxels and write them into the output image
-        averaged_coordinates = []
-        for value, list_coord in groups.iteritems():
-            averaged_coordinates.append(sum(list_coord) / float(len(list_coord)))
+        # 2. Separate all coordinates into groups by value (sorted by value)
+        values, groups = np.unique(coordinates[:, 3], return_inverse=True)
 
-        averaged_coordinates = sorted(averaged_coordinates, key=lambda obj: obj.value, reverse=False)
-        return averaged_coordinates
+        # 3. Compute the center of mass of each group of voxels
+        nb_voxels = np.bincount(groups, minlength=len(values)).astype(np.float64)
+        averaged_coordinates = np.zeros((len(values), 4))
+        for i in range(3):
+            averaged_coordinates[:, i] = np.bincount(groups, weights=coordinates[:, i], minlength=len(values)) / nb_voxels
+        averaged_coordinates[:, 3] = values
+
+        if as_array:
+            return averaged_coordinates
+        return [Coordinate(list(coord)) for coord in averaged_coordinates]
 
     # crop the image in order to keep only voxels in the mask, therefore the mask's slices must be squares or rectangles of the same size
     # orientation must be IRP to be able to go trough slices as first dimension
@@ -716,6 +828,43 @@ class Image(object):
         self.m_p2f_transfo = m_p2f[0:3, 0:3]
         self.coord_origin = np.array([[m_p2f[0, 3]], [m_p2f[1, 3]], [m_p2f[2, 3]]])
 
+    def get_transform_matrices(self):
+        """
+        Get the pixel to physical transformation (sform) and its inverse. The inverse is kept until the sform changes.
+        :return: m_p2f (4x4), m_f2p_transfo (3x3 inverse of the rotation/scaling part of m_p2f)
+        """
+        m_p2f = self.hdr.get_sform()
+        transfo = getattr(self, '_transfo_inverse', None)
+        if transfo is None or not np.array_equal(transfo[0], m_p2f):
+            transfo = self._transfo_inverse = (m_p2f, np.linalg.inv(m_p2f[0:3, 0:3]))
+        return transfo
+
+    def transfo_pix2phys_array(self, coordi):
+        """
+        Same as transfo_pix2phys, for an array of coordinates of any shape, without conversion to lists.
+        :param coordi: array (..., 3) of pixel coordinates
+        :return: array (..., 3) of physical coordinates
+        """
+        m_p2f = self.get_transform_matrices()[0]
+        return np.dot(coordi, m_p2f[0:3, 0:3].T) + m_p2f[0:3, 3]
+
+    def transfo_phys2continuouspix_array(self, coordi):
+        """
+        Same as transfo_phys2continuouspix, for an array of coordinates of any shape, without conversion to lists.
+        :param coordi: array (..., 3) of physical coordinates
+        :return: array (..., 3) of continuous pixel coordinates
+        """
+        m_p2f, m_f2p_transfo = self.get_transform_matrices()
+        return np.dot(np.asarray(coordi) - m_p2f[0:3, 3], m_f2p_transfo.T)
+
+    def transfo_phys2pix_array(self, coordi):
+        """
+        Same as transfo_phys2pix, for an array of coordinates of any shape, without conversion to lists.
+        :param coordi: array (..., 3) of physical coordinates
+        :return: array (..., 3) of pixel coordinates, rounded to the nearest integer
+        """
+        return np.round(self.transfo_phys2continuouspix_array(coordi)).astype(int)
+
     def transfo_pix2phys(self, coordi=None):
         """
         This function returns the physical coordinates of all points of 'coordi'. 'coordi' is a list of list of size
@@ -731,35 +880,8 @@ class Image(object):
         :return:
         """
 
-        m_p2f = self.hdr.get_sform()
-        m_p2f_transfo = m_p2f[0:3, 0:3]
-        coord_origin = np.array([[m_p2f[0, 3]], [m_p2f[1, 3]], [m_p2f[2, 3]]])
-
         if coordi is not None:
-            coordi = np.asarray(coordi)
-            number_of_coordinates = coordi.shape[0]
-            num_c = 100000
-            result_temp = np.empty(shape=(0, 3))
-
-            for i in range(int(number_of_coordinates / num_c)):
-                coordi_temp = coordi[num_c * i:(i + 1) * num_c, :]
-                coordi_pix = np.transpose(coordi_temp)
-                dot_result = np.dot(m_p2f_transfo, coordi_pix)
-                coordi_phys = np.transpose(coord_origin + dot_result)
-                result_temp = np.concatenate((result_temp, coordi_phys), axis=0)
-
-            if int(number_of_coordinates / num_c) == 0:
-                coordi_temp = coordi
-            else:
-                coordi_temp = coordi[int(number_of_coordinates / num_c) * num_c:, :]
-            coordi_pix = np.transpose(coordi_temp)
-            coordi_phys = np.transpose(coord_origin + np.dot(m_p2f_transfo, coordi_pix))
-
-            coordi_phys = np.concatenate((result_temp, coordi_phys), axis=0)
-            coordi_phys_list = coordi_phys.tolist()
-            # print coordi_phys.shape
-
-            return coordi_phys_list
+            return self.transfo_pix2phys_array(coordi).tolist()
         """
         if coordi != None:
             coordi_phys = transpose(self.coord_origin + dot(self.m_p2f_transfo, transpose(asarray(coordi))))
@@ -778,18 +900,7 @@ class Image(object):
         :return:
         """
 
-        m_p2f = self.hdr.get_sform()
-        m_p2f_transfo = m_p2f[0:3, 0:3]
-        m_f2p_transfo = np.linalg.inv(m_p2f_transfo)
-
-        coord_origin = np.array([[m_p2f[0, 3]], [m_p2f[1, 3]], [m_p2f[2, 3]]])
-
-        coordi_phys = np.transpose(np.asarray(coordi))
-        coordi_pix = np.transpose(np.dot(m_f2p_transfo, (coordi_phys - coord_origin)))
-        coordi_pix_tmp = coordi_pix.tolist()
-        coordi_pix_list = [[int(np.round(coordi_pix_tmp[j][i])) for i in range(len(coordi_pix_tmp[j]))] for j in range(len(coordi_pix_tmp))]
-
-        return coordi_pix_list
+        return self.transfo_phys2pix_array(coordi).tolist()
 
     def transfo_phys2continuouspix(self, coordi=None, data_phys=None):
         """
@@ -804,20 +915,8 @@ class Image(object):
         :return:
         """
 
-        m_p2f = self.hdr.get_sform()
-        m_p2f_transfo = m_p2f[0:3, 0:3]
-        m_f2p_transfo = np.linalg.inv(m_p2f_transfo)
-
-        coord_origin = np.array([[m_p2f[0, 3]], [m_p2f[1, 3]], [m_p2f[2, 3]]])
-
-        if coordi != None:
-            coordi_phys = np.transpose(np.asarray(coordi))
-            coordi_pix = np.transpose(np.dot(m_f2p_transfo, (coordi_phys - coord_origin)))
-            coordi_pix_tmp = coordi_pix.tolist()
-            coordi_pix_list = [[coordi_pix_tmp[j][i] for i in range(len(coordi_pix_tmp[j]))] for j in
-                               range(len(coordi_pix_tmp))]
-
-            return coordi_pix_list
+        if coordi is not None:
+            return self.transfo_phys2continuouspix_array(coordi).tolist()
 
     def get_values(self, coordi=None, interpolation_mode=0, border='constant', cval=0.0):
         """
@@ -910,17 +1009,16 @@ class Image(object):
         :return: a new image that has the same dimensions/grid of the reference image but the data of self image.
         """
         nx, ny, nz, nt, px, py, pz, pt = im_ref.dim
-        x, y, z = np.mgrid[0:nx, 0:ny, 0:nz]
-        indexes_ref = np.array(zip(x.ravel(), y.ravel(), z.ravel()))
-        physical_coordinates_ref = im_ref.transfo_pix2phys(indexes_ref)
+        indexes_ref = np.indices((nx, ny, nz)).reshape(3, -1).transpose()
+        physical_coordinates_ref = im_ref.transfo_pix2phys_array(indexes_ref)
 
         # TODO: add optional transformation from reference space to image space to physical coordinates of ref grid.
         # TODO: add choice to do non-full transorm: translation, (rigid), affine
         # 1. get transformation
         # 2. apply transformation on coordinates
 
-        coord_im = np.array(self.transfo_phys2continuouspix(physical_coordinates_ref))
-        interpolated_values = self.get_values(np.array([coord_im[:, 0], coord_im[:, 1], coord_im[:, 2]]), interpolation_mode=interpolation_mode, border=border)
+        coord_im = self.transfo_phys2continuouspix_array(physical_coordinates_ref)
+        interpolated_values = self.get_values(coord_im.transpose(), interpolation_mode=interpolation_mode, border=border)
 
         im_output = Image(im_ref)
         if interpolation_mode == 0:
@@ -1176,6 +1274,115 @@ def compute_dice(image1, image2, mode='3d', label=1, zboundaries=False):
     return dice
 
 
+def copy_nifti(im_file):
+    """
+    Copy a nibabel image without copying its data: the data proxy (or array) is shared with the new image.
+    """
+    from copy import deepcopy
+    if not hasattr(im_file, 'dataobj'):
+        return deepcopy(im_file)
+    return type(im_file)(im_file.dataobj, im_file.affine, im_file.header)
+
+
+def get_uncompressed_nifti(fname):
+    """
+    Return an uncompressed version of a nifti file that can be memory-mapped. Compressed files are uncompressed only
+    once per session, in a temporary folder that is deleted at exit.
+    :param fname: nifti file (.nii or .nii.gz)
+    :return: file name of the uncompressed file
+    """
+    import gzip
+    import shutil
+    import tempfile
+    import atexit
+    from sct_utils import create_folder
+    if not fname.endswith('.gz'):
+        return fname
+    fname = os.path.abspath(fname)
+    stat = os.stat(fname)
+    key = (fname, stat.st_mtime, stat.st_size)
+    if key not in _mmap_cache:
+        path_cache = os.path.join(tempfile.gettempdir(), 'sct_mmap_' + str(os.getpid()))
+        if not _mmap_cache:
+            create_folder(path_cache)
+            atexit.register(shutil.rmtree, path_cache, True)
+        fname_nii = os.path.join(path_cache, str(len(_mmap_cache)) + '_' + os.path.basename(fname)[:-3])
+        with open(fname_nii, 'wb') as f_out:
+            f_in = gzip.open(fname, 'rb')
+            shutil.copyfileobj(f_in, f_out, 16 * 1024 * 1024)
+            f_in.close()
+        _mmap_cache[key] = fname_nii
+    return _mmap_cache[key]
+
+
+def is_memory_image(fname):
+    """
+    Check if an image file name refers to an image held in memory (see sct_utils.call).
+    """
+    return os.path.abspath(fname) in _memory_images
+
+
+def register_memory_image(im):
+    """
+    Make an image readable by Image() without writing it to disk. The image gets a file name in a temporary folder,
+    where it is only written if an external program needs it (see flush_memory_images).
+    :param im: Image
+    :return: file name of the image in memory
+    """
+    import tempfile
+    from sct_utils import create_folder
+    ext = im.ext if im.ext in ['.nii', '.nii.gz'] else '.nii.gz'
+    path_memory = os.path.join(tempfile.gettempdir(), 'sct_memory_' + str(os.getpid()), str(len(_memory_images)) + '_' + str(id(im)))
+    create_folder(path_memory)
+    fname = os.path.join(path_memory, (im.file_name or 'image') + ext)
+    # the data array is shared: every Image() created from this file name gets its own copy
+    im_memory = Image(im.data, hdr=im.hdr, orientation=im.orientation, absolutepath=fname, dim=im.dim, verbose=im.verbose)
+    im_memory.im_file = im.im_file
+    _memory_images[fname] = im_memory
+    return fname
+
+
+def capture_memory_image(fname):
+    """
+    Keep in memory the image that will be saved under fname, instead of writing it to disk.
+    :return: absolute file name to use with release_memory_image
+    """
+    fname = os.path.abspath(fname)
+    _memory_capture.add(fname)
+    return fname
+
+
+def release_memory_image(fname):
+    """
+    Stop holding an image in memory and delete its temporary file if it was written.
+    :return: the image held in memory, or None
+    """
+    import shutil
+    fname = os.path.abspath(fname)
+    _memory_capture.discard(fname)
+    im = _memory_images.pop(fname, None)
+    path_memory = os.path.dirname(fname)
+    if im is not None and os.path.basename(os.path.dirname(path_memory)).startswith('sct_memory_'):
+        shutil.rmtree(path_memory, ignore_errors=True)
+    return im
+
+
+def flush_memory_images(cmd):
+    """
+    Write to disk the images in memory that are used by a command line, so that an external program can read them.
+    :param cmd: command line
+    """
+    for fname, im in _memory_images.items():
+        if fname in cmd or os.path.relpath(fname) in cmd:
+            is_captured = fname in _memory_capture
+            _memory_capture.discard(fname)
+            im_disk = Image(im)
+            im_disk.setFileName(fname)
+            im_disk.save(squeeze_data=False, verbose=0)
+            if is_captured:
+                _memory_capture.add(fname)
+
+
 def find_zmin_zmax(fname):
     import sct_utils as sct
     # crop image
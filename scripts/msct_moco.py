@@ -86,25 +86,61 @@ def moco(param):
     failed_transfo = [0 for i in range(nt)]
     file_mat = [[] for i in range(nt)]
 
-    # Motion correction: Loop across T
+    # file names for each volume
     for indice_index in range(nt):
-
-        # create indices and display stuff
         it = index[indice_index]
         file_data_splitT_num.append(file_data_splitT + str(it).zfill(4))
         file_data_splitT_moco_num.append(file_data + suffix + '_T' + str(it).zfill(4))
-        sct.printv(('\nVolume ' + str((it)) + '/' + str(nt - 1) + ':'), verbose)
         file_mat[it] = folder_mat + 'mat.T' + str(it)
 
+    # the target is updated with the first registered volumes (iterative averaging): these volumes are registered
+    # serially, then the target is fixed and the remaining volumes are independent
+    if param.iterative_averaging:
+        nt_serial = min(nt, 10)
+    else:
+        nt_serial = 0
+    nb_cpu = sct.get_nb_cpu(param.nb_cpu)
+    if nb_cpu <= 1:
+        nt_serial = nt
+
+    # the target is averaged in memory and only written to disk when the registration needs it
+    if param.iterative_averaging:
+        im_target = Image(file_target + ext)
+        im_target.changeType('float32')
+    target_updated = False
+
+    # Motion correction: Loop across T
+    for indice_index in range(nt_serial):
+
+        # display stuff
+        it = index[indice_index]
+        sct.printv(('\nVolume ' + str((it)) + '/' + str(nt - 1) + ':'), verbose)
+
+        # write averaged target
+        if target_updated:
+            im_target.save(verbose=0)
+            target_updated = False
+
         # run 3D registration
         failed_transfo[it] = register(param, file_data_splitT_num[it], file_target, file_mat[it], file_data_splitT_moco_num[it])
 
         # average registered volume with target image
         # N.B. use weighted averaging: (target * nb_it + moco) / (nb_it + 1)
         if param.iterative_averaging and indice_index < 10 and failed_transfo[it] == 0:
-            sct.run('sct_maths -i ' + file_target + ext + ' -mul ' + str(indice_index + 1) + ' -o ' + file_target + ext)
-            sct.run('sct_maths -i ' + file_target + ext + ' -add ' + file_data_splitT_moco_num[it] + ext + ' -o ' + file_target + ext)
-            sct.run('sct_maths -i ' + file_target + ext + ' -div ' + str(indice_index + 2) + ' -o ' + file_target + ext)
+            data_moco = Image(file_data_splitT_moco_num[it] + ext).data
+            im_target.data = ((im_target.data * (indice_index + 1) + data_moco.reshape(im_target.data.shape)) / (indice_index + 2)).astype(np.float32)
+            target_updated = True
+
+    if target_updated:
+        im_target.save(verbose=0)
+
+    # register the remaining volumes in parallel
+    if nt_serial < nt:
+        sct.printv('\nRegister volumes ' + str(index[nt_serial]) + ' to ' + str(nt - 1) + ' using ' + str(nb_cpu) + ' processes...', verbose)
+        list_it = [index[indice_index] for indice_index in range(nt_serial, nt)]
+        list_args = [(param, file_data_splitT_num[it], file_target, file_mat[it], file_data_splitT_moco_num[it]) for it in list_it]
+        for it, failed in zip(list_it, register_parallel(list_args, nb_cpu)):
+            failed_transfo[it] = failed
 
     # Replace failed transformation with the closest good one
     sct.printv(('\nReplace failed transformations...'), verbose)
@@ -144,6 +180,26 @@ def moco(param):
     sct.run('rm target.nii')
 
 
+def register_wrapper(args):
+    # sct.run() exits on error: raise an exception instead, otherwise the pool would wait for the worker forever
+    try:
+        return register(*args)
+    except SystemExit:
+        raise RuntimeError('Registration of ' + args[1] + ' failed.')
+
+
+#=======================================================================================================================
+# register_parallel:  run several registrations on a pool of processes
+#=======================================================================================================================
+def register_parallel(list_args, nb_cpu):
+    """
+    :param list_args: list of tuples (param, file_src, file_dest, file_mat, file_out), see register()
+    :param nb_cpu: number of processes
+    :return: list of failed_transfo (same order as list_args)
+    """
+    return sct.run_pool(register_wrapper, list_args, nb_cpu)
+
+
 #=======================================================================================================================
 # register:  registration of two volumes (or two images)
 #=======================================================================================================================
@@ -22,12 +22,20 @@ import numpy as np
 import pandas as pd
 from sklearn import decomposition, manifold
 
-from msct_gmseg_utils import (apply_transfo, average_gm_wm, normalize_slice,
-                              pre_processing, register_data)
+from msct_gmseg_utils import (Slice, apply_transfo, average_gm_wm,
+                              normalize_slice, pre_processing, register_data)
 from msct_image import Image
 from msct_parser import Parser
 from sct_utils import printv, slash_at_the_end
 
+# version of the on-disk model format written by Model.save_model()
+MODEL_FORMAT_VERSION = 1
+# model files: slice data are stored as contiguous arrays, loaded as read-only memory maps
+MODEL_INFO_FILE = 'model_info.npz'
+MODEL_FILES_SLICES = ['im', 'im_M', 'gm_seg', 'wm_seg', 'gm_seg_M', 'wm_seg_M']
+MODEL_FILES_SEG = ['gm_seg', 'wm_seg', 'gm_seg_M', 'wm_seg_M']  # several manual segmentations per slice
+MODEL_FILE_FITTED_MODEL = 'fitted_model.pkl'
+
 
 def get_parser():
     # Initialize the parser
@@ -41,8 +49,13 @@ def get_parser():
     parser.add_option(name="-path-data",
                       type_value="folder",
                       description="Path to the dataset",
-                      mandatory=True,
+                      mandatory=False,
                       example='my_data/')
+    parser.add_option(name="-convert-model",
+                      type_value="folder",
+                      description="Path to a model saved in the former format (gzipped pickles: slices.pklz, intensities.pklz, fitted_model.pklz, fitted_data.pklz), to convert into the current model format in the output folder. No model is computed.",
+                      mandatory=False,
+                      example='gm_model/')
     parser.add_option(name="-o",
                       type_value="folder_creation",
                       description="Output folder",
@@ -405,23 +418,39 @@ class Model:
 
     # ------------------------------------------------------------------------------------------------------------------
     def save_model(self):
+        """
+        Save the model as contiguous typed arrays (.npy files), so that it can be memory-mapped when loaded.
+        Manual segmentations of all slices are concatenated, with the offsets of each slice stored in the info file.
+        """
         os.chdir(self.param_model.new_model_dir)
-        # to save:
         # - self.slices = dictionary
-        slices = self.slices
-        pickle.dump(slices, gzip.open('slices.pklz', 'wb'), protocol=2)
+        dict_info = {}
+        for attr in MODEL_FILES_SLICES:
+            list_data = [getattr(dic_slice, attr) for dic_slice in self.slices]
+            if attr in MODEL_FILES_SEG:
+                dict_info['offsets_' + attr] = np.cumsum([0] + [len(data) for data in list_data])
+                data = np.concatenate(list_data)
+            else:
+                data = np.asarray(list_data)
+            np.save(attr + '.npy', data)
+        dict_info['slice_id'] = np.asarray([dic_slice.id for dic_slice in self.slices])
+        dict_info['level'] = np.asarray([dic_slice.level for dic_slice in self.slices], dtype=float)
+
+        # - self.mean_image = mean image of the dictionary (used to register target on model)
+        np.save('mean_image.npy', self.mean_image)
 
         # - self.intensities = for normalization
-        intensities = self.intensities
-        pickle.dump(intensities, gzip.open('intensities.pklz', 'wb'), protocol=2)
+        dict_info['intensities'] = np.asarray(self.intensities.values, dtype=float)
+        dict_info['intensities_index'] = np.asarray(self.intensities.index)
+        dict_info['intensities_columns'] = np.asarray([str(col) for col in self.intensities.columns])
 
-        # - reduced space (pca or isomap)
-        model = self.fitted_model
-        pickle.dump(model, gzip.open('fitted_model.pklz', 'wb'), protocol=2)
+        # - reduced space (pca or isomap): scikit-learn object, pickled
+        pickle.dump(self.fitted_model, open(MODEL_FILE_FITTED_MODEL, 'wb'), protocol=2)
 
         # - fitted data (=eigen vectors or embedding vectors )
-        data = self.fitted_data
-        pickle.dump(data, gzip.open('fitted_data.pklz', 'wb'), protocol=2)
+        np.save('fitted_data.npy', self.fitted_data)
+
+        np.savez(MODEL_INFO_FILE, version=MODEL_FORMAT_VERSION, method=self.param_model.method, **dict_info)
 
         os.chdir('..')
 
@@ -435,9 +464,21 @@ class Model:
         printv('\nLoading model...', self.param.verbose, 'normal')
         os.chdir(self.param_model.path_model_to_load)
 
-        model_files = {'slices': 'slices.pklz', 'intensity': 'intensities.pklz', 'model': 'fitted_model.pklz', 'data': 'fitted_data.pklz'}
+        if os.path.isfile(MODEL_INFO_FILE):
+            self.load_model_arrays()
+        else:
+            # model saved in the former format
+            self.load_model_pklz()
+
+        printv('  model: ' + self.param_model.method)
+        printv('  ' + str(self.fitted_data.shape[1]) + ' components kept on ' + str(self.fitted_data.shape[0]), self.param.verbose, 'normal')
+        # when model == pca, self.fitted_data.shape[1] = self.fitted_model.n_components_
+        os.chdir(path)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def check_model_files(self, list_fname):
         correct_model = True
-        for fname in model_files.values():
+        for fname in list_fname:
             if os.path.isfile(fname):
                 printv('  OK: ' + fname, self.param.verbose, 'normal')
             else:
@@ -451,6 +492,47 @@ class Model:
                    'cd ' + path_sct + '\n'
                    './install_sct -m -b\n', self.param.verbose, 'error')
 
+    # ------------------------------------------------------------------------------------------------------------------
+    def load_model_arrays(self):
+        """
+        Load a model saved by save_model(): slices data are memory-mapped (read-only), so that loading is immediate
+        and concurrent segmentations share the same pages.
+        """
+        info = np.load(MODEL_INFO_FILE)
+        if int(info['version']) > MODEL_FORMAT_VERSION:
+            printv('ERROR: The GM segmentation model was saved with a more recent version of the model format (' + str(int(info['version'])) + ' > ' + str(MODEL_FORMAT_VERSION) + '). Please update the toolbox.', self.param.verbose, 'error')
+        self.param_model.method = str(info['method'])
+        self.check_model_files([attr + '.npy' for attr in MODEL_FILES_SLICES] + ['mean_image.npy', 'fitted_data.npy', MODEL_FILE_FITTED_MODEL])
+
+        # - self.slices = dictionary (views on memory-mapped arrays)
+        dict_data = dict((attr, np.load(attr + '.npy', mmap_mode='r')) for attr in MODEL_FILES_SLICES)
+        self.slices = []
+        for j, slice_id in enumerate(info['slice_id']):
+            dict_slice = {}
+            for attr in MODEL_FILES_SLICES:
+                if attr in MODEL_FILES_SEG:
+                    offsets = info['offsets_' + attr]
+                    dict_slice[attr] = dict_data[attr][offsets[j]:offsets[j + 1]]
+                else:
+                    dict_slice[attr] = dict_data[attr][j]
+            self.slices.append(Slice(slice_id=int(slice_id), im=dict_slice['im'], gm_seg=dict_slice['gm_seg'], wm_seg=dict_slice['wm_seg'], im_m=dict_slice['im_M'], gm_seg_m=dict_slice['gm_seg_M'], wm_seg_m=dict_slice['wm_seg_M'], level=info['level'][j]))
+        printv('  ' + str(len(self.slices)) + ' slices in the model dataset', self.param.verbose, 'normal')
+        self.mean_image = np.load('mean_image.npy')
+
+        # - self.intensities = for normalization
+        self.intensities = pd.DataFrame(info['intensities'], index=info['intensities_index'], columns=info['intensities_columns'])
+
+        # - reduced space (pca or isomap)
+        self.fitted_model = pickle.load(open(MODEL_FILE_FITTED_MODEL, 'rb'))
+
+        # - fitted data (=eigen vectors or embedding vectors )
+        self.fitted_data = np.load('fitted_data.npy', mmap_mode='r')
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def load_model_pklz(self):
+        model_files = {'slices': 'slices.pklz', 'intensity': 'intensities.pklz', 'model': 'fitted_model.pklz', 'data': 'fitted_data.pklz'}
+        self.check_model_files(model_files.values())
+
         # - self.slices = dictionary
         self.slices = pickle.load(gzip.open(model_files['slices'],  'rb'))
         printv('  ' + str(len(self.slices)) + ' slices in the model dataset', self.param.verbose, 'normal')
@@ -465,10 +547,8 @@ class Model:
         # - fitted data (=eigen vectors or embedding vectors )
         self.fitted_data = pickle.load(gzip.open(model_files['data'], 'rb'))
 
-        printv('  model: ' + self.param_model.method)
-        printv('  ' + str(self.fitted_data.shape[1]) + ' components kept on ' + str(self.fitted_data.shape[0]), self.param.verbose, 'normal')
-        # when model == pca, self.fitted_data.shape[1] = self.fitted_model.n_components_
-        os.chdir(path)
+        printv('  Model saved in the former format (.pklz): convert it for faster loading with:\n'
+               '  msct_multiatlas_seg -convert-model ' + os.path.abspath('.') + ' -o new_gm_model/', self.param.verbose, 'warning')
 
     # ------------------------------------------------------------------------------------------------------------------
     #                                                   UTILS FUNCTIONS
@@ -510,10 +590,29 @@ def main(args=None):
     parser = get_parser()
     arguments = parser.parse(args)
 
-    param_model.path_data = arguments['-path-data']
-
     if '-o' in arguments:
         param_model.new_model_dir = arguments['-o']
+
+    if '-convert-model' in arguments:
+        # convert a model saved in the former format
+        param_model.path_model_to_load = os.path.abspath(arguments['-convert-model'])
+        if '-model-type' in arguments:
+            param_model.method = arguments['-model-type']
+        if '-v' in arguments:
+            param.verbose = arguments['-v']
+        model = Model(param_model=param_model, param_data=param_data, param=param)
+        model.load_model()
+        if not os.path.exists(param_model.new_model_dir):
+            os.mkdir(param_model.new_model_dir)
+        if os.path.isfile(os.path.join(param_model.path_model_to_load, 'info.txt')):
+            shutil.copy(os.path.join(param_model.path_model_to_load, 'info.txt'), param_model.new_model_dir)
+        model.save_model()
+        printv('Model converted in: ' + param_model.new_model_dir, param.verbose, 'info')
+        return
+
+    if '-path-data' not in arguments:
+        printv('ERROR: Specify the dataset (-path-data) or a model to convert (-convert-model).', param.verbose, 'error')
+    param_model.path_data = arguments['-path-data']
     if '-model-type' in arguments:
         param_model.method = arguments['-model-type']
     if '-k-pca' in arguments:
@@ -383,6 +383,11 @@ class Parser:
             if option not in dictionary and self.options[option].default_value:
                 dictionary[option] = self.options[option].default_value
 
+        # restore the outputs from the cache or prepare to store them (only if SCT_CACHE_DIR is set, see msct_cache)
+        if check_file_exist:
+            import msct_cache
+            msct_cache.start(self, dictionary)
+
         # return a dictionary with each option name as a key and the input as the value
         return dictionary
 
@@ -37,7 +37,8 @@ def register_slicewise(fname_src,
                         paramreg=None,
                         ants_registration_params=None,
                         path_qc='./',
-                        verbose=0):
+                        verbose=0,
+                        nb_cpu=None):
 
     # create temporary folder
     path_tmp = sct.tmp_create(verbose)
@@ -67,7 +68,7 @@ def register_slicewise(fname_src,
         algo_dic = {'translation': 'Translation', 'rigid': 'Rigid', 'affine': 'Affine', 'syn': 'SyN', 'bsplinesyn': 'BSplineSyN', 'centermass': 'centermass'}
         paramreg.algo = algo_dic[paramreg.algo]
         # run slicewise registration
-        register2d('src.nii', 'dest.nii', fname_mask=fname_mask, fname_warp=warp_forward_out, fname_warp_inv=warp_inverse_out, paramreg=paramreg, ants_registration_params=ants_registration_params, verbose=verbose)
+        register2d('src.nii', 'dest.nii', fname_mask=fname_mask, fname_warp=warp_forward_out, fname_warp_inv=warp_inverse_out, paramreg=paramreg, ants_registration_params=ants_registration_params, verbose=verbose, nb_cpu=nb_cpu)
 
     sct.printv('\nMove warping fields to parent folder...', verbose)
     sct.run('mv ' + warp_forward_out + ' ../')
@@ -101,25 +102,12 @@ def register2d_centermassrot(fname_src, fname_dest, fname_warp='warp_forward.nii
 
     # Get image dimensions and retrieve nz
     sct.printv('\nGet image dimensions of destination image...', verbose)
-    nx, ny, nz, nt, px, py, pz, pt = Image(fname_dest).dim
+    im_src = Image(fname_src)
+    im_dest = Image(fname_dest)
+    nx, ny, nz, nt, px, py, pz, pt = im_dest.dim
     sct.printv('  matrix size: ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz), verbose)
     sct.printv('  voxel size:  ' + str(px) + 'mm x ' + str(py) + 'mm x ' + str(pz) + 'mm', verbose)
 
-    # Split source volume along z
-    sct.printv('\nSplit input volume...', verbose)
-    from sct_image import split_data
-    im_src = Image('src.nii')
-    split_source_list = split_data(im_src, 2)
-    for im in split_source_list:
-        im.save()
-
-    # Split destination volume along z
-    sct.printv('\nSplit destination volume...', verbose)
-    im_dest = Image('dest.nii')
-    split_dest_list = split_data(im_dest, 2)
-    for im in split_dest_list:
-        im.save()
-
     # display image
     data_src = im_src.data
     data_dest = im_dest.data
@@ -181,95 +169,110 @@ def register2d_centermassrot(fname_src, fname_dest, fname_warp='warp_forward.nii
         # update variable
         angle_src_dest[z_nonzero] = angle_src_dest_regularized
 
-    # initialize warping fields
+    # construct 3D warping fields (all slices at once)
     # N.B. forward transfo is defined in destination space and inverse transfo is defined in the source space
-    warp_x = np.zeros(data_dest.shape)
-    warp_y = np.zeros(data_dest.shape)
-    warp_inv_x = np.zeros(data_src.shape)
-    warp_inv_y = np.zeros(data_src.shape)
+    warp_x, warp_y, warp_inv_x, warp_inv_y = compute_warp_centermassrot(im_src, data_dest.shape, centermass_src, centermass_dest, angle_src_dest, z_nonzero)
 
-    # construct 3D warping matrix
-    for iz in z_nonzero:
-        print str(iz) + '/' + str(nz) + '..',
-        # get indices of x and y coordinates
-        row, col = np.indices((nx, ny))
-        # build 2xn array of coordinates in pixel space
-        coord_init_pix = np.array([row.ravel(), col.ravel(), np.array(np.ones(len(row.ravel())) * iz)]).T
-        # convert coordinates to physical space
-        coord_init_phy = np.array(im_src.transfo_pix2phys(coord_init_pix))
-        # get centermass coordinates in physical space
-        centermass_src_phy = im_src.transfo_pix2phys([[centermass_src[iz, :].T[0], centermass_src[iz, :].T[1], iz]])[0]
-        centermass_dest_phy = im_src.transfo_pix2phys([[centermass_dest[iz, :].T[0], centermass_dest[iz, :].T[1], iz]])[0]
-        # build rotation matrix
-        R = np.matrix(((cos(angle_src_dest[iz]), sin(angle_src_dest[iz])), (-sin(angle_src_dest[iz]), cos(angle_src_dest[iz]))))
-        # build 3D rotation matrix
-        R3d = np.eye(3)
-        R3d[0:2, 0:2] = R
-        # apply forward transformation (in physical space)
-        coord_forward_phy = np.array(np.dot((coord_init_phy - np.transpose(centermass_dest_phy)), R3d) + np.transpose(centermass_src_phy))
-        # apply inverse transformation (in physical space)
-        coord_inverse_phy = np.array(np.dot((coord_init_phy - np.transpose(centermass_src_phy)), R3d.T) + np.transpose(centermass_dest_phy))
-        # display rotations
-        if verbose == 2 and not angle_src_dest[iz] == 0:
-            # compute new coordinates
-            coord_src_rot = coord_src[iz] * R
-            coord_dest_rot = coord_dest[iz] * R.T
-            # generate figure
-            plt.figure('iz=' + str(iz) + ', angle_src_dest=' + str(angle_src_dest[iz]), figsize=(9, 9))
-            # plt.ion()  # enables interactive mode (allows keyboard interruption)
-            # plt.title('iz='+str(iz))
-            for isub in [221, 222, 223, 224]:
-                # plt.figure
-                plt.subplot(isub)
-                # ax = matplotlib.pyplot.axis()
-                if isub == 221:
-                    plt.scatter(coord_src[iz][:, 0], coord_src[iz][:, 1], s=5, marker='o', zorder=10, color='steelblue',
-                                alpha=0.5)
-                    pcaaxis = pca_src[iz].components_.T
-                    pca_eigenratio = pca_src[iz].explained_variance_ratio_
-                    plt.title('src')
-                elif isub == 222:
-                    plt.scatter(coord_src_rot[:, 0], coord_src_rot[:, 1], s=5, marker='o', zorder=10,
-                                color='steelblue',
-                                alpha=0.5)
-                    pcaaxis = pca_dest[iz].components_.T
-                    pca_eigenratio = pca_dest[iz].explained_variance_ratio_
-                    plt.title('src_rot')
-                elif isub == 223:
-                    plt.scatter(coord_dest[iz][:, 0], coord_dest[iz][:, 1], s=5, marker='o', zorder=10, color='red',
-                                alpha=0.5)
-                    pcaaxis = pca_dest[iz].components_.T
-                    pca_eigenratio = pca_dest[iz].explained_variance_ratio_
-                    plt.title('dest')
-                elif isub == 224:
-                    plt.scatter(coord_dest_rot[:, 0], coord_dest_rot[:, 1], s=5, marker='o', zorder=10, color='red',
-                                alpha=0.5)
-                    pcaaxis = pca_src[iz].components_.T
-                    pca_eigenratio = pca_src[iz].explained_variance_ratio_
-                    plt.title('dest_rot')
-                plt.text(-2.5, -2, 'eigenvectors:', horizontalalignment='left', verticalalignment='bottom')
-                plt.text(-2.5, -2.8, str(pcaaxis), horizontalalignment='left', verticalalignment='bottom')
-                plt.text(-2.5, 2.5, 'eigenval_ratio:', horizontalalignment='left', verticalalignment='bottom')
-                plt.text(-2.5, 2, str(pca_eigenratio), horizontalalignment='left', verticalalignment='bottom')
-                plt.plot([0, pcaaxis[0, 0]], [0, pcaaxis[1, 0]], linewidth=2, color='red')
-                plt.plot([0, pcaaxis[0, 1]], [0, pcaaxis[1, 1]], linewidth=2, color='orange')
-                plt.axis([-3, 3, -3, 3])
-                plt.gca().set_aspect('equal', adjustable='box')
-                # plt.axis('equal')
-            plt.savefig(path_qc + 'register2d_centermassrot_pca_z' + str(iz) + '.png')
-            plt.close()
-
-        # construct 3D warping matrix
-        warp_x[:, :, iz] = np.array([coord_forward_phy[i, 0] - coord_init_phy[i, 0] for i in xrange(nx * ny)]).reshape((nx, ny))
-        warp_y[:, :, iz] = np.array([coord_forward_phy[i, 1] - coord_init_phy[i, 1] for i in xrange(nx * ny)]).reshape((nx, ny))
-        warp_inv_x[:, :, iz] = np.array([coord_inverse_phy[i, 0] - coord_init_phy[i, 0] for i in xrange(nx * ny)]).reshape((nx, ny))
-        warp_inv_y[:, :, iz] = np.array([coord_inverse_phy[i, 1] - coord_init_phy[i, 1] for i in xrange(nx * ny)]).reshape((nx, ny))
+    # display rotations
+    if verbose == 2:
+        for iz in z_nonzero:
+            if not angle_src_dest[iz] == 0:
+                # compute new coordinates
+                R = np.matrix(((cos(angle_src_dest[iz]), sin(angle_src_dest[iz])), (-sin(angle_src_dest[iz]), cos(angle_src_dest[iz]))))
+                coord_src_rot = coord_src[iz] * R
+                coord_dest_rot = coord_dest[iz] * R.T
+                # generate figure
+                plt.figure('iz=' + str(iz) + ', angle_src_dest=' + str(angle_src_dest[iz]), figsize=(9, 9))
+                # plt.ion()  # enables interactive mode (allows keyboard interruption)
+                # plt.title('iz='+str(iz))
+                for isub in [221, 222, 223, 224]:
+                    # plt.figure
+                    plt.subplot(isub)
+                    # ax = matplotlib.pyplot.axis()
+                    if isub == 221:
+                        plt.scatter(coord_src[iz][:, 0], coord_src[iz][:, 1], s=5, marker='o', zorder=10, color='steelblue',
+                                    alpha=0.5)
+                        pcaaxis = pca_src[iz].components_.T
+                        pca_eigenratio = pca_src[iz].explained_variance_ratio_
+                        plt.title('src')
+                    elif isub == 222:
+                        plt.scatter(coord_src_rot[:, 0], coord_src_rot[:, 1], s=5, marker='o', zorder=10,
+                                    color='steelblue',
+                                    alpha=0.5)
+                        pcaaxis = pca_dest[iz].components_.T
+                        pca_eigenratio = pca_dest[iz].explained_variance_ratio_
+                        plt.title('src_rot')
+                    elif isub == 223:
+                        plt.scatter(coord_dest[iz][:, 0], coord_dest[iz][:, 1], s=5, marker='o', zorder=10, color='red',
+                                    alpha=0.5)
+                        pcaaxis = pca_dest[iz].components_.T
+                        pca_eigenratio = pca_dest[iz].explained_variance_ratio_
+                        plt.title('dest')
+                    elif isub == 224:
+                        plt.scatter(coord_dest_rot[:, 0], coord_dest_rot[:, 1], s=5, marker='o', zorder=10, color='red',
+                                    alpha=0.5)
+                        pcaaxis = pca_src[iz].components_.T
+                        pca_eigenratio = pca_src[iz].explained_variance_ratio_
+                        plt.title('dest_rot')
+                    plt.text(-2.5, -2, 'eigenvectors:', horizontalalignment='left', verticalalignment='bottom')
+                    plt.text(-2.5, -2.8, str(pcaaxis), horizontalalignment='left', verticalalignment='bottom')
+                    plt.text(-2.5, 2.5, 'eigenval_ratio:', horizontalalignment='left', verticalalignment='bottom')
+                    plt.text(-2.5, 2, str(pca_eigenratio), horizontalalignment='left', verticalalignment='bottom')
+                    plt.plot([0, pcaaxis[0, 0]], [0, pcaaxis[1, 0]], linewidth=2, color='red')
+                    plt.plot([0, pcaaxis[0, 1]], [0, pcaaxis[1, 1]], linewidth=2, color='orange')
+                    plt.axis([-3, 3, -3, 3])
+                    plt.gca().set_aspect('equal', adjustable='box')
+                    # plt.axis('equal')
+                plt.savefig(path_qc + 'register2d_centermassrot_pca_z' + str(iz) + '.png')
+                plt.close()
 
     # Generate forward warping field (defined in destination space)
     generate_warping_field(fname_dest, warp_x, warp_y, fname_warp, verbose)
     generate_warping_field(fname_src, warp_inv_x, warp_inv_y, fname_warp_inv, verbose)
 
 
+def get_coordinates_grid(shape):
+    """
+    :param shape: (nx, ny, nz)
+    :return: array (nx, ny, nz, 3) of pixel coordinates (float)
+    """
+    return np.indices(shape, dtype=float).transpose(1, 2, 3, 0)
+
+
+def compute_warp_centermassrot(im_src, shape, centermass_src, centermass_dest, angle_src_dest, z_nonzero):
+    """
+    Compute the displacements of the slicewise rotation around the center of mass, for all slices at once.
+    The forward transformation maps x to R(x - centermass_dest) + centermass_src, in physical space.
+    :param im_src: Image used for pixel to physical conversion
+    :param shape: (nx, ny, nz)
+    :param centermass_src: array (nz, 2) of centers of mass of the source, in pixel space
+    :param centermass_dest: array (nz, 2) of centers of mass of the destination, in pixel space
+    :param angle_src_dest: array (nz) of rotation angles (rad)
+    :param z_nonzero: list of slices to process. Displacement is zero for the other slices.
+    :return: warp_x, warp_y, warp_inv_x, warp_inv_y: arrays (nx, ny, nz) of displacements in physical space
+    """
+    nz = shape[2]
+    # physical coordinates of each voxel, as (nx, ny, nz) arrays
+    coord_phy = im_src.transfo_pix2phys_array(get_coordinates_grid(shape))
+    x, y = coord_phy[..., 0], coord_phy[..., 1]
+    # physical coordinates of centers of mass, as (nz) arrays that broadcast along the last axis
+    centermass_src_phy = im_src.transfo_pix2phys_array(np.c_[centermass_src, np.arange(nz)])
+    centermass_dest_phy = im_src.transfo_pix2phys_array(np.c_[centermass_dest, np.arange(nz)])
+    cos_a, sin_a = np.cos(angle_src_dest), np.sin(angle_src_dest)
+    # apply forward transformation (in physical space)
+    x_c, y_c = x - centermass_dest_phy[:, 0], y - centermass_dest_phy[:, 1]
+    warp_x = x_c * cos_a - y_c * sin_a + centermass_src_phy[:, 0] - x
+    warp_y = x_c * sin_a + y_c * cos_a + centermass_src_phy[:, 1] - y
+    # apply inverse transformation (in physical space)
+    x_c, y_c = x - centermass_src_phy[:, 0], y - centermass_src_phy[:, 1]
+    warp_inv_x = x_c * cos_a + y_c * sin_a + centermass_dest_phy[:, 0] - x
+    warp_inv_y = - x_c * sin_a + y_c * cos_a + centermass_dest_phy[:, 1] - y
+    # empty slices are not transformed
+    mask = np.zeros(nz, dtype=bool)
+    mask[z_nonzero] = True
+    return warp_x * mask, warp_y * mask, warp_inv_x * mask, warp_inv_y * mask
+
+
 def register2d_columnwise(fname_src, fname_dest, fname_warp='warp_forward.nii.gz', fname_warp_inv='warp_inverse.nii.gz', verbose=0, path_qc='./', smoothWarpXY=1):
     """
     Column-wise non-linear registration of segmentations. Based on an idea from Allan Martin.
@@ -297,25 +300,12 @@ def register2d_columnwise(fname_src, fname_dest, fname_warp='warp_forward.nii.gz
 
     # Get image dimensions and retrieve nz
     sct.printv('\nGet image dimensions of destination image...', verbose)
-    nx, ny, nz, nt, px, py, pz, pt = Image(fname_dest).dim
+    im_src = Image(fname_src)
+    im_dest = Image(fname_dest)
+    nx, ny, nz, nt, px, py, pz, pt = im_dest.dim
     sct.printv('  matrix size: ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz), verbose)
     sct.printv('  voxel size:  ' + str(px) + 'mm x ' + str(py) + 'mm x ' + str(pz) + 'mm', verbose)
 
-    # Split source volume along z
-    sct.printv('\nSplit input volume...', verbose)
-    from sct_image import split_data
-    im_src = Image('src.nii')
-    split_source_list = split_data(im_src, 2)
-    for im in split_source_list:
-        im.save()
-
-    # Split destination volume along z
-    sct.printv('\nSplit destination volume...', verbose)
-    im_dest = Image('dest.nii')
-    split_dest_list = split_data(im_dest, 2)
-    for im in split_dest_list:
-        im.save()
-
     # open image
     data_src = im_src.data
     data_dest = im_dest.data
@@ -328,13 +318,12 @@ def register2d_columnwise(fname_src, fname_dest, fname_warp='warp_forward.nii.gz
         data_src = data_src.reshape(new_shape)
         data_dest = data_dest.reshape(new_shape)
 
-    # initialize forward warping field (defined in destination space)
-    warp_x = np.zeros(data_dest.shape)
-    warp_y = np.zeros(data_dest.shape)
-
-    # initialize inverse warping field (defined in source space)
-    warp_inv_x = np.zeros(data_src.shape)
-    warp_inv_y = np.zeros(data_src.shape)
+    # initialize pixel coordinates of the transformations (identity), as (nx, ny, nz, 3) arrays
+    coord_pix = get_coordinates_grid(data_dest.shape)
+    coord_pix_scaleX, coord_pix_scaleY = np.copy(coord_pix), np.copy(coord_pix)
+    coord_pix_scaleXinv, coord_pix_scaleYinv = np.copy(coord_pix), np.copy(coord_pix)
+    # slices where the transformation is estimated (warping field is zero elsewhere)
+    z_estimated = np.zeros(nz, dtype=bool)
 
     # Loop across slices
     sct.printv('\nEstimate columnwise transformation...', verbose)
@@ -349,9 +338,7 @@ def register2d_columnwise(fname_src, fname_dest, fname_warp='warp_forward.nii.gz
         # ordering of indices is as follows:
         # coord_init_pix[:, 0] = 0, 0, 0, ..., 1, 1, 1..., nx, nx, nx
         # coord_init_pix[:, 1] = 0, 1, 2, ..., 0, 1, 2..., 0, 1, 2
-        coord_init_pix = np.array([row.ravel(), col.ravel(), np.array(np.ones(len(row.ravel())) * iz)]).T
-        # convert coordinates to physical space
-        coord_init_phy = np.array(im_src.transfo_pix2phys(coord_init_pix))
+        coord_init_pix = coord_pix[:, :, iz].reshape(nx * ny, 3)
         # get 2d data from the selected slice
         src2d = data_src[:, :, iz]
         dest2d = data_dest[:, :, iz]
@@ -509,21 +496,24 @@ def register2d_columnwise(fname_src, fname_dest, fname_warp='warp_forward.nii.gz
                 plt.savefig(path_qc + 'register2d_columnwise_image_z' + str(iz) + '.png')
                 plt.close()
 
-            # ============================================================
-            # CALCULATE TRANSFORMATIONS
-            # ============================================================
-            # calculate forward transformation (in physical space)
-            coord_init_phy_scaleX = np.array(im_dest.transfo_pix2phys(coord_init_pix_scaleX))
-            coord_init_phy_scaleY = np.array(im_dest.transfo_pix2phys(coord_init_pix_scaleY))
-            # calculate inverse transformation (in physical space)
-            coord_init_phy_scaleXinv = np.array(im_src.transfo_pix2phys(coord_init_pix_scaleXinv))
-            coord_init_phy_scaleYinv = np.array(im_src.transfo_pix2phys(coord_init_pix_scaleYinv))
-            # compute displacement per pixel in destination space (for forward warping field)
-            warp_x[:, :, iz] = np.array([coord_init_phy_scaleXinv[i, 0] - coord_init_phy[i, 0] for i in xrange(nx * ny)]).reshape((nx, ny))
-            warp_y[:, :, iz] = np.array([coord_init_phy_scaleYinv[i, 1] - coord_init_phy[i, 1] for i in xrange(nx * ny)]).reshape((nx, ny))
-            # compute displacement per pixel in source space (for inverse warping field)
-            warp_inv_x[:, :, iz] = np.array([coord_init_phy_scaleX[i, 0] - coord_init_phy[i, 0] for i in xrange(nx * ny)]).reshape((nx, ny))
-            warp_inv_y[:, :, iz] = np.array([coord_init_phy_scaleY[i, 1] - coord_init_phy[i, 1] for i in xrange(nx * ny)]).reshape((nx, ny))
+            # store transformations (in pixel space)
+            coord_pix_scaleX[:, :, iz] = coord_init_pix_scaleX.reshape(nx, ny, 3)
+            coord_pix_scaleY[:, :, iz] = coord_init_pix_scaleY.reshape(nx, ny, 3)
+            coord_pix_scaleXinv[:, :, iz] = coord_init_pix_scaleXinv.reshape(nx, ny, 3)
+            coord_pix_scaleYinv[:, :, iz] = coord_init_pix_scaleYinv.reshape(nx, ny, 3)
+            z_estimated[iz] = True
+
+    # ============================================================
+    # CALCULATE TRANSFORMATIONS
+    # ============================================================
+    # convert coordinates to physical space
+    coord_phy = im_src.transfo_pix2phys_array(coord_pix)
+    # compute displacement per pixel in destination space (for forward warping field)
+    warp_x = (im_src.transfo_pix2phys_array(coord_pix_scaleXinv) - coord_phy)[..., 0] * z_estimated
+    warp_y = (im_src.transfo_pix2phys_array(coord_pix_scaleYinv) - coord_phy)[..., 1] * z_estimated
+    # compute displacement per pixel in source space (for inverse warping field)
+    warp_inv_x = (im_dest.transfo_pix2phys_array(coord_pix_scaleX) - coord_phy)[..., 0] * z_estimated
+    warp_inv_y = (im_dest.transfo_pix2phys_array(coord_pix_scaleY) - coord_phy)[..., 1] * z_estimated
 
     # Generate forward warping field (defined in destination space)
     generate_warping_field(fname_dest, warp_x, warp_y, fname_warp, verbose)
@@ -533,7 +523,7 @@ def register2d_columnwise(fname_src, fname_dest, fname_warp='warp_forward.nii.gz
 
 def register2d(fname_src, fname_dest, fname_mask='', fname_warp='warp_forward.nii.gz', fname_warp_inv='warp_inverse.nii.gz', paramreg=Paramreg(step='0', type='im', algo='Translation', metric='MI', iter='5', shrink='1', smooth='0', gradStep='0.5'),
                     ants_registration_params={'rigid': '', 'affine': '', 'compositeaffine': '', 'similarity': '', 'translation': '', 'bspline': ',10', 'gaussiandisplacementfield': ',3,0',
-                                              'bsplinedisplacementfield': ',5,10', 'syn': ',3,0', 'bsplinesyn': ',1,3'}, verbose=0):
+                                              'bsplinedisplacementfield': ',5,10', 'syn': ',3,0', 'bsplinesyn': ',1,3'}, verbose=0, nb_cpu=None):
     """Slice-by-slice registration of two images.
 
     We first split the 3D images into 2D images (and the mask if inputted). Then we register slices of the two images
@@ -551,6 +541,7 @@ def register2d(fname_src, fname_dest, fname_mask='', fname_warp='warp_forward.ni
         fname_warp_inv: name of output 3d inverse warping field
         paramreg[optional]: parameters of antsRegistration (type: Paramreg class from sct_register_multimodal)
         ants_registration_params[optional]: specific algorithm's parameters for antsRegistration (type: dictionary)
+        nb_cpu[optional]: number of processes used to register slices. None: all the available cores, 0 or 1: serial.
 
     output:
         if algo==translation:
@@ -605,84 +596,21 @@ def register2d(fname_src, fname_dest, fname_mask='', fname_warp='warp_forward.ni
     # coord_diff_origin = (np.asarray(coord_origin_dest[0]) - np.asarray(coord_origin_input[0])).tolist()
     # [x_o, y_o, z_o] = [coord_diff_origin[0] * 1.0/px, coord_diff_origin[1] * 1.0/py, coord_diff_origin[2] * 1.0/pz]
 
-    # initialization
-    if paramreg.algo in ['Translation']:
-        x_displacement = [0 for i in range(nz)]
-        y_displacement = [0 for i in range(nz)]
-        theta_rotation = [0 for i in range(nz)]
-    if paramreg.algo in ['Rigid', 'Affine', 'BSplineSyN', 'SyN']:
-        list_warp = []
-        list_warp_inv = []
-
-    # loop across slices
-    for i in range(nz):
-        # set masking
-        sct.printv('Registering slice ' + str(i) + '/' + str(nz - 1) + '...', verbose)
-        num = numerotation(i)
-        prefix_warp2d = 'warp2d_' + num
-        # if mask is used, prepare command for ANTs
-        if fname_mask != '':
-            masking = '-x mask_Z' + num + '.nii.gz'
-        else:
-            masking = ''
-        # main command for registration
-        cmd = ('isct_antsRegistration '
-               '--dimensionality 2 '
-               '--transform ' + paramreg.algo + '[' + str(paramreg.gradStep) +
-               ants_registration_params[paramreg.algo.lower()] + '] '
-               '--metric ' + paramreg.metric + '[dest_Z' + num + '.nii' + ',src_Z' + num + '.nii' + ',1,' + metricSize + '] '  #[fixedImage,movingImage,metricWeight +nb_of_bins (MI) or radius (other)
-               '--convergence ' + str(paramreg.iter) + ' '
-               '--shrink-factors ' + str(paramreg.shrink) + ' '
-               '--smoothing-sigmas ' + str(paramreg.smooth) + 'mm '
-               '--output [' + prefix_warp2d + ',src_Z' + num + '_reg.nii] '    #--> file.mat (contains Tx,Ty, theta)
-               '--interpolation BSpline[3] '
-               + masking)
-        # add init translation
-        if not paramreg.init == '':
-            init_dict = {'geometric': '0', 'centermass': '1', 'origin': '2'}
-            cmd += ' -r [dest_Z' + num + '.nii' + ',src_Z' + num + '.nii,' + init_dict[paramreg.init] + ']'
-
-        try:
-            # run registration
-            sct.run(cmd)
-
-            if paramreg.algo in ['Translation']:
-                file_mat = prefix_warp2d + '0GenericAffine.mat'
-                matfile = loadmat(file_mat, struct_as_record=True)
-                array_transfo = matfile['AffineTransform_double_2_2']
-                x_displacement[i] = array_transfo[4][0]  # Tx in ITK'S coordinate system
-                y_displacement[i] = array_transfo[5][0]  # Ty  in ITK'S and fslview's coordinate systems
-                theta_rotation[i] = asin(array_transfo[2])  # angle of rotation theta in ITK'S coordinate system (minus theta for fslview)
-
-            if paramreg.algo in ['Rigid', 'Affine', 'BSplineSyN', 'SyN']:
-                # List names of 2d warping fields for subsequent merge along Z
-                file_warp2d = prefix_warp2d + '0Warp.nii.gz'
-                file_warp2d_inv = prefix_warp2d + '0InverseWarp.nii.gz'
-                list_warp.append(file_warp2d)
-                list_warp_inv.append(file_warp2d_inv)
-
-            if paramreg.algo in ['Rigid', 'Affine']:
-                # Generating null 2d warping field (for subsequent concatenation with affine transformation)
-                sct.run('isct_antsRegistration -d 2 -t SyN[1, 1, 1] -c 0 -m MI[dest_Z' + num + '.nii, src_Z' + num + '.nii, 1, 32] -o warp2d_null -f 1 -s 0')
-                # --> outputs: warp2d_null0Warp.nii.gz, warp2d_null0InverseWarp.nii.gz
-                file_mat = prefix_warp2d + '0GenericAffine.mat'
-                # Concatenating mat transfo and null 2d warping field to obtain 2d warping field of affine transformation
-                sct.run('isct_ComposeMultiTransform 2 ' + file_warp2d + ' -R dest_Z' + num + '.nii warp2d_null0Warp.nii.gz ' + file_mat)
-                sct.run('isct_ComposeMultiTransform 2 ' + file_warp2d_inv + ' -R src_Z' + num + '.nii warp2d_null0InverseWarp.nii.gz -i ' + file_mat)
-
-        # if an exception occurs with ants, take the last value for the transformation
-        # TODO: DO WE NEED TO DO THAT??? (julien 2016-03-01)
-        except Exception, e:
-            sct.printv('ERROR: Exception occurred.\n' + str(e), 1, 'error')
+    # register slices (slices are independent: they are dispatched on a pool of processes)
+    list_args = [(i, nz, paramreg, ants_registration_params, metricSize, fname_mask != '', verbose) for i in range(nz)]
+    nb_cpu = min(sct.get_nb_cpu(nb_cpu), nz)
+    if nb_cpu <= 1:
+        list_results = [register2d_slice(args) for args in list_args]
+    else:
+        sct.printv('\nRegister slices using ' + str(nb_cpu) + ' processes...', verbose)
+        list_results = sct.run_pool(register2d_slice_wrapper, list_args, nb_cpu)
 
     # Merge warping field along z
     sct.printv('\nMerge warping fields along z...', verbose)
 
     if paramreg.algo in ['Translation']:
         # convert to array
-        x_disp_a = np.asarray(x_displacement)
-        y_disp_a = np.asarray(y_displacement)
-        theta_rot_a = np.asarray(theta_rotation)
+        x_disp_a, y_disp_a, theta_rot_a = np.asarray(list_results, dtype=float).T
         # Generate warping field
         generate_warping_field('dest.nii', x_disp_a, y_disp_a, fname_warp=fname_warp)  #name_warp= 'step'+str(paramreg.step)
         # Inverse warping field
@@ -691,10 +619,92 @@ def register2d(fname_src, fname_dest, fname_mask='', fname_warp='warp_forward.ni
     if paramreg.algo in ['Rigid', 'Affine', 'BSplineSyN', 'SyN']:
         from sct_image import concat_warp2d
         # concatenate 2d warping fields along z
+        list_warp, list_warp_inv = [list(l) for l in zip(*list_results)]
         concat_warp2d(list_warp, fname_warp, 'dest.nii')
         concat_warp2d(list_warp_inv, fname_warp_inv, 'src.nii')
 
 
+def register2d_slice_wrapper(args):
+    import os
+    # each slice is registered by a single-threaded ANTs process: do not oversubscribe the cores
+    os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = '1'
+    # sct.run() exits on error: raise an exception instead, otherwise the pool would wait for the worker forever
+    try:
+        return register2d_slice(args)
+    except SystemExit:
+        raise RuntimeError('Registration of slice ' + str(args[0]) + ' failed.')
+
+
+def register2d_slice(args):
+    """Register one slice of src_Z*.nii onto dest_Z*.nii (files created by register2d).
+
+    :param args: tuple (i, nz, paramreg, ants_registration_params, metricSize, use_mask, verbose)
+    :return: if algo==translation: (x_displacement, y_displacement, theta_rotation)
+             else: (file_warp2d, file_warp2d_inv)
+    """
+    i, nz, paramreg, ants_registration_params, metricSize, use_mask, verbose = args
+    # set masking
+    sct.printv('Registering slice ' + str(i) + '/' + str(nz - 1) + '...', verbose)
+    num = numerotation(i)
+    prefix_warp2d = 'warp2d_' + num
+    # if mask is used, prepare command for ANTs
+    if use_mask:
+        masking = '-x mask_Z' + num + '.nii.gz'
+    else:
+        masking = ''
+    # main command for registration
+    cmd = ('isct_antsRegistration '
+           '--dimensionality 2 '
+           '--transform ' + paramreg.algo + '[' + str(paramreg.gradStep) +
+           ants_registration_params[paramreg.algo.lower()] + '] '
+           '--metric ' + paramreg.metric + '[dest_Z' + num + '.nii' + ',src_Z' + num + '.nii' + ',1,' + metricSize + '] '  #[fixedImage,movingImage,metricWeight +nb_of_bins (MI) or radius (other)
+           '--convergence ' + str(paramreg.iter) + ' '
+           '--shrink-factors ' + str(paramreg.shrink) + ' '
+           '--smoothing-sigmas ' + str(paramreg.smooth) + 'mm '
+           '--output [' + prefix_warp2d + ',src_Z' + num + '_reg.nii] '    #--> file.mat (contains Tx,Ty, theta)
+           '--interpolation BSpline[3] '
+           + masking)
+    # add init translation
+    if not paramreg.init == '':
+        init_dict = {'geometric': '0', 'centermass': '1', 'origin': '2'}
+        cmd += ' -r [dest_Z' + num + '.nii' + ',src_Z' + num + '.nii,' + init_dict[paramreg.init] + ']'
+
+    try:
+        # run registration
+        sct.run(cmd)
+
+        if paramreg.algo in ['Translation']:
+            file_mat = prefix_warp2d + '0GenericAffine.mat'
+            matfile = loadmat(file_mat, struct_as_record=True)
+            array_transfo = matfile['AffineTransform_double_2_2']
+            x_displacement = array_transfo[4][0]  # Tx in ITK'S coordinate system
+            y_displacement = array_transfo[5][0]  # Ty  in ITK'S and fslview's coordinate systems
+            theta_rotation = asin(array_transfo[2])  # angle of rotation theta in ITK'S coordinate system (minus theta for fslview)
+            return x_displacement, y_displacement, theta_rotation
+
+        # List names of 2d warping fields for subsequent merge along Z
+        file_warp2d = prefix_warp2d + '0Warp.nii.gz'
+        file_warp2d_inv = prefix_warp2d + '0InverseWarp.nii.gz'
+
+        if paramreg.algo in ['Rigid', 'Affine']:
+            # Generating null 2d warping field (for subsequent concatenation with affine transformation)
+            # N.B. the prefix is per slice because slices can be registered concurrently
+            prefix_null = 'warp2d_null_' + num
+            sct.run('isct_antsRegistration -d 2 -t SyN[1, 1, 1] -c 0 -m MI[dest_Z' + num + '.nii, src_Z' + num + '.nii, 1, 32] -o ' + prefix_null + ' -f 1 -s 0')
+            # --> outputs: warp2d_null_<num>0Warp.nii.gz, warp2d_null_<num>0InverseWarp.nii.gz
+            file_mat = prefix_warp2d + '0GenericAffine.mat'
+            # Concatenating mat transfo and null 2d warping field to obtain 2d warping field of affine transformation
+            sct.run('isct_ComposeMultiTransform 2 ' + file_warp2d + ' -R dest_Z' + num + '.nii ' + prefix_null + '0Warp.nii.gz ' + file_mat)
+            sct.run('isct_ComposeMultiTransform 2 ' + file_warp2d_inv + ' -R src_Z' + num + '.nii ' + prefix_null + '0InverseWarp.nii.gz -i ' + file_mat)
+
+        return file_warp2d, file_warp2d_inv
+
+    # if an exception occurs with ants, take the last value for the transformation
+    # TODO: DO WE NEED TO DO THAT??? (julien 2016-03-01)
+    except Exception, e:
+        sct.printv('ERROR: Exception occurred.\n' + str(e), 1, 'error')
+
+
 def numerotation(nb):
     """Indexation of number for matching fslsplit's index.
 
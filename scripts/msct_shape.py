@@ -140,6 +140,120 @@ def properties2d(image, resolution=None, verbose=1):
     return sc_properties
 
 
+# properties computed by properties2d_batch from the moments of the patches (other properties use regionprops)
+properties_batch = ['area', 'centroid', 'eccentricity', 'equivalent_diameter', 'inertia_tensor', 'inertia_tensor_eigvals',
+                    'major_axis_length', 'minor_axis_length', 'orientation', 'ratio_minor_major', 'symmetry']
+
+
+def properties2d_batch(images, resolution=None, property_list=None, verbose=1):
+    """
+    Same as properties2d, for a stack of 2D images (first axis), using array operations on the whole stack.
+    :param images: array (nb_images, nx, ny)
+    :param resolution: [px, py]
+    :param property_list: properties to compute. None: properties_batch. Properties that are not in properties_batch
+    are computed with skimage.measure.regionprops on the spinal cord region of each image.
+    :return: list of dictionaries (None if the image is empty)
+    """
+    from scipy.ndimage import label, map_coordinates
+    if property_list is None:
+        property_list = properties_batch
+    nb_images = images.shape[0]
+    if nb_images == 0:
+        return []
+    # connected regions (8-connectivity within each image, images are not connected to each other)
+    structure = np.zeros((3, 3, 3), dtype=int)
+    structure[1] = 1
+    label_img, nb_labels = label(images != 0, structure=structure)
+    # spinal cord region = largest region of each image
+    areas = np.bincount(label_img.ravel(), minlength=nb_labels + 1)
+    image_of_label = np.zeros(nb_labels + 1, dtype=int)
+    image_of_label[label_img.ravel()] = np.repeat(np.arange(nb_images), images[0].size)
+    sc_label = np.zeros(nb_images, dtype=int)
+    if nb_labels:
+        labels_sorted = np.lexsort((areas[1:], image_of_label[1:])) + 1
+        image_of_label_sorted = image_of_label[labels_sorted]
+        is_largest = np.append(image_of_label_sorted[1:] != image_of_label_sorted[:-1], True)
+        sc_label[image_of_label_sorted[is_largest]] = labels_sorted[is_largest]
+    mask = label_img == sc_label[:, np.newaxis, np.newaxis]
+    mask[sc_label == 0] = False
+    # moments, in the (row, col) coordinates of the transposed image (as in properties2d)
+    col, row = np.indices(images.shape[1:], dtype=float)
+    area = mask.sum(axis=(1, 2)).astype(float)
+    area_nonzero = np.maximum(area, 1)
+    centroid_row = np.sum(mask * row, axis=(1, 2)) / area_nonzero
+    centroid_col = np.sum(mask * col, axis=(1, 2)) / area_nonzero
+    row_c = row - centroid_row[:, np.newaxis, np.newaxis]
+    col_c = col - centroid_col[:, np.newaxis, np.newaxis]
+    # inertia tensor [[a, b], [b, c]] and its eigenvalues (same definitions as skimage.measure.regionprops)
+    a = np.sum(mask * col_c ** 2, axis=(1, 2)) / area_nonzero
+    b = - np.sum(mask * row_c * col_c, axis=(1, 2)) / area_nonzero
+    c = np.sum(mask * row_c ** 2, axis=(1, 2)) / area_nonzero
+    l1 = (a + c) / 2 + np.sqrt(4 * b ** 2 + (a - c) ** 2) / 2
+    l2 = np.maximum((a + c) / 2 - np.sqrt(4 * b ** 2 + (a - c) ** 2) / 2, 0)
+    major_axis_length = 4 * np.sqrt(l1)
+    minor_axis_length = 4 * np.sqrt(l2)
+    eccentricity = np.sqrt(1 - l2 / np.where(l1 == 0, 1, l1)) * (l1 != 0)
+    orientation = np.where(a - c == 0, np.where(-b > 0, -math.pi / 4.0, math.pi / 4.0), -0.5 * np.arctan2(-2 * b, a - c))
+    equivalent_diameter = np.sqrt(4 * area / math.pi)
+    ratio_minor_major = minor_axis_length / np.where(major_axis_length == 0, np.inf, major_axis_length)
+
+    if resolution is not None:
+        factor_area = resolution[0] * resolution[1]
+        # TODO: compute length depending on resolution. Here it assume the patch has the same X and Y resolution
+        factor_length = resolution[0]
+        size_grid = 8.0 / resolution[0] * np.ones(nb_images)  # assuming the maximum spinal cord radius is 8 mm
+    else:
+        factor_area, factor_length = 1.0, 1.0
+        size_grid = (2.4 * major_axis_length).astype(int)
+
+    # symmetry: resample each image along the orientation of the spinal cord, then compare left and right sides
+    symmetry = np.zeros(nb_images)
+    if 'symmetry' in property_list:
+        resolution_grid = 0.25
+        for size in np.unique(size_grid):
+            ind_images = np.where((size_grid == size) & (sc_label != 0))[0]
+            if len(ind_images) == 0:
+                continue
+            x_grid, y_grid = np.mgrid[-size:size:resolution_grid, -size:size:resolution_grid]
+            cos_o, sin_o = np.cos(orientation[ind_images]), np.sin(orientation[ind_images])
+            coordinates_x = centroid_col[ind_images, np.newaxis] + cos_o[:, np.newaxis] * x_grid.ravel()
+            coordinates_y = centroid_row[ind_images, np.newaxis] - sin_o[:, np.newaxis] * y_grid.ravel()
+            coordinates_z = np.tile(np.arange(len(ind_images))[:, np.newaxis], (1, x_grid.size))
+            square = map_coordinates(images[ind_images], np.array([coordinates_z.ravel(), coordinates_x.ravel(), coordinates_y.ravel()]), output=np.float32, order=0, mode='constant', cval=0.0)
+            square_image = square.reshape((len(ind_images), len(x_grid), len(x_grid)))
+            size_half = square_image.shape[2] / 2
+            left_image = square_image[:, :, :size_half]
+            right_image = square_image[:, :, size_half:][:, :, ::-1]
+            symmetry[ind_images] = np.sum(left_image * (right_image == 1), axis=(1, 2)) * 2.0 / (np.sum(left_image, axis=(1, 2)) + np.sum(right_image, axis=(1, 2)))
+
+    list_properties = []
+    for i in range(nb_images):
+        if sc_label[i] == 0:
+            list_properties.append(None)
+            continue
+        sc_properties = {'area': area[i] * factor_area,
+                         'centroid': (centroid_row[i], centroid_col[i]),
+                         'eccentricity': eccentricity[i],
+                         'equivalent_diameter': equivalent_diameter[i] * factor_length,
+                         'inertia_tensor': np.array([[a[i], b[i]], [b[i], c[i]]]),
+                         'inertia_tensor_eigvals': (l1[i], l2[i]),
+                         'minor_axis_length': minor_axis_length[i] * factor_length,
+                         'major_axis_length': major_axis_length[i] * factor_length,
+                         'orientation': orientation[i] * 180.0 / math.pi,
+                         'ratio_minor_major': ratio_minor_major[i],
+                         'symmetry': symmetry[i]
+                         }
+        # other properties (e.g., solidity) are computed on the spinal cord region only
+        property_others = [property_name for property_name in property_list if property_name not in sc_properties]
+        if property_others:
+            sc_region = measure.regionprops(np.transpose(mask[i]).astype(int))[0]
+            for property_name in property_others:
+                sc_properties[property_name] = getattr(sc_region, property_name)
+        list_properties.append(sc_properties)
+
+    return list_properties
+
+
 def average_properties(fname_seg_images, property_list, fname_disks_images, group_images, verbose=1):
     if len(fname_seg_images) != len(fname_disks_images):
         raise ValueError('ERROR: each segmentation image must be accompagnied by a disk image')
@@ -270,31 +384,36 @@ def compute_properties_along_centerline(fname_seg_image, property_list, fname_di
         centerline.compute_vertebral_distribution(coord_physical)
 
     sct.printv('Computing spinal cord shape along the spinal cord...')
-    timer_properties = sct.Timer(number_of_iteration=centerline.number_of_points)
+    # patches are extracted and processed by chunks of points (bounded memory)
+    size_chunk = 100
+    list_chunks = [range(i, min(i + size_chunk, centerline.number_of_points)) for i in range(0, centerline.number_of_points, size_chunk)]
+    timer_properties = sct.Timer(number_of_iteration=len(list_chunks))
     timer_properties.start()
     # Extracting patches perpendicular to the spinal cord and computing spinal cord shape
-    for index in range(centerline.number_of_points):
+    from scipy.ndimage import grey_dilation
+    # footprint of skimage.morphology.dilation (cross), applied on each patch
+    footprint = np.zeros((3, 3, 3), dtype=bool)
+    footprint[1] = [[0, 1, 0], [1, 1, 1], [0, 1, 0]]
+    for indexes in list_chunks:
         value_out = -5.0
-        current_patch = centerline.extract_perpendicular_square(image, index, resolution=resolution, interpolation_mode=interpolation_mode, border='constant', cval=value_out)
+        patches = centerline.extract_perpendicular_square_batch(image, indexes, resolution=resolution, interpolation_mode=interpolation_mode, border='constant', cval=value_out)
 
         # check for pixels close to the spinal cord segmentation that are out of the image
-        from skimage.morphology import dilation
-        patch_zero = np.copy(current_patch)
-        patch_zero[patch_zero == value_out] = 0.0
-        patch_borders = dilation(patch_zero) - patch_zero
-
-        if np.count_nonzero(patch_borders + current_patch == value_out + 1.0) != 0:
-            continue
-
-        sc_properties = properties2d(patch_zero, [resolution, resolution])
-        if sc_properties is not None:
-            properties['incremental_length'].append(centerline.incremental_length[index])
-            if fname_disks_image is not None:
-                properties['distance_from_C1'].append(centerline.dist_points[index])
-                properties['vertebral_level'].append(centerline.l_points[index])
-            properties['z_slice'].append(image.transfo_phys2pix([centerline.points[index]])[0][2])
-            for property_name in property_list_local:
-                properties[property_name].append(sc_properties[property_name])
+        patches_zero = np.copy(patches)
+        patches_zero[patches_zero == value_out] = 0.0
+        patches_borders = grey_dilation(patches_zero, footprint=footprint) - patches_zero
+        is_out = np.any(patches_borders + patches == value_out + 1.0, axis=(1, 2))
+
+        list_sc_properties = properties2d_batch(patches_zero[~is_out], [resolution, resolution], property_list_local)
+        for index, sc_properties in zip(np.array(indexes)[~is_out], list_sc_properties):
+            if sc_properties is not None:
+                properties['incremental_length'].append(centerline.incremental_length[index])
+                if fname_disks_image is not None:
+                    properties['distance_from_C1'].append(centerline.dist_points[index])
+                    properties['vertebral_level'].append(centerline.l_points[index])
+                properties['z_slice'].append(image.transfo_phys2pix([centerline.points[index]])[0][2])
+                for property_name in property_list_local:
+                    properties[property_name].append(sc_properties[property_name])
 
         timer_properties.add_iteration()
     timer_properties.stop()
@@ -16,7 +16,7 @@
 
 from __future__ import division
 from math import sqrt
-from numpy import dot, cross, array, dstack, einsum, tile, multiply, stack, rollaxis, zeros
+from numpy import dot, cross, array, einsum, tile, multiply, stack, rollaxis, zeros
 from numpy.linalg import norm, inv
 import numpy as np
 
@@ -132,43 +132,45 @@ class Centerline:
     """
 
     def __init__(self, points_x, points_y, points_z, deriv_x, deriv_y, deriv_z):
-        self.derivatives = []
-        self.length = 0.0
-        self.progressive_length = [0.0]
-        self.progressive_length_inverse = [0.0]
-        self.incremental_length = [0.0]
-        self.incremental_length_inverse = [0.0]
-
-        self.points = array(zip(points_x, points_y, points_z))
-        self.derivatives = array(zip(deriv_x, deriv_y, deriv_z))
+        self.points = stack([points_x, points_y, points_z], axis=1).astype(float)
+        self.derivatives = stack([deriv_x, deriv_y, deriv_z], axis=1).astype(float)
         self.number_of_points = len(self.points)
 
         self.compute_length(points_x, points_y, points_z)
-
-        self.coordinate_system = [self.compute_coordinate_system(index) for index in range(0, self.number_of_points)]
-        self.plans_parameters = [self.get_plan_parameters(index) for index in range(0, self.number_of_points)]
-
-        self.matrices = stack([item[4] for item in self.coordinate_system])
-        self.inverse_matrices = stack([item[5] for item in self.coordinate_system])
-        self.offset_plans = array([item[3] for item in self.plans_parameters])
+        self.compute_coordinate_systems()
 
         from scipy.spatial import cKDTree
-        self.tree_points = cKDTree(dstack([points_x, points_y, points_z])[0])
+        self.tree_points = cKDTree(self.points)
 
     def compute_length(self, points_x, points_y, points_z):
-        for i in range(0, self.number_of_points - 1):
-            distance = sqrt((points_x[i] - points_x[i + 1]) ** 2 +
-                            (points_y[i] - points_y[i + 1]) ** 2 +
-                            (points_z[i] - points_z[i + 1]) ** 2)
-            self.length += distance
-            self.progressive_length.append(distance)
-            self.incremental_length.append(self.incremental_length[-1] + distance)
-        for i in range(self.number_of_points - 1, 0, -1):
-            distance = sqrt((points_x[i] - points_x[i - 1]) ** 2 +
-                            (points_y[i] - points_y[i - 1]) ** 2 +
-                            (points_z[i] - points_z[i - 1]) ** 2)
-            self.progressive_length_inverse.append(distance)
-            self.incremental_length_inverse.append(self.incremental_length_inverse[-1] + distance)
+        """
+        Compute the distances between consecutive points (progressive_length), from the first point
+        (incremental_length) and from the last point (*_inverse), and the length of the centerline.
+        """
+        distances = np.sqrt(np.sum(np.diff(self.points, axis=0) ** 2, axis=1))
+        self.progressive_length = np.concatenate([[0.0], distances])
+        self.progressive_length_inverse = np.concatenate([[0.0], distances[::-1]])
+        self.incremental_length = np.cumsum(self.progressive_length)
+        self.incremental_length_inverse = np.cumsum(self.progressive_length_inverse)
+        self.length = float(self.incremental_length[-1])
+
+    def compute_coordinate_systems(self):
+        """
+        Compute the coordinate reference system of the planes at all points at once (see compute_coordinate_system)
+        and the parameters of the planes (see get_plan_parameters). The derivatives are normalized.
+        """
+        self.derivatives /= norm(self.derivatives, axis=1)[:, np.newaxis]
+        z_prime_axis = self.derivatives
+        y_prime_axis = array([0, 1, 0]) - z_prime_axis[:, 1:2] * z_prime_axis
+        y_prime_axis /= norm(y_prime_axis, axis=1)[:, np.newaxis]
+        x_prime_axis = cross(y_prime_axis, z_prime_axis)
+        x_prime_axis /= norm(x_prime_axis, axis=1)[:, np.newaxis]
+
+        # the axes are the columns of the matrices
+        self.matrices = stack([x_prime_axis, y_prime_axis, z_prime_axis], axis=2)
+        self.inverse_matrices = inv(self.matrices)
+        self.offset_plans = - einsum('ij,ij->i', self.derivatives, self.points)
+        self.plans_parameters = np.c_[self.derivatives, self.offset_plans]
 
     def find_nearest_index(self, coord):
         """
@@ -205,10 +207,7 @@ class Centerline:
         :return: List of parameters [a, b, c, d], corresponding to plane parametric equation a*x + b*y + c*z + d = 0
         """
         if 0 <= index < self.number_of_points:
-            a = self.derivatives[index][0]
-            b = self.derivatives[index][1]
-            c = self.derivatives[index][2]
-            d = - (a * self.points[index][0] + b * self.points[index][1] + c * self.points[index][2])
+            a, b, c, d = self.plans_parameters[index]
         else:
             raise IndexError('ERROR in msct_types.Centerline.get_plan_parameters: index (' + str(index) + ') should be '
                              'within [' + str(0) + ', ' + str(self.number_of_points) + '[.')
@@ -248,7 +247,7 @@ class Centerline:
         """
         if index is None:
             index = self.find_nearest_index(coord)
-        plane_params = self.plans_parameters[index]
+        plane_params = self.get_plan_parameters(index)
         distance = self.get_distance_from_plane(coord, index, plane_params=plane_params)
 
         return index, plane_params, distance
@@ -308,8 +307,7 @@ class Centerline:
         :return:
         """
         if 0 <= index < self.number_of_points:
-            origin, x_prime_axis, y_prime_axis, z_prime_axis, matrix_base, inverse_matrix = self.coordinate_system[index]
-            return inverse_matrix.dot(coord - origin)
+            return self.inverse_matrices[index].dot(coord - self.points[index])
         else:
             raise IndexError('ERROR in msct_types.Centerline.compute_coordinate_system: index (' + str(index) + ') '
                              'should be within [' + str(0) + ', ' + str(self.number_of_points) + '[.')
@@ -389,8 +387,7 @@ class Centerline:
         index_disk_inv = sorted(index_disk_inv, key=itemgetter(0))
 
         progress_length = zeros(self.number_of_points)
-        for i in range(self.number_of_points - 1):
-            progress_length[i + 1] = progress_length[i] + self.progressive_length[i]
+        progress_length[1:] = np.cumsum(self.progressive_length[:-1])
 
         label_reference = 'C1'
         if 'C1' not in self.index_disk:
@@ -448,10 +445,27 @@ class Centerline:
         x_grid, y_grid, z_grid = np.mgrid[-size:size:resolution, -size:size:resolution, 0:1]
         coordinates_grid = np.array(zip(x_grid.ravel(), y_grid.ravel(), z_grid.ravel()))
         coordinates_phys = self.get_inverse_plans_coordinates(coordinates_grid, np.array([index] * len(coordinates_grid)))
-        coordinates_im = np.array(image.transfo_phys2continuouspix(coordinates_phys))
+        coordinates_im = image.transfo_phys2continuouspix_array(coordinates_phys)
         square = image.get_values(coordinates_im.transpose(), interpolation_mode=interpolation_mode, border=border, cval=cval)
         return square.reshape((len(x_grid), len(x_grid)))
 
+    def extract_perpendicular_square_batch(self, image, indexes=None, size=20, resolution=0.5, interpolation_mode=0, border='constant', cval=0.0):
+        """
+        Same as extract_perpendicular_square, for several points of the centerline at once (single interpolation).
+        :param indexes: indexes of the centerline points. None: all points
+        :return: array (len(indexes), n, n) of patches
+        """
+        if indexes is None:
+            indexes = np.arange(self.number_of_points)
+        x_grid, y_grid = np.mgrid[-size:size:resolution, -size:size:resolution]
+        coordinates_grid = np.array([x_grid.ravel(), y_grid.ravel(), np.zeros(x_grid.size)])
+        # coordinates of the grid in each plane, in physical space: (len(indexes), grid size, 3)
+        coordinates_phys = einsum('pmn,ng->pgm', self.matrices[indexes], coordinates_grid) + self.points[indexes][:, np.newaxis, :]
+        # convert to continuous pixel coordinates
+        coordinates_im = image.transfo_phys2continuouspix_array(coordinates_phys.reshape(-1, 3))
+        square = image.get_values(coordinates_im.transpose(), interpolation_mode=interpolation_mode, border=border, cval=cval)
+        return square.reshape((len(indexes), len(x_grid), len(x_grid)))
+
     def save_centerline(self, image, fname_output):
         labels_regions = {'PONS': 50, 'MO': 51,
                           'C1': 1, 'C2': 2, 'C3': 3, 'C4': 4, 'C5': 5, 'C6': 6, 'C7': 7,
@@ -464,46 +478,46 @@ class Centerline:
         image_output.data = image_output.data.astype(np.float32)
         image_output.data *= 0.0
 
+        coordinates_pix = image.transfo_phys2pix_array(self.points)
         for i in range(self.number_of_points):
             current_label = self.l_points[i]
-            current_coord = self.points[i]
             current_dist_rel = self.dist_points_rel[i]
             if current_label in labels_regions:
-                coord_pix = image.transfo_phys2pix([current_coord])[0]
+                coord_pix = coordinates_pix[i]
                 image_output.data[int(coord_pix[0]), int(coord_pix[1]), int(coord_pix[2])] = float(labels_regions[current_label]) + current_dist_rel
 
         image_output.setFileName(fname_output)
         image_output.save(type='float32')
 
     def average_coordinates_over_slices(self, image):
-        # extracting points information for each coordinates
-        P_x = np.array([point[0] for point in self.points])
-        P_y = np.array([point[1] for point in self.points])
-        P_z = np.array([point[2] for point in self.points])
-        P_z_vox = np.array([coord[2] for coord in image.transfo_phys2pix(self.points)])
-        P_x_d = np.array([deriv[0] for deriv in self.derivatives])
-        P_y_d = np.array([deriv[1] for deriv in self.derivatives])
-        P_z_d = np.array([deriv[2] for deriv in self.derivatives])
-
-        P_z_vox = np.array([int(np.round(P_z_vox[i])) for i in range(0, len(P_z_vox))])
-        # not perfect but works (if "enough" points), in order to deal with missing z slices
-        for i in range(min(P_z_vox), max(P_z_vox) + 1, 1):
-            if i not in P_z_vox:
-                P_x_temp = np.insert(P_x, np.where(P_z_vox == i - 1)[-1][-1] + 1, (P_x[np.where(P_z_vox == i - 1)[-1][-1]] + P_x[np.where(P_z_vox == i - 1)[-1][-1] + 1]) / 2)
-                P_y_temp = np.insert(P_y, np.where(P_z_vox == i - 1)[-1][-1] + 1, (P_y[np.where(P_z_vox == i - 1)[-1][-1]] + P_y[np.where(P_z_vox == i - 1)[-1][-1] + 1]) / 2)
-                P_z_temp = np.insert(P_z, np.where(P_z_vox == i - 1)[-1][-1] + 1, (P_z[np.where(P_z_vox == i - 1)[-1][-1]] + P_z[np.where(P_z_vox == i - 1)[-1][-1] + 1]) / 2)
-                P_x_d_temp = np.insert(P_x_d, np.where(P_z_vox == i - 1)[-1][-1] + 1, (P_x_d[np.where(P_z_vox == i - 1)[-1][-1]] + P_x_d[np.where(P_z_vox == i - 1)[-1][-1] + 1]) / 2)
-                P_y_d_temp = np.insert(P_y_d, np.where(P_z_vox == i - 1)[-1][-1] + 1, (P_y_d[np.where(P_z_vox == i - 1)[-1][-1]] + P_y_d[np.where(P_z_vox == i - 1)[-1][-1] + 1]) / 2)
-                P_z_d_temp = np.insert(P_z_d, np.where(P_z_vox == i - 1)[-1][-1] + 1, (P_z_d[np.where(P_z_vox == i - 1)[-1][-1]] + P_z_d[np.where(P_z_vox == i - 1)[-1][-1] + 1]) / 2)
-                P_x, P_y, P_z, P_x_d, P_y_d, P_z_d = P_x_temp, P_y_temp, P_z_temp, P_x_d_temp, P_y_d_temp, P_z_d_temp
-
-        coord_mean = np.array([[np.mean(P_x[P_z_vox == i]), np.mean(P_y[P_z_vox == i]), np.mean(P_z[P_z_vox == i])] for i in range(min(P_z_vox), max(P_z_vox) + 1, 1)])
-        x_centerline_fit = coord_mean[:, :][:, 0]
-        y_centerline_fit = coord_mean[:, :][:, 1]
-        coord_mean_d = np.array([[np.mean(P_x_d[P_z_vox == i]), np.mean(P_y_d[P_z_vox == i]), np.mean(P_z_d[P_z_vox == i])] for i in range(min(P_z_vox), max(P_z_vox) + 1, 1)])
-        z_centerline = coord_mean[:, :][:, 2]
-        x_centerline_deriv = coord_mean_d[:, :][:, 0]
-        y_centerline_deriv = coord_mean_d[:, :][:, 1]
-        z_centerline_deriv = coord_mean_d[:, :][:, 2]
+        """
+        Average the points and derivatives of the centerline in each axial slice of an image
+        :param image: Image
+        :return: x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv
+        """
+        # slice of each point, from the lowest slice
+        P_z_vox = image.transfo_phys2pix_array(self.points)[:, 2]
+        index_slice = P_z_vox - P_z_vox.min()
+        nb_slices = index_slice.max() + 1
+        values = np.c_[self.points, self.derivatives]
+
+        # average the points of each slice
+        count = np.bincount(index_slice, minlength=nb_slices)
+        is_missing = count == 0
+        sums = np.array([np.bincount(index_slice, weights=values[:, i], minlength=nb_slices) for i in range(6)]).transpose()
+        coord_mean = np.zeros((nb_slices, 6))
+        coord_mean[~is_missing] = sums[~is_missing] / count[~is_missing, np.newaxis]
+
+        # not perfect but works (if "enough" points), in order to deal with missing z slices: average of the last
+        # point of the previous slice and of the next point
+        if is_missing.any():
+            index_last = np.zeros(nb_slices, dtype=int)
+            np.maximum.at(index_last, index_slice, np.arange(self.number_of_points))
+            index_previous = np.maximum.accumulate(index_last)[np.flatnonzero(is_missing) - 1]
+            index_next = np.minimum(index_previous + 1, self.number_of_points - 1)
+            coord_mean[is_missing] = (values[index_previous] + values[index_next]) / 2
+
+        x_centerline_fit, y_centerline_fit, z_centerline = coord_mean[:, 0], coord_mean[:, 1], coord_mean[:, 2]
+        x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = coord_mean[:, 3], coord_mean[:, 4], coord_mean[:, 5]
 
         return x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv
@@ -15,8 +15,6 @@
 # TODO: interpolation methods
 
 import sys
-import os
-import time
 from msct_parser import Parser
 import sct_utils as sct
 from sct_crop_image import ImageCropper
@@ -25,7 +23,6 @@ from sct_crop_image import ImageCropper
 class Param:
     def __init__(self):
         self.verbose = '1'
-        self.remove_tmp_files = '1'
 
 
 # PARSER
@@ -74,10 +71,11 @@ def get_parser():
                       example=['nn', 'linear', 'spline'])
     parser.add_option(name="-r",
                       type_value="multiple_choice",
-                      description="""Remove temporary files.""",
+                      description="""Remove temporary files. Ignored: 4D data is transformed in one pass, without splitting the volumes.""",
                       mandatory=False,
                       default_value='1',
-                      example=['0', '1'])
+                      example=['0', '1'],
+                      deprecated=True)
     parser.add_option(name="-v",
                       type_value="multiple_choice",
                       description="""Verbose.""",
@@ -90,6 +88,8 @@ def get_parser():
 
 class Transform:
     def __init__(self, input_filename, warp, fname_dest, output_filename='', verbose=0, crop=0, interp='spline', remove_temp_files=1, debug=0):
+        # remove_temp_files is ignored: 4D data is transformed by antsApplyTransforms in one pass on disk (time-series
+        # mode), directly into the output file, so the volumes are no longer split into temporary files
         self.input_filename = input_filename
         if isinstance(warp, str):
             self.warp_input = list([warp])
@@ -100,7 +100,6 @@ class Transform:
         self.interp = interp
         self.crop = crop
         self.verbose = verbose
-        self.remove_temp_files = remove_temp_files
         self.debug = debug
 
     def apply(self):
@@ -110,7 +109,6 @@ class Transform:
         fname_out = self.output_filename  # output
         fname_dest = self.fname_dest  # destination image (fix)
         verbose = self.verbose
-        remove_temp_files = self.remove_temp_files
         crop_reference = self.crop  # if = 1, put 0 everywhere around warping field, if = 2, real crop
 
         interp = sct.get_interpolation('isct_antsApplyTransforms', self.interp)
@@ -169,60 +167,18 @@ class Transform:
             # print 'HOLA1'
             sct.run('isct_antsApplyTransforms -d 3 -i ' + fname_src + ' -o ' + fname_out + ' -t ' + ' '.join(fname_warp_list_invert) + ' -r ' + fname_dest + interp, verbose)
 
-        # if 4d, loop across the T dimension
+        # if 4d, apply the transformation to all volumes at once (time-series mode of antsApplyTransforms, so that the
+        # warping fields are only read and composed once)
         else:
-            # create temporary folder
-            sct.printv('\nCreate temporary folder...', verbose)
-            path_tmp = sct.slash_at_the_end('tmp.' + time.strftime("%y%m%d%H%M%S"), 1)
-            # sct.run('mkdir '+path_tmp, verbose)
-            sct.run('mkdir ' + path_tmp, verbose)
-
-            # convert to nifti into temp folder
-            sct.printv('\nCopying input data to tmp folder and convert to nii...', verbose)
-            from sct_convert import convert
-            convert(fname_src, path_tmp + 'data.nii')
-            sct.run('cp ' + fname_dest + ' ' + path_tmp + file_dest + ext_dest)
-            fname_warp_list_tmp = []
-            for fname_warp in fname_warp_list:
-                path_warp, file_warp, ext_warp = sct.extract_fname(fname_warp)
-                sct.run('cp ' + fname_warp + ' ' + path_tmp + file_warp + ext_warp)
-                fname_warp_list_tmp.append(file_warp + ext_warp)
-            fname_warp_list_invert_tmp = fname_warp_list_tmp[::-1]
-
-            os.chdir(path_tmp)
-            # split along T dimension
-            sct.printv('\nSplit along T dimension...', verbose)
-            from sct_image import split_data
-            im_dat = Image('data.nii')
-            im_header = im_dat.hdr
-            data_split_list = split_data(im_dat, 3)
-            for im in data_split_list:
-                im.save()
-
-            # apply transfo
-            sct.printv('\nApply transformation to each 3D volume...', verbose)
-            for it in range(nt):
-                file_data_split = 'data_T' + str(it).zfill(4) + '.nii'
-                file_data_split_reg = 'data_reg_T' + str(it).zfill(4) + '.nii'
-                status, output = sct.run('isct_antsApplyTransforms -d 3 -i ' + file_data_split + ' -o ' + file_data_split_reg + ' -t ' + ' '.join(fname_warp_list_invert_tmp) + ' -r ' + file_dest + ext_dest + interp, verbose)
-
-            # Merge files back
-            sct.printv('\nMerge file back...', verbose)
-            from sct_image import concat_data
-            import glob
-            path_out, name_out, ext_out = sct.extract_fname(fname_out)
-            # im_list = [Image(file_name) for file_name in glob.glob('data_reg_T*.nii')]
-            # concat_data use to take a list of image in input, now takes a list of file names to open the files one by one (see issue #715)
-            fname_list = glob.glob('data_reg_T*.nii')
-            im_out = concat_data(fname_list, 3, im_header['pixdim'])
-            im_out.setFileName(name_out + ext_out)
-            im_out.save()
-            os.chdir('..')
-            sct.generate_output_file(path_tmp + name_out + ext_out, fname_out)
-            # Delete temporary folder if specified
-            if int(remove_temp_files):
-                sct.printv('\nRemove temporary files...', verbose)
-                sct.run('rm -rf ' + path_tmp, verbose, error_exit='warning')
+            sct.printv('\nApply transformation to all volumes...', verbose)
+            sct.run('isct_antsApplyTransforms -d 3 -e 3 -i ' + fname_src + ' -o ' + fname_out + ' -t ' + ' '.join(fname_warp_list_invert) + ' -r ' + fname_dest + interp, verbose)
+
+            # keep the temporal resolution of the input
+            im_out = Image(fname_out, mmap=True)
+            zooms = im_out.hdr.get_zooms()
+            if len(zooms) == 4 and zooms[3] != pt:
+                im_out.hdr.set_zooms(zooms[:3] + (pt,))
+                im_out.save(squeeze_data=False, verbose=0)
 
         # 2. crop the resulting image using dimensions from the warping field
         warping_field = fname_warp_list_invert[-1]
@@ -241,6 +197,59 @@ class Transform:
         sct.printv('fslview ' + fname_dest + ' ' + fname_out + ' &\n', verbose, 'info')
 
 
+def get_sampling_coordinates(fname_warp, im_dest):
+    """
+    Compute the physical coordinates where a source image needs to be sampled to be warped onto the grid of the
+    destination image. These coordinates only depend on the warping field and the destination image, so they can be
+    computed once and used to warp several images (see resample_on_coordinates).
+    :param fname_warp: warping field (ITK displacement field, e.g. warp_template2anat.nii.gz)
+    :param im_dest: destination Image
+    :return: array of size (3, nx, ny, nz) containing the RAS coordinates (in mm)
+    """
+    import numpy as np
+    from msct_image import Image
+    from scipy.ndimage import map_coordinates
+
+    # the warping field is memory-mapped (compressed files are uncompressed once) instead of being loaded in memory
+    im_warp = Image(fname_warp, mmap=True, verbose=0)
+    data_warp = im_warp.data
+    data_warp = data_warp.reshape(data_warp.shape[:3] + (3,))
+    nx, ny, nz = im_dest.data.shape[:3]
+
+    # physical coordinates of the destination grid
+    affine_dest = im_dest.hdr.get_best_affine()
+    coord_dest = np.dot(affine_dest[:3, :3], np.mgrid[0:nx, 0:ny, 0:nz].reshape(3, -1)) + affine_dest[:3, 3:]
+
+    # displacement at each point of the destination grid
+    affine_warp = im_warp.im_file.affine
+    if data_warp.shape[:3] == (nx, ny, nz) and np.allclose(affine_warp, affine_dest):
+        displacement = np.array(data_warp.reshape(-1, 3).T, dtype=np.float64)
+    else:
+        affine_warp_inv = np.linalg.inv(affine_warp)
+        coord_warp = np.dot(affine_warp_inv[:3, :3], coord_dest) + affine_warp_inv[:3, 3:]
+        displacement = np.array([map_coordinates(data_warp[..., i], coord_warp, order=1) for i in range(3)], dtype=np.float64)
+    # ITK displacements are expressed in LPS coordinates
+    displacement[:2] *= -1
+
+    return (coord_dest + displacement).reshape(3, nx, ny, nz)
+
+
+def resample_on_coordinates(im_src, coord_phys, interp='linear'):
+    """
+    Sample a 3D image at physical coordinates (see get_sampling_coordinates).
+    :param im_src: source Image
+    :param coord_phys: array of size (3, nx, ny, nz) containing RAS coordinates
+    :param interp: {nn, linear, spline}
+    :return: array of size (nx, ny, nz)
+    """
+    import numpy as np
+    shape = coord_phys.shape[1:]
+    affine_src_inv = np.linalg.inv(im_src.hdr.get_best_affine())
+    coord_pix = np.dot(affine_src_inv[:3, :3], coord_phys.reshape(3, -1)) + affine_src_inv[:3, 3:]
+    order = {'nn': 0, 'linear': 1, 'spline': 3}[interp]
+    return im_src.get_values(coord_pix, interpolation_mode=order).reshape(shape)
+
+
 # MAIN
 # ==========================================================================================
 def main(args=None):
@@ -264,8 +273,6 @@ def main(args=None):
         transform.output_filename = arguments["-o"]
     if "-x" in arguments:
         transform.interp = arguments["-x"]
-    if "-r" in arguments:
-        transform.remove_temp_files = int(arguments["-r"])
     if "-v" in arguments:
         transform.verbose = int(arguments["-v"])
 
@@ -31,6 +31,7 @@ class Param:
     def __init__(self):
         self.debug = 0
         self.thinning = True
+        self.hausdorff_3d = False
         self.verbose = 1
 
 
@@ -52,110 +53,92 @@ class Thinning:
                 print '-- changing orientation ...'
                 self.image = set_orientation(self.image, 'IRP')
 
-            thinned_data = np.asarray([self.zhang_suen(im_slice) for im_slice in self.image.data])
+            # all slices are thinned at once (the first axis is the slice axis)
+            thinned_data = self.zhang_suen(self.image.data)
 
             self.thinned_image = Image(param=thinned_data, absolutepath=self.image.path + self.image.file_name + '_thinned' + self.image.ext, hdr=self.image.hdr)
 
     # ------------------------------------------------------------------------------------------------------------------
-    def get_neighbours(self, x, y, image):
+    def get_neighbours(self, image):
         """
-        Return 8-neighbours of image point P1(x,y), in a clockwise order
-        code from https://github.com/linbojin/Skeletonization-by-Zhang-Suen-Thinning-Algorithm
-        :param x:
-        :param y:
-        :param image:
-        :return:
+        Return 8-neighbours of all image points P1(x,y), in a clockwise order, encoded as a 8-bit code:
+        code = P2 + 2*P3 + 4*P4 + ... + 128*P9.
+        As in https://github.com/linbojin/Skeletonization-by-Zhang-Suen-Thinning-Algorithm, x-1 and y-1 wrap around
+        the edge of the image.
+        :param image: 2D binary image, or stack of 2D images along the first axis
+        :return: array of codes (same shape as image)
         """
-        # now = time.time()
-        x_1, y_1, x1, y1 = x - 1, y - 1, x + 1, y + 1
-        neighbours = [image[x_1][y], image[x_1][y1], image[x][y1], image[x1][y1],     # P2,P3,P4,P5
-                      image[x1][y], image[x1][y_1], image[x][y_1], image[x_1][y_1]]    # P6,P7,P8,P9
-        # t = time.time() - now
-        # print 't neighbours: ', t
-        return neighbours
+        ax_x, ax_y = image.ndim - 2, image.ndim - 1
+        # neighbour (dx, dy) of P1(x,y) is image[x+dx][y+dy]
+        shifts = [(-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1)]  # P2,P3,P4,P5,P6,P7,P8,P9
+        code = np.zeros(image.shape, dtype=np.uint8)
+        for bit, (dx, dy) in enumerate(shifts):
+            code |= np.roll(np.roll(image, -dx, axis=ax_x), -dy, axis=ax_y).astype(np.uint8) << bit
+        return code
 
     # ------------------------------------------------------------------------------------------------------------------
-    def transitions(self, neighbours):
+    def get_lookup_tables(self):
         """
-        No. of 0,1 patterns (transitions from 0 to 1) in the ordered sequence
-        code from https://github.com/linbojin/Skeletonization-by-Zhang-Suen-Thinning-Algorithm
-        :param neighbours:
-        :return:
+        Zhang-Suen conditions 1 to 4 for each of the 256 neighbourhood codes (see get_neighbours)
+        :return: lut_step1, lut_step2: boolean arrays of size 256, True if the point must be removed
         """
-        # now = time.time()
-        n = neighbours + neighbours[0:1]      # P2, P3, ... , P8, P9, P2
-        s = np.sum((n1, n2) == (0, 1) for n1, n2 in zip(n, n[1:]))  # (P2,P3), (P3,P4), ... , (P8,P9), (P9,P2)
-        # t = time.time() - now
-        # print 't transitions sum: ', t
-        return s
+        lut_step1 = np.zeros(256, dtype=bool)
+        lut_step2 = np.zeros(256, dtype=bool)
+        for code in range(256):
+            P2, P3, P4, P5, P6, P7, P8, P9 = n = [(code >> bit) & 1 for bit in range(8)]
+            # No. of 0,1 patterns (transitions from 0 to 1) in the ordered sequence P2, P3, ... , P8, P9, P2
+            transitions = sum((n1, n2) == (0, 1) for n1, n2 in zip(n, n[1:] + n[0:1]))
+            # Condition 1: 2<= N(P1) <= 6, Condition 2: S(P1)=1
+            condition_12 = 2 <= sum(n) <= 6 and transitions == 1
+            lut_step1[code] = condition_12 and P2 * P4 * P6 == 0 and P4 * P6 * P8 == 0  # Conditions 3 and 4
+            lut_step2[code] = condition_12 and P2 * P4 * P8 == 0 and P2 * P6 * P8 == 0  # Conditions 3 and 4
+        return lut_step1, lut_step2
 
     # ------------------------------------------------------------------------------------------------------------------
     def zhang_suen(self, image):
         """
         the Zhang-Suen Thinning Algorithm
-        code from https://github.com/linbojin/Skeletonization-by-Zhang-Suen-Thinning-Algorithm
-        :param image:
+        code adapted from https://github.com/linbojin/Skeletonization-by-Zhang-Suen-Thinning-Algorithm: all points
+        are processed at once using a lookup table of the neighbourhood configurations
+        :param image: 2D binary image, or stack of 2D images along the first axis (each slice is thinned separately)
         :return:
         """
-        # now = time.time()
         image_thinned = image.copy()  # deepcopy to protect the original image
-        changing1 = changing2 = 1  # the points to be removed (set as 0)
+        lut_step1, lut_step2 = self.get_lookup_tables()
+        # points on the lines 1 and max are not processed
+        max = image.shape[-2] - 1
+        x, y = np.indices(image.shape[-2:])
+        mask_pass = (x != 1) & (x != max) & (y != 1) & (y != max)
+        changing1 = changing2 = True  # the points to be removed (set as 0)
         while changing1 or changing2:  # iterates until no further changes occur in the image
             # Step 1
-            changing1 = []
-            max = len(image_thinned) - 1
-            pass_list = [1, max]
-            # rows, columns = image_thinned.shape  # x for rows, y for columns
-
-            # for x in range(1, rows - 1):         # No. of  rows
-            # for y in range(1, columns - 1):  # No. of columns
-            for x, y in non_zero_coord(image_thinned):
-                if x not in pass_list and y not in pass_list:
-                    # if image_thinned[x][y] == 1:  # Condition 0: Point P1 in the object regions
-                    P2, P3, P4, P5, P6, P7, P8, P9 = n = self.get_neighbours(x, y, image_thinned)
-                    if (2 <= sum(n) <= 6 and    # Condition 1: 2<= N(P1) <= 6
-                        P2 * P4 * P6 == 0 and    # Condition 3
-                        P4 * P6 * P8 == 0 and   # Condition 4
-                        self.transitions(n) == 1):    # Condition 2: S(P1)=1
-                        changing1.append((x, y))
-            for x, y in changing1:
-                image_thinned[x][y] = 0
+            changing1 = (image_thinned > 0) & mask_pass & lut_step1[self.get_neighbours(image_thinned)]
+            image_thinned[changing1] = 0
+            changing1 = changing1.any()
             # Step 2
-            changing2 = []
-
-            # for x in range(1, rows - 1):
-            # for y in range(1, columns - 1):
-            for x, y in non_zero_coord(image_thinned):
-                if x not in pass_list and y not in pass_list:
-                    # if image_thinned[x][y] == 1:  # Condition 0
-                    P2, P3, P4, P5, P6, P7, P8, P9 = n = self.get_neighbours(x, y, image_thinned)
-                    if (2 <= sum(n) <= 6 and       # Condition 1
-                        P2 * P4 * P8 == 0 and       # Condition 3
-                        P2 * P6 * P8 == 0 and  # Condition 4
-                        self.transitions(n) == 1):    # Condition 2
-                        changing2.append((x, y))
-            for x, y in changing2:
-                image_thinned[x][y] = 0
-        # t = time.time() - now
-        # print 't thinning: ', t
+            changing2 = (image_thinned > 0) & mask_pass & lut_step2[self.get_neighbours(image_thinned)]
+            image_thinned[changing2] = 0
+            changing2 = changing2.any()
         return image_thinned
 
 
 # ----------------------------------------------------------------------------------------------------------------------
 # HAUSDORFF'S DISTANCE -------------------------------------------------------------------------------------------------
 class HausdorffDistance:
-    def __init__(self, data1, data2, v=1):
+    def __init__(self, data1, data2, v=1, sampling=None):
         """
         the hausdorff distance between two sets is the maximum of the distances from a point in any of the sets to the nearest point in the other set
+        Works in 2D and 3D.
+        :param sampling: voxel size along each axis. None: distances are in pixel
         :return:
         """
         # now = time.time()
-        sct.printv('Computing 2D Hausdorff\'s distance ... ', v, 'normal')
+        sct.printv('Computing ' + str(data1.ndim) + 'D Hausdorff\'s distance ... ', v, 'normal')
         self.data1 = bin_data(data1)
         self.data2 = bin_data(data2)
 
-        self.min_distances_1 = self.relative_hausdorff_dist(self.data1, self.data2, v)
-        self.min_distances_2 = self.relative_hausdorff_dist(self.data2, self.data1, v)
+        self.min_distances_1 = self.relative_hausdorff_dist(self.data1, self.data2, v, sampling)
+        self.min_distances_2 = self.relative_hausdorff_dist(self.data2, self.data1, v, sampling)
 
         # relatives hausdorff's distances in pixel
         self.h1 = np.max(self.min_distances_1)
@@ -167,24 +150,15 @@ class HausdorffDistance:
         # print 'Hausdorff dist time :', t
 
     # ------------------------------------------------------------------------------------------------------------------
-    def relative_hausdorff_dist(self, dat1, dat2, v=1):
+    def relative_hausdorff_dist(self, dat1, dat2, v=1, sampling=None):
+        """
+        Distance from each non-zero point of dat1 to the nearest non-zero point of dat2 (0 elsewhere).
+        Uses the Euclidean distance transform of the background of dat2.
+        """
+        from scipy.ndimage import distance_transform_edt
         h = np.zeros(dat1.shape)
-        nz_coord_1 = non_zero_coord(dat1)
-        nz_coord_2 = non_zero_coord(dat2)
-        if len(nz_coord_1) != 0 and len(nz_coord_2) != 0 :
-            for x1, y1 in nz_coord_1:
-                # for x1 in range(dat1.shape[0]):
-                # for y1 in range(dat1.shape[1]):
-                # if dat1[x1, y1] == 1:
-                d_p1_dat2 = []
-                p1 = np.asarray([x1, y1])
-                for x2, y2 in nz_coord_2:
-                    # for x2 in range(dat2.shape[0]):
-                    # for y2 in range(dat2.shape[1]):
-                    # if dat2[x2, y2] == 1:
-                    p2 = np.asarray([x2, y2])
-                    d_p1_dat2.append(np.linalg.norm(p1 - p2))  # Euclidean distance between p1 and p2
-                h[x1, y1] = min(d_p1_dat2)
+        if np.any(dat1) and np.any(dat2):
+            h = distance_transform_edt(dat2 == 0, sampling=sampling) * (dat1 > 0)
         else:
             sct.printv('Warning: an image is empty', v, 'warning')
         return h
@@ -228,13 +202,15 @@ class ComputeDistances:
         if self.dim_im == 3:
             if self.im2 is None:
                 self.compute_dist_1im_3d()
+            elif self.param.hausdorff_3d:
+                self.compute_dist_2im_3d_volume()
             else:
                 self.compute_dist_2im_3d()
 
-        if self.dim_im == 2 and self.distances is not None:
+        if isinstance(self.distances, HausdorffDistance):
             self.dist1_distribution = self.distances.min_distances_1[np.nonzero(self.distances.min_distances_1)]
             self.dist2_distribution = self.distances.min_distances_2[np.nonzero(self.distances.min_distances_2)]
-        if self.dim_im == 3:
+        if isinstance(self.distances, list):
             self.dist1_distribution = []
             self.dist2_distribution = []
             for d in self.distances:
@@ -275,6 +251,26 @@ class ComputeDistances:
                    'First relative Hausdorff\'s distance : ' + str(self.distances.h1 * self.dim_pix) + ' mm\n' \
                    'Second relative Hausdorff\'s distance : ' + str(self.distances.h2 * self.dim_pix) + ' mm'
 
+    # ------------------------------------------------------------------------------------------------------------------
+    def compute_dist_2im_3d_volume(self):
+        nx1, ny1, nz1, nt1, px1, py1, pz1, pt1 = get_dimension(self.im1)
+        nx2, ny2, nz2, nt2, px2, py2, pz2, pt2 = get_dimension(self.im2)
+        assert (nx1, ny1, nz1) == (nx2, ny2, nz2)
+        # distances are computed in mm
+        self.dim_pix = 1
+
+        if self.param.thinning:
+            dat1 = self.thinning1.thinned_image.data
+            dat2 = self.thinning2.thinned_image.data
+        else:
+            dat1 = bin_data(self.im1.data)
+            dat2 = bin_data(self.im2.data)
+
+        self.distances = HausdorffDistance(dat1, dat2, self.param.verbose, sampling=(px1, py1, pz1))
+        self.res = '3D Hausdorff\'s distance : ' + str(self.distances.H) + ' mm\n\n' \
+                   'First relative Hausdorff\'s distance : ' + str(self.distances.h1) + ' mm\n' \
+                   'Second relative Hausdorff\'s distance : ' + str(self.distances.h2) + ' mm'
+
     # ------------------------------------------------------------------------------------------------------------------
     def compute_dist_1im_3d(self):
         nx1, ny1, nz1, nt1, px1, py1, pz1, pt1 = get_dimension(self.im1)
@@ -319,7 +315,7 @@ class ComputeDistances:
 
         data_dist = {"distances": [], "image": [], "slice": []}
 
-        if self.dim_im == 2:
+        if isinstance(self.distances, HausdorffDistance):
             data_dist["distances"].append([dist * self.dim_pix for dist in self.dist1_distribution])
             data_dist["image"].append(len(self.dist1_distribution) * [1])
             data_dist["slice"].append(len(self.dist1_distribution) * [0])
@@ -328,7 +324,7 @@ class ComputeDistances:
             data_dist["image"].append(len(self.dist2_distribution) * [2])
             data_dist["slice"].append(len(self.dist2_distribution) * [0])
 
-        if self.dim_im == 3:
+        if isinstance(self.distances, list):
             for i in range(len(self.distances)):
                 data_dist["distances"].append([dist * self.dim_pix for dist in self.dist1_distribution[i]])
                 data_dist["image"].append(len(self.dist1_distribution[i]) * [1])
@@ -442,6 +438,12 @@ def get_parser():
                       description="Thinning : find the skeleton of the binary images using the Zhang-Suen algorithm (1984) and use it to compute the hausdorff's distance",
                       deprecated_by="-thinning",
                       mandatory=False)
+    parser.add_option(name="-3d",
+                      type_value="multiple_choice",
+                      description="Compute the Hausdorff's distance between the two 3D volumes (in mm, using the voxel size) instead of slice-by-slice.",
+                      mandatory=False,
+                      default_value='0',
+                      example=['0', '1'])
     parser.add_option(name="-resampling",
                       type_value="float",
                       description="pixel size in mm to resample to",
@@ -485,6 +487,8 @@ if __name__ == "__main__":
             input_second_fname = arguments["-d"]
         if "-thinning" in arguments:
             param.thinning = bool(int(arguments["-thinning"]))
+        if "-3d" in arguments:
+            param.hausdorff_3d = bool(int(arguments["-3d"]))
         if "-resampling" in arguments:
             resample_to = arguments["-resampling"]
         if "-o" in arguments:
@@ -10,8 +10,11 @@
 # About the license: see the file LICENSE.TXT
 #########################################################################################
 
+import os
 import sys
 
+import numpy as np
+
 from msct_parser import Parser
 from sct_utils import printv
 
@@ -19,6 +22,8 @@ from sct_utils import printv
 class Param:
     def __init__(self):
         self.verbose = 1
+        self.chunk_size = 0  # number of voxels fitted at once. 0: fit all voxels at once.
+        self.nb_cpu = None  # number of processes used to fit chunks of voxels. None: all the available cores.
 
 
 # PARSER
@@ -67,6 +72,17 @@ def get_parser():
                       description='Output prefix.',
                       mandatory=False,
                       default_value='dti_')
+    parser.add_option(name='-chunk-size',
+                      type_value='int',
+                      description='Fit the tensor by chunks of this number of voxels, in parallel (see -cpu-nb): only the data of the chunks being fitted is loaded in memory. If a mask is provided, data is cropped around the mask and only voxels within the mask are fitted. 0: fit all voxels at once.',
+                      mandatory=False,
+                      default_value=param.chunk_size,
+                      example='10000')
+    parser.add_option(name="-cpu-nb",
+                      type_value="int",
+                      description="Number of CPU used for fitting chunks of voxels in parallel (with -chunk-size). 0: no multiprocessing. If not provided, it uses all the available cores.",
+                      mandatory=False,
+                      example='4')
     parser.add_option(name="-v",
                       type_value="multiple_choice",
                       description="""Verbose. 0: nothing. 1: basic. 2: extended.""",
@@ -97,15 +113,18 @@ def main(args = None):
     if "-m" in arguments:
         file_mask = arguments['-m']
     param.verbose = int(arguments['-v'])
+    param.chunk_size = arguments['-chunk-size']
+    if '-cpu-nb' in arguments:
+        param.nb_cpu = arguments['-cpu-nb']
 
     # compute DTI
-    if not compute_dti(fname_in, fname_bvals, fname_bvecs, prefix, method, file_mask):
+    if not compute_dti(fname_in, fname_bvals, fname_bvecs, prefix, method, file_mask, chunk_size=param.chunk_size, nb_cpu=param.nb_cpu):
         printv('ERROR in compute_dti()', 1, 'error')
 
 
 # compute_dti
 # ==========================================================================================
-def compute_dti(fname_in, fname_bvals, fname_bvecs, prefix, method, file_mask):
+def compute_dti(fname_in, fname_bvals, fname_bvecs, prefix, method, file_mask, chunk_size=0, nb_cpu=None):
     """
     Compute DTI.
     :param fname_in: input 4d file.
@@ -113,11 +132,13 @@ def compute_dti(fname_in, fname_bvals, fname_bvecs, prefix, method, file_mask):
     :param bvecs: bvecs txt file
     :param prefix: output prefix. Example: "dti_"
     :param method: algo for computing dti
+    :param chunk_size: number of voxels fitted at once (see fit_dti_chunks). 0: fit all voxels at once.
+    :param nb_cpu: number of processes used to fit chunks of voxels. None: all the available cores.
     :return: True/False
     """
-    # Open file.
+    # Open file. When fitting by chunks, data is memory-mapped and only read chunk by chunk.
     from msct_image import Image
-    nii = Image(fname_in)
+    nii = Image(fname_in, mmap=True if chunk_size > 0 else None)
     data = nii.data
     print('data.shape (%d, %d, %d, %d)' % data.shape)
 
@@ -128,56 +149,166 @@ def compute_dti(fname_in, fname_bvals, fname_bvecs, prefix, method, file_mask):
     gtab = gradient_table(bvals, bvecs)
 
     # mask and crop the data. This is a quick way to avoid calculating Tensors on the background of the image.
+    mask = None
     if not file_mask == '':
         printv('Open mask file...', param.verbose)
         # open mask file
         nii_mask = Image(file_mask)
         mask = nii_mask.data
 
+    # noise level, for restore method
+    sigma = None
+    if method == 'restore':
+        import dipy.denoise.noise_estimate as ne
+        if chunk_size > 0:
+            # noise is estimated on each volume independently: read one volume at a time
+            sigma = np.concatenate([ne.estimate_sigma(np.asarray(data[..., i_vol])) for i_vol in range(data.shape[3])])
+        else:
+            sigma = ne.estimate_sigma(data)
+
+    # signal floor of the fit, computed on the whole data so that all chunks use the same one
+    min_signal = get_min_positive_signal(data)
+
     # fit tensor model
     printv('Computing tensor using "' + method + '" method...', param.verbose)
-    import dipy.reconst.dti as dti
-    if method == 'standard':
-        tenmodel = dti.TensorModel(gtab)
-        if file_mask == '':
+    if chunk_size > 0:
+        dict_metrics = fit_dti_chunks(data, bvals, bvecs, method, sigma=sigma, mask=mask, chunk_size=chunk_size, nb_cpu=nb_cpu, min_signal=min_signal)
+    else:
+        import dipy.reconst.dti as dti
+        if method == 'standard':
+            tenmodel = dti.TensorModel(gtab, min_signal=min_signal)
+        elif method == 'restore':
+            tenmodel = dti.TensorModel(gtab, fit_method='RESTORE', sigma=sigma, min_signal=min_signal)
+        if mask is None:
             tenfit = tenmodel.fit(data)
         else:
             tenfit = tenmodel.fit(data, mask)
-    elif method == 'restore':
-        import dipy.denoise.noise_estimate as ne
-        sigma = ne.estimate_sigma(data)
-        dti_restore = dti.TensorModel(gtab, fit_method='RESTORE', sigma=sigma)
-        if file_mask == '':
-            tenfit = dti_restore.fit(data)
-        else:
-            tenfit = dti_restore.fit(data, mask)
-
-    # Compute metrics
-    printv('Computing metrics...', param.verbose)
-    # FA
-    from dipy.reconst.dti import fractional_anisotropy
-    nii.data = fractional_anisotropy(tenfit.evals)
-    nii.setFileName(prefix + 'FA.nii.gz')
-    nii.save('float32')
-    # MD
-    from dipy.reconst.dti import mean_diffusivity
-    nii.data = mean_diffusivity(tenfit.evals)
-    nii.setFileName(prefix + 'MD.nii.gz')
-    nii.save('float32')
-    # RD
-    from dipy.reconst.dti import radial_diffusivity
-    nii.data = radial_diffusivity(tenfit.evals)
-    nii.setFileName(prefix + 'RD.nii.gz')
-    nii.save('float32')
-    # AD
-    from dipy.reconst.dti import axial_diffusivity
-    nii.data = axial_diffusivity(tenfit.evals)
-    nii.setFileName(prefix + 'AD.nii.gz')
-    nii.save('float32')
+
+        # Compute metrics
+        printv('Computing metrics...', param.verbose)
+        dict_metrics = compute_dti_metrics(tenfit.evals)
+
+    # save metrics
+    for metric in LIST_DTI_METRICS:
+        nii.data = dict_metrics[metric]
+        nii.setFileName(prefix + metric + '.nii.gz')
+        nii.save('float32')
 
     return True
 
 
+# names of the metrics computed from the eigen values of the tensor
+LIST_DTI_METRICS = ['FA', 'MD', 'RD', 'AD']
+
+
+def compute_dti_metrics(evals):
+    """
+    :param evals: eigen values of the tensor, array (..., 3)
+    :return: dict of metrics (FA, MD, RD, AD) arrays, with metric names as keys
+    """
+    from dipy.reconst.dti import fractional_anisotropy, mean_diffusivity, radial_diffusivity, axial_diffusivity
+    return {'FA': fractional_anisotropy(evals),
+            'MD': mean_diffusivity(evals),
+            'RD': radial_diffusivity(evals),
+            'AD': axial_diffusivity(evals)}
+
+
+def get_min_positive_signal(data):
+    """
+    Minimum positive signal of the data, used by dipy to floor the signal before fitting the tensor (same value as
+    dipy.reconst.dti computes on the whole data). The data is read one volume at a time.
+    :param data: 4d array (or memory-mapped array)
+    :return: float
+    """
+    min_signal = None
+    for i_vol in range(data.shape[3]):
+        data_vol = np.asarray(data[..., i_vol])
+        data_vol = data_vol[data_vol > 0]
+        if data_vol.size and (min_signal is None or data_vol.min() < min_signal):
+            min_signal = data_vol.min()
+    if min_signal is None:
+        # no positive signal: same default as dipy
+        return 0.0001
+    return float(min_signal)
+
+
+def fit_dti_chunk(args):
+    """
+    Fit the tensor on a chunk of voxels (run in a worker process)
+    :param args: tuple (data_chunk, bvals, bvecs, method, sigma, min_signal), data_chunk: array (nb voxels, nb volumes)
+    :return: dict of metrics (see compute_dti_metrics), arrays (nb voxels)
+    """
+    data_chunk, bvals, bvecs, method, sigma, min_signal = args
+    from dipy.core.gradients import gradient_table
+    import dipy.reconst.dti as dti
+    gtab = gradient_table(bvals, bvecs)
+    if method == 'restore':
+        tenmodel = dti.TensorModel(gtab, fit_method='RESTORE', sigma=sigma, min_signal=min_signal)
+    else:
+        tenmodel = dti.TensorModel(gtab, min_signal=min_signal)
+    return compute_dti_metrics(tenmodel.fit(data_chunk).evals)
+
+
+def fit_dti_chunks(data, bvals, bvecs, method, sigma=None, mask=None, chunk_size=10000, nb_cpu=None, min_signal=None):
+    """
+    Fit the tensor by chunks of voxels, on a pool of processes. Only 2 * nb_cpu chunks are loaded in memory at once.
+    If a mask is provided, only the voxels within the mask (cropped to the bounding box of the mask) are fitted, the
+    metrics being 0 elsewhere (as with TensorModel.fit(data, mask)).
+    :param data: 4d array (or memory-mapped array)
+    :param mask: 3d array or None
+    :param chunk_size: number of voxels per chunk
+    :param nb_cpu: number of processes. None: all the available cores. 0 or 1: no multiprocessing.
+    :param min_signal: signal floor of the fit (see get_min_positive_signal). None: computed on data.
+    :return: dict of metrics (see compute_dti_metrics), 3d arrays
+    """
+    from itertools import izip
+    from sct_utils import get_nb_cpu, iter_pool
+    nb_cpu = get_nb_cpu(nb_cpu)
+    shape = data.shape[:3]
+    if min_signal is None:
+        min_signal = get_min_positive_signal(data)
+    # coordinates of the voxels to fit
+    if mask is None:
+        coord_fit = np.indices(shape).reshape(3, -1)
+        bbox = tuple(slice(0, n) for n in shape)
+    else:
+        coord_mask = np.nonzero(np.asarray(mask) > 0)
+        if len(coord_mask[0]) == 0:
+            printv('WARNING: Mask is empty.', param.verbose, 'warning')
+            return dict((metric, np.zeros(shape)) for metric in LIST_DTI_METRICS)
+        # crop data around the mask
+        bbox = tuple(slice(np.min(coord), np.max(coord) + 1) for coord in coord_mask)
+        printv('Crop data around the mask: ' + ', '.join(str(b.start) + '-' + str(b.stop - 1) for b in bbox), param.verbose)
+        data = data[bbox]
+        coord_fit = np.array([coord - b.start for coord, b in zip(coord_mask, bbox)])
+    nb_vox = coord_fit.shape[1]
+
+    dict_metrics = dict((metric, np.zeros(shape)) for metric in LIST_DTI_METRICS)
+    dict_metrics_crop = dict((metric, dict_metrics[metric][bbox]) for metric in LIST_DTI_METRICS)
+    list_ind_chunks = [np.arange(i, min(i + chunk_size, nb_vox)) for i in range(0, nb_vox, chunk_size)]
+    printv('Fit ' + str(nb_vox) + ' voxels by chunks of ' + str(chunk_size) + ' voxels (' + str(len(list_ind_chunks)) + ' chunks) using ' + str(max(nb_cpu, 1)) + ' processes...', param.verbose)
+
+    def get_args(ind_chunk):
+        coord_chunk = tuple(coord_fit[:, ind_chunk])
+        return np.asarray(data[coord_chunk], dtype=float), bvals, bvecs, method, sigma, min_signal
+
+    def store_metrics(ind_chunk, metrics_chunk):
+        coord_chunk = tuple(coord_fit[:, ind_chunk])
+        for metric in LIST_DTI_METRICS:
+            dict_metrics_crop[metric][coord_chunk] = metrics_chunk[metric]
+
+    if nb_cpu <= 1:
+        for ind_chunk in list_ind_chunks:
+            store_metrics(ind_chunk, fit_dti_chunk(get_args(ind_chunk)))
+    else:
+        # chunks are read when they are submitted to the pool: at most 2 * nb_cpu chunks are in memory at once
+        iter_metrics = iter_pool(fit_dti_chunk, (get_args(ind_chunk) for ind_chunk in list_ind_chunks), nb_cpu)
+        for ind_chunk, metrics_chunk in izip(list_ind_chunks, iter_metrics):
+            store_metrics(ind_chunk, metrics_chunk)
+
+    return dict_metrics
+
+
 # # Get bvecs
 # # ==========================================================================================
 # def get_bvecs(fname):
@@ -73,6 +73,7 @@ class Param:
         self.bval_min = 100  # in case user does not have min bvalues at 0, set threshold (where csf disapeared).
         self.otsu = 0  # use otsu algorithm to segment dwi data for better moco. Value coresponds to data threshold. For no segmentation set to 0.
         self.iterative_averaging = 1  # iteratively average target image for more robust moco
+        self.nb_cpu = None  # number of processes used to register volumes. None: all the available cores.
 
 
 #=======================================================================================================================
@@ -112,6 +113,8 @@ def main():
         param.interp = arguments['-x']
     if '-ofolder' in arguments:
         path_out = arguments['-ofolder']
+    if '-cpu-nb' in arguments:
+        param.nb_cpu = arguments['-cpu-nb']
     if '-r' in arguments:
         param.remove_tmp_files = int(arguments['-r'])
     if '-v' in arguments:
@@ -513,6 +516,11 @@ def get_parser():
                       mandatory=False,
                       deprecated_by='-o')
     parser.usage.addSection('MISC')
+    parser.add_option(name="-cpu-nb",
+                      type_value="int",
+                      description="Number of CPU used for registering volumes in parallel. 0: no multiprocessing. If not provided, it uses all the available cores.",
+                      mandatory=False,
+                      example='4')
     parser.add_option(name="-r",
                       type_value="multiple_choice",
                       description='Remove temporary files.',
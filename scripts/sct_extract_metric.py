@@ -463,14 +463,11 @@ def extract_metric(method, data, labels, indiv_labels_ids, clusters_labels='', a
     if normalizing_label:  # if the "normalization" option is wanted
         sct.printv('\nExtract normalization values...', verbose)
         if normalization_method == 'sbs':  # case: the user wants to normalize slice-by-slice
-            for z in range(0, data.shape[-1]):
-                normalizing_label_slice = np.empty([1], dtype=object)  # in order to keep compatibility with the function
-                # 'extract_metric_within_tract', define a new array for the slice z of the normalizing labels
-                normalizing_label_slice[0] = normalizing_label[0][..., z]
-                metric_normalizing_label = estimate_metric_within_tract(data[..., z], normalizing_label_slice, method, 0)
-                # estimate the metric mean in the normalizing label for the slice z
-                if metric_normalizing_label[0][0] != 0:
-                    data[..., z] = data[..., z] / metric_normalizing_label[0][0]  # divide all the slice z by this value
+            # estimate the metric mean in the normalizing label for all slices at once
+            metric_normalizing_label = estimate_metric_within_tract_slicewise(data, normalizing_label, method)[0][:, 0]
+            # divide each slice z by this value
+            ind_nonzero = metric_normalizing_label != 0
+            data[..., ind_nonzero] = data[..., ind_nonzero] / metric_normalizing_label[ind_nonzero]
 
         elif normalization_method == 'whole':  # case: the user wants to normalize after estimations in the whole labels
             metric_norm_label, metric_std_norm_label = estimate_metric_within_tract(data, normalizing_label, method, param_default.verbose)  # mean and std are lists
@@ -996,11 +993,11 @@ def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels
     for i in range(0, nb_labels):
         labels2d[i] = labels[i][ind_positive]
     # if specified (flag -mask-weighted), define a matrix to weight voxels. If not, this matrix is set to identity.
+    # weights are applied by scaling the rows of the problem (instead of multiplying by a diagonal weight matrix).
     if im_weight:
         data_weight_1d = im_weight.data[ind_positive]
     else:
         data_weight_1d = np.ones(nb_vox)
-    W = np.diag(data_weight_1d)  # weight matrix
 
     # Display number of non-zero values
     sct.printv('  Number of non-null voxels: ' + str(nb_vox), verbose=verbose)
@@ -1036,11 +1033,10 @@ def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels
             data_weight_1d_apriori = im_weight.data[ind_positive_clustered_labels]
         else:
             data_weight_1d_apriori = np.ones(np.sum(ind_positive_clustered_labels))
-        W_apriori = np.diag(data_weight_1d_apriori)  # weight matrix
 
-        # apply the weighting matrix
-        y_apriori = np.dot(W_apriori, y_apriori)
-        x_apriori = np.dot(W_apriori, x_apriori)
+        # apply the weights
+        y_apriori = data_weight_1d_apriori * y_apriori
+        x_apriori = data_weight_1d_apriori[:, np.newaxis] * x_apriori
 
         # estimate values using ML for each cluster
         beta = np.dot(np.linalg.pinv(np.dot(x_apriori.T, x_apriori)), np.dot(x_apriori.T, y_apriori))  # beta = (Xt . X)-1 . Xt . y
@@ -1055,8 +1051,8 @@ def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels
         var_noise = int(adv_param[1]) ^ 2  # variance of the noise (assumed Gaussian)
 
         # define the problem: y is the measurements vector (to which weights are applied, to each voxel) and x is the linear relation between the measurements y and the true metric value to be estimated beta
-        y = np.dot(W, data1d)  # [nb_vox x 1]
-        x = np.dot(W, labels2d.T)  # [nb_vox x nb_labels]
+        y = data_weight_1d * data1d  # [nb_vox x 1]
+        x = data_weight_1d[:, np.newaxis] * labels2d.T  # [nb_vox x nb_labels]
         # construct beta0
         beta0 = np.zeros(nb_labels)
         for i_cluster in range(nb_clusters):
@@ -1077,8 +1073,8 @@ def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels
     # Estimation with maximum likelihood
     if method == 'ml':
         # define the problem: y is the measurements vector (to which weights are applied, to each voxel) and x is the linear relation between the measurements y and the true metric value to be estimated beta
-        y = np.dot(W, data1d)  # [nb_vox x 1]
-        x = np.dot(W, labels2d.T)  # [nb_vox x nb_labels]
+        y = data_weight_1d * data1d  # [nb_vox x 1]
+        x = data_weight_1d[:, np.newaxis] * labels2d.T  # [nb_vox x nb_labels]
         beta = np.dot(np.linalg.pinv(np.dot(x.T, x)), np.dot(x.T, y))  # beta = (Xt . X)-1 . Xt . y
         #beta, residuals, rank, singular_value = np.linalg.lstsq(np.dot(x.T, x), np.dot(x.T, y), rcond=-1)
         #beta, residuals, rank, singular_value = np.linalg.lstsq(x, y)
@@ -1089,22 +1085,79 @@ def estimate_metric_within_tract(data, labels, method, verbose, clustered_labels
 
     # Estimation with weighted average (also works for binary)
     if method == 'wa' or method == 'bin' or method == 'wath' or method == 'max':
+        sum_labels = np.sum(labels2d, axis=1)
         for i_label in range(0, nb_labels):
             # check if all labels are equal to zero
-            if sum(labels2d[i_label, :]) == 0:
+            if sum_labels[i_label] == 0:
                 print 'WARNING: labels #' + str(i_label) + ' contains only null voxels. Mean and std are set to 0.'
                 metric_mean[i_label] = 0
                 metric_std[i_label] = 0
             else:
                 # estimate the weighted average
-                metric_mean[i_label] = sum(data1d * labels2d[i_label, :]) / sum(labels2d[i_label, :])
+                metric_mean[i_label] = np.dot(labels2d[i_label, :], data1d) / sum_labels[i_label]
                 # estimate the biased weighted standard deviation
-                metric_std[i_label] = np.sqrt(
-                    sum(labels2d[i_label, :] * (data1d - metric_mean[i_label]) ** 2) / sum(labels2d[i_label, :]))
+                metric_std[i_label] = np.sqrt(np.dot(labels2d[i_label, :], (data1d - metric_mean[i_label]) ** 2) / sum_labels[i_label])
 
     return metric_mean, metric_std
 
 
+def estimate_metric_within_tract_slicewise(data, labels, method, im_weight=None):
+    """Extract metric within labels for each slice. The problems of all slices are solved at once.
+    :data: (nx,ny,nz) numpy array
+    :labels: nlabel tuple of (nx,ny,nz) array
+    :method: ml, wa, bin, wath or max (map is not available slice-wise)
+    :return: metric_mean, metric_std: (nz,nlabel) numpy arrays
+    """
+    if method not in ['ml', 'wa', 'bin', 'wath', 'max']:
+        sct.printv('ERROR: method ' + method + ' is not available for slice-wise estimation.', 1, 'error')
+
+    labels = np.array([label for label in labels], dtype=float)  # [nb_labels x nx x ny x nz]
+    # if user asks for binary regions, binarize atlas
+    if method == 'bin':
+        labels = (labels >= 0.5).astype(float)
+    # if user asks for thresholded weighted-average, threshold atlas
+    if method == 'wath':
+        labels[labels < 0.5] = 0
+    if im_weight:
+        data_weight = im_weight.data
+    else:
+        data_weight = np.ones(data.shape)
+
+    # Estimation with maximum likelihood: solve the normal equations (Xt . X) . beta = Xt . y of each slice
+    if method == 'ml':
+        data_weight = data_weight ** 2
+        xtx = np.einsum('ixyz,jxyz,xyz->zij', labels, labels, data_weight)
+        xty = np.einsum('ixyz,xyz->zi', labels, data_weight * data)
+        metric_mean = np.einsum('zij,zj->zi', pinv_stacked(xtx), xty)
+        metric_std = np.zeros(metric_mean.shape)
+
+    # Estimation with weighted average (also works for binary)
+    else:
+        sum_labels = np.sum(labels, axis=(1, 2)).T  # [nz x nb_labels]
+        sum_data = np.einsum('ixyz,xyz->zi', labels, data)
+        sum_data2 = np.einsum('ixyz,xyz->zi', labels, data ** 2)
+        ind_nonzero = sum_labels != 0
+        metric_mean = np.zeros(sum_labels.shape)
+        metric_mean[ind_nonzero] = sum_data[ind_nonzero] / sum_labels[ind_nonzero]
+        # biased weighted standard deviation: sum(w.(x-m)^2) / sum(w) = sum(w.x^2) / sum(w) - m^2
+        metric_var = np.zeros(sum_labels.shape)
+        metric_var[ind_nonzero] = sum_data2[ind_nonzero] / sum_labels[ind_nonzero] - metric_mean[ind_nonzero] ** 2
+        metric_std = np.sqrt(np.maximum(metric_var, 0))
+
+    return metric_mean, metric_std
+
+
+def pinv_stacked(a, rcond=1e-15):
+    """Pseudo-inverse of a stack of matrices (same as np.linalg.pinv applied to each matrix).
+    :a: (n,m,m) numpy array
+    """
+    u, s, vt = np.linalg.svd(a)
+    cutoff = rcond * np.max(s, axis=-1, keepdims=True)
+    s_inv = np.zeros(s.shape)
+    s_inv[s > cutoff] = 1. / s[s > cutoff]
+    return np.einsum('nji,nj,nkj->nik', vt, s_inv, u)
+
+
 def get_clustered_labels(clusters_all_labels, labels, indiv_labels_ids, labels_user, averaging_flag, verbose):
     """
     Cluster labels according to selected options (labels and averaging).
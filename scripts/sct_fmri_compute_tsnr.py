@@ -53,40 +53,14 @@ class Tsnr:
         # # print sct.slash_at_the_end(path_fmri) + fname_fmri
         # # sct.run('mcflirt -in ' + sct.slash_at_the_end(path_fmri, 1) + fname_fmri + ' -out ' + fname_fmri_moco)
 
-        # compute mean
-        fname_data_mean = sct.add_suffix(fname_data, '_mean')
-        sct_maths.main(args=[
-            '-i', fname_data,
-            '-o', fname_data_mean,
-            '-mean', 't'
-        ])
-
-        # compute STD
-        fname_data_std = sct.add_suffix(fname_data, '_std')
-        sct_maths.main(args=[
-            '-i', fname_data,
-            '-o', fname_data_std,
-            '-std', 't'
-        ])
-
-        # compute tSNR
+        # compute tSNR in a single pass over the time series
         fname_tsnr = sct.add_suffix(fname_data, '_tsnr')
         from msct_image import Image
-        nii_mean = Image(fname_data_mean)
-        data_mean = nii_mean.data
-        data_std = Image(fname_data_std).data
-        data_tsnr = data_mean / data_std
-        nii_tsnr = nii_mean
-        nii_tsnr.data = data_tsnr
-        nii_tsnr.setFileName(fname_tsnr)
+        nii_data = Image(fname_data, mmap=True)
+        data_tsnr = sct_maths.temporal_stats(nii_data.data, ['tsnr'])['tsnr']
+        nii_tsnr = Image(param=data_tsnr, hdr=nii_data.hdr.copy(), orientation=nii_data.orientation, absolutepath=fname_tsnr, dim=nii_data.dim)
         nii_tsnr.save()
 
-        # Remove temp files
-        sct.printv('\nRemove temporary files...', self.param.verbose, 'normal')
-        import os
-        os.remove(fname_data_mean)
-        os.remove(fname_data_std)
-
         # to view results
         sct.printv('\nDone! To view results, type:', self.param.verbose, 'normal')
         sct.printv('fslview ' + fname_tsnr + ' &\n', self.param.verbose, 'info')
@@ -47,6 +47,7 @@ class Param:
         self.interp = 'spline'  # nn, linear, spline
         self.min_norm = 0.001
         self.iterative_averaging = 1  # iteratively average target image for more robust moco
+        self.nb_cpu = None  # number of processes used to register volumes. None: all the available cores.
 
 
 #=======================================================================================================================
@@ -328,6 +329,11 @@ def get_parser():
                       mandatory=False,
                       default_value='linear',
                       example=['nn', 'linear', 'spline'])
+    parser.add_option(name="-cpu-nb",
+                      type_value="int",
+                      description="Number of CPU used for registering volumes in parallel. 0: no multiprocessing. If not provided, it uses all the available cores.",
+                      mandatory=False,
+                      example='4')
     parser.add_option(name="-r",
                       type_value="multiple_choice",
                       description="""Remove temporary files.""",
@@ -363,6 +369,8 @@ if __name__ == "__main__":
     if '-param' in arguments:
         param_user = arguments['-param']
     param.interp = arguments['-x']
+    if '-cpu-nb' in arguments:
+        param.nb_cpu = arguments['-cpu-nb']
     param.remove_tmp_files = arguments['-r']
     param.verbose = arguments['-v']
 
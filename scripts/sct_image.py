@@ -324,79 +324,78 @@ def copy_header(im_src, im_dest):
 
 def split_data(im_in, dim):
     """
-    Split data
+    Split data. The split images are views of the input image: they share its data array (see Image.view).
     :param im_in: input image.
     :param dim: dimension: 0, 1, 2, 3.
     :return: list of split images
     """
-    from numpy import array_split
+    from numpy import split
     dim_list = ['x', 'y', 'z', 't']
-    # Parse file name
-    # Open first file.
     data = im_in.data
     if dim + 1 > len(shape(data)):  # in case input volume is 3d and dim=t
         data = data[..., newaxis]
-    # Split data into list
-    data_split = array_split(data, data.shape[dim], dim)
-    # Write each file
+    # Split data into list of views
+    data_split = split(data, data.shape[dim], dim)
     im_out_list = []
     for i, dat in enumerate(data_split):
-        im_out = im_in.copy()
-        im_out.data = dat
+        im_out = im_in.view(dat)
         im_out.setFileName(im_out.file_name + '_' + dim_list[dim].upper() + str(i).zfill(4) + im_out.ext)
         im_out_list.append(im_out)
 
     return im_out_list
 
 
+def get_shape(im_in):
+    """
+    :param im_in: image or file name. For a file, only the header is read.
+    :return: shape of the data
+    """
+    from msct_image import is_memory_image
+    if isinstance(im_in, Image):
+        return im_in.data.shape
+    if is_memory_image(im_in):
+        return Image(im_in).data.shape
+    from nibabel import load
+    return load(im_in).shape
+
+
 def concat_data(fname_in_list, dim, pixdim=None):
     """
-    Concatenate data
-    :param im_in_list: list of images.
+    Concatenate data. The output array is allocated once and the images are opened one at a time.
+    :param fname_in_list: list of images or of file names (images are used without being copied).
     :param dim: dimension: 0, 1, 2, 3.
     :param pixdim: pixel resolution to join to image header
     :return im_out: concatenated image
     """
-    # WARNING: calling concat_data in python instead of in command line causes a non understood issue (results are different with both options)
-    from numpy import concatenate, expand_dims
-
-    dat_list = []
-    data_concat_list = []
+    from numpy import empty, expand_dims, result_type
 
     # check if shape of first image is smaller than asked dim to concatenate along
-    data0 = Image(fname_in_list[0]).data
-    if len(data0.shape) <= dim:
-        expand_dim = True
-    else:
-        expand_dim = False
-
-    for i, fname in enumerate(fname_in_list):
-        # if there is more than 100 images to concatenate, then it does it iteratively to avoid memory issue.
-        if i != 0 and i % 100 == 0:
-            data_concat_list.append(concatenate(dat_list, axis=dim))
-            im = Image(fname)
-            dat = im.data
-            if expand_dim:
-                dat = expand_dims(dat, dim)
-            dat_list = [dat]
-            del im
-            del dat
-        else:
-            im = Image(fname)
-            dat = im.data
-            if expand_dim:
-                dat = expand_dims(dat, dim)
-            dat_list.append(dat)
-            del im
-            del dat
-    if data_concat_list:
-        data_concat_list.append(concatenate(dat_list, axis=dim))
-        data_concat = concatenate(data_concat_list, axis=dim)
-    else:
-        data_concat = concatenate(dat_list, axis=dim)
+    list_shape = [list(get_shape(im_in)) for im_in in fname_in_list]
+    expand_dim = len(list_shape[0]) <= dim
+    if expand_dim:
+        list_shape = [s[:dim] + [1] + s[dim:] for s in list_shape]
+    shape_concat = list(list_shape[0])
+    shape_concat[dim] = sum(s[dim] for s in list_shape)
+
+    data_concat = None
+    index = 0
+    for i, im_in in enumerate(fname_in_list):
+        im = im_in if isinstance(im_in, Image) else Image(im_in)
+        if i == 0:
+            im_first = im
+        dat = im.data
+        if expand_dim:
+            dat = expand_dims(dat, dim)
+        if data_concat is None:
+            data_concat = empty(shape_concat, dtype=dat.dtype)
+        elif result_type(data_concat, dat) != data_concat.dtype:
+            data_concat = data_concat.astype(result_type(data_concat, dat))
+        data_concat[(slice(None),) * dim + (slice(index, index + dat.shape[dim]),)] = dat
+        index += dat.shape[dim]
+        del im
+        del dat
     # write file
-    im_out = Image(fname_in_list[0]).copy()
-    im_out.data = data_concat
+    im_out = im_first.view(data_concat)
     im_out.setFileName(im_out.file_name + '_concat' + im_out.ext)
 
     if pixdim is not None:
@@ -667,6 +666,36 @@ def set_orientation(im, orientation, data_inversion=False, filename=False, fname
     return im_out
 
 
+def reorient_image(im, orientation):
+    """
+    Change the orientation of an image in memory: the data axes are permuted/flipped and the header (affine, dimensions,
+    voxel sizes) is updated accordingly, without writing the image to disk.
+    :param im: Image (3D or 4D)
+    :param orientation: orientation, e.g. 'RPI' (see get_orientation)
+    :return: reoriented Image. Its data is a view of the data of im.
+    """
+    from nibabel import orientations
+    # nibabel axis codes point towards the end of the axes, orientations of the toolbox towards their origin
+    opposite_character = {'L': 'R', 'R': 'L', 'A': 'P', 'P': 'A', 'I': 'S', 'S': 'I'}
+    affine = im.hdr.get_best_affine()
+    transform = orientations.ornt_transform(orientations.io_orientation(affine), orientations.axcodes2ornt([opposite_character[c] for c in orientation]))
+    data = orientations.apply_orientation(im.data, transform)
+    affine_out = affine.dot(orientations.inv_ornt_aff(transform, im.data.shape[:3]))
+
+    im_out = im.view(data)
+    zooms = list(im.hdr.get_zooms())
+    for axis_in, axis_out in enumerate(transform[:, 0].astype(int)):
+        zooms[axis_out] = im.hdr.get_zooms()[axis_in]
+    im_out.hdr.set_data_shape(data.shape)
+    im_out.hdr.set_zooms(zooms)
+    im_out.hdr.set_sform(affine_out)
+    im_out.hdr.set_qform(affine_out)
+    nx, ny, nz, nt, px, py, pz, pt = im.dim
+    im_out.dim = tuple(data.shape[:3]) + (nt,) + tuple(zooms[:3]) + (pt,)
+    im_out.orientation = orientation
+    return im_out
+
+
 def visualize_warp(fname_warp, fname_grid=None, step=3, rm_tmp=True):
     if fname_grid is None:
         from numpy import zeros
@@ -130,11 +130,10 @@ class ProcessLabels(object):
         """
         image_output = Image(self.image_input, self.verbose)
         # image_output.data *= 0
-        coordinates_input = self.image_input.getNonZeroCoordinates()
+        coordinates_input = self.image_input.getNonZeroCoordinates(as_array=True)
+        x, y, z = coordinates_input[:, :3].astype(int).T
 
-        # for all points with non-zeros neighbors, force the neighbors to 0
-        for i, coord in enumerate(coordinates_input):
-            image_output.data[int(coord.x), int(coord.y), int(coord.z)] = image_output.data[int(coord.x), int(coord.y), int(coord.z)] + float(value)
+        image_output.data[x, y, z] = image_output.data[x, y, z] + float(value)
         return image_output
 
     def create_label(self, add=False):
@@ -281,12 +280,10 @@ class ProcessLabels(object):
         image_input_pos = Image(self.image_input, self.verbose).copy()
         image_input_neg.data *= 0
         image_input_pos.data *= 0
-        X, Y, Z = (self.image_input.data < 0).nonzero()
-        for i in range(len(X)):
-            image_input_neg.data[X[i], Y[i], Z[i]] = -self.image_input.data[X[i], Y[i], Z[i]]  # in order to apply getNonZeroCoordinates
-        X_pos, Y_pos, Z_pos = (self.image_input.data > 0).nonzero()
-        for i in range(len(X_pos)):
-            image_input_pos.data[X_pos[i], Y_pos[i], Z_pos[i]] = self.image_input.data[X_pos[i], Y_pos[i], Z_pos[i]]
+        mask_neg = self.image_input.data < 0
+        image_input_neg.data[mask_neg] = -self.image_input.data[mask_neg]  # in order to apply getNonZeroCoordinates
+        mask_pos = self.image_input.data > 0
+        image_input_pos.data[mask_pos] = self.image_input.data[mask_pos]
 
         coordinates_input_neg = image_input_neg.getNonZeroCoordinates()
         coordinates_input_pos = image_input_pos.getNonZeroCoordinates()
@@ -314,22 +311,13 @@ class ProcessLabels(object):
         output_image = self.image_input.copy()
         output_image.data *= 0
 
-        # 1. Extraction of coordinates from all non-null voxels in the image. Coordinates are sorted by value.
-        coordinates = self.image_input.getNonZeroCoordinates(sorting='value')
-
-        # 2. Separate all coordinates into groups by value
-        groups = dict()
-        for coord in coordinates:
-            if coord.value in groups:
-                groups[coord.value].append(coord)
-            else:
-                groups[coord.value] = [coord]
+        # 1. Compute the center of mass of each group of voxels with the same value (sorted by value)
+        centers_of_mass = self.image_input.getCoordinatesAveragedByValue(as_array=True)
 
-        # 3. Compute the center of mass of each group of voxels and write them into the output image
-        for value, list_coord in groups.iteritems():
-            center_of_mass = sum(list_coord) / float(len(list_coord))
-            sct.printv("Value = " + str(center_of_mass.value) + " : (" + str(center_of_mass.x) + ", " + str(center_of_mass.y) + ", " + str(center_of_mass.z) + ") --> ( " + str(round(center_of_mass.x)) + ", " + str(round(center_of_mass.y)) + ", " + str(round(center_of_mass.z)) + ")", verbose=self.verbose)
-            output_image.data[int(round(center_of_mass.x)), int(round(center_of_mass.y)), int(round(center_of_mass.z))] = center_of_mass.value
+        # 2. Write them into the output image
+        for x, y, z, value in centers_of_mass:
+            sct.printv("Value = " + str(value) + " : (" + str(x) + ", " + str(y) + ", " + str(z) + ") --> ( " + str(round(x)) + ", " + str(round(y)) + ", " + str(round(z)) + ")", verbose=self.verbose)
+            output_image.data[int(round(x)), int(round(y)), int(round(z))] = value
 
         return output_image
 
@@ -340,11 +328,10 @@ class ProcessLabels(object):
         """
         image_output = Image(self.image_input, self.verbose)
         image_output.data *= 0
-        coordinates_input = self.image_input.getNonZeroCoordinates(sorting='z', reverse_coord=True)
+        coordinates_input = self.image_input.getNonZeroCoordinates(sorting='z', reverse_coord=True, as_array=True)
+        x, y, z = coordinates_input[:, :3].astype(int).T
 
-        # for all points with non-zeros neighbors, force the neighbors to 0
-        for i, coord in enumerate(coordinates_input):
-            image_output.data[int(coord.x), int(coord.y), int(coord.z)] = i + 1
+        image_output.data[x, y, z] = np.arange(1, len(coordinates_input) + 1)
 
         return image_output
 
@@ -357,14 +344,14 @@ class ProcessLabels(object):
         """
         image_output = Image(self.image_input, self.verbose)
         image_output.data *= 0
-        coordinates_input = self.image_input.getNonZeroCoordinates()
-        coordinates_ref = self.image_ref.getNonZeroCoordinates(sorting='value')
+        coordinates_input = self.image_input.getNonZeroCoordinates(as_array=True)
+        coordinates_ref = self.image_ref.getNonZeroCoordinates(sorting='value', as_array=True)
+        x, y, z = coordinates_input[:, :3].astype(int).T
 
         # for all points in input, find the value that has to be set up, depending on the vertebral level
-        for i, coord in enumerate(coordinates_input):
-            for j in range(0, len(coordinates_ref) - 1):
-                if coordinates_ref[j + 1].z < coord.z <= coordinates_ref[j].z:
-                    image_output.data[int(coord.x), int(coord.y), int(coord.z)] = coordinates_ref[j].value
+        for j in range(0, len(coordinates_ref) - 1):
+            in_level = (coordinates_ref[j + 1, 2] < z) & (z <= coordinates_ref[j, 2])
+            image_output.data[x[in_level], y[in_level], z[in_level]] = coordinates_ref[j, 3]
 
         return image_output
 
@@ -708,11 +695,13 @@ class ProcessLabels(object):
 
         # 3. saving data
         # for each slice, get all non-zero pixels and replace with continuous values
-        coordinates_input = self.image_input.getNonZeroCoordinates()
+        coordinates_input = self.image_input.getNonZeroCoordinates(as_array=True)
+        x, y, z = coordinates_input[:, :3].astype(int).T
         im_output.changeType('float32')
         # for all points in input, find the value that has to be set up, depending on the vertebral level
-        for i, coord in enumerate(coordinates_input):
-            im_output.data[int(coord.x), int(coord.y), int(coord.z)] = continuous_values[coord.z]
+        slices, index_slices = np.unique(z, return_inverse=True)
+        values_slices = np.array([continuous_values[iz] for iz in slices])
+        im_output.data[x, y, z] = values_slices[index_slices]
 
         return im_output
 
@@ -21,7 +21,6 @@ import sys
 import os
 import shutil
 import numpy as np
-from sct_maths import mutual_information
 from msct_parser import Parser
 from msct_image import Image
 import sct_image
@@ -51,6 +50,7 @@ class Param:
         self.size_IS = 19  # window size in IS direction (=z) (in voxel)
         self.shift_AP_visu = 15  #0#15  # shift AP for displaying disc values
         self.smooth_factor = [3, 1, 1]  # [3, 1, 1]
+        self.metric = 'mi'  # similarity between subject and template patterns: 'mi' (mutual information), 'corr' (normalized cross-correlation)
 
     # update constructor with user's parameters
     def update(self, param_user):
@@ -59,7 +59,17 @@ class Param:
             if len(object) < 2:
                 sct.printv('ERROR: Wrong usage.', 1, type='error')
             obj = object.split('=')
-            setattr(self, obj[0], int(obj[1]))
+            if obj[0] == 'metric':
+                if obj[1] not in ['mi', 'corr']:
+                    sct.printv('ERROR: metric should be mi or corr.', 1, type='error')
+                self.metric = obj[1]
+            elif obj[0] == 'smooth_factor':
+                # one sigma for all the axes, or one sigma per axis (e.g. 3x1x1)
+                smooth_factor = [float(sigma) for sigma in obj[1].split('x')]
+                self.smooth_factor = smooth_factor[0] if len(smooth_factor) == 1 else smooth_factor
+            else:
+                # sizes and shifts (in voxel)
+                setattr(self, obj[0], int(obj[1]))
 
 
 # PARSER
@@ -144,7 +154,9 @@ sct_label_vertebrae -i t2.nii.gz -s t2_seg_manual.nii.gz  "$(< init_label_verteb
                                   "shift_AP [mm]: AP shift of centerline for disc search. Default=" + str(param_default.shift_AP) + ".\n"
                                   "size_AP [mm]: AP window size for disc search. Default=" + str(param_default.size_AP) + ".\n"
                                   "size_RL [mm]: RL window size for disc search. Default=" + str(param_default.size_RL) + ".\n"
-                                  "size_IS [mm]: IS window size for disc search. Default=" + str(param_default.size_IS) + ".\n",
+                                  "size_IS [mm]: IS window size for disc search. Default=" + str(param_default.size_IS) + ".\n"
+                                  "smooth_factor: sigma of the Gaussian smoothing of the image, for all the axes or for each axis (e.g. 3x1x1). Default=" + 'x'.join([str(sigma) for sigma in param_default.smooth_factor]) + ".\n"
+                                  "metric {mi, corr}: similarity between subject and template patterns. Default=" + param_default.metric + ".\n",
                       mandatory = False)
     parser.add_option(name="-r",
                       type_value="multiple_choice",
@@ -455,7 +467,7 @@ def vertebral_detection(fname, fname_seg, contrast, param, init_disc=[], verbose
         sct.printv('\nDetect C2/C3 disk...', verbose)
         zrange = range(0, nz)
         ind_c2 = list_disc_value_template.index(2)
-        z_peak = compute_corr_3d(src=data, target=data_template, x=xc, xshift=0, xsize=param.size_RL_initc2, y=yc, yshift=param.shift_AP_initc2, ysize=param.size_AP_initc2, z=0, zshift=param.shift_IS_initc2, zsize=param.size_IS_initc2, xtarget=xct, ytarget=yct, ztarget=list_disc_z_template[ind_c2], zrange=zrange, verbose=verbose, save_suffix='_initC2', gaussian_weighting=True, path_output=path_output)
+        z_peak = compute_corr_3d(src=data, target=data_template, x=xc, xshift=0, xsize=param.size_RL_initc2, y=yc, yshift=param.shift_AP_initc2, ysize=param.size_AP_initc2, z=0, zshift=param.shift_IS_initc2, zsize=param.size_IS_initc2, xtarget=xct, ytarget=yct, ztarget=list_disc_z_template[ind_c2], zrange=zrange, verbose=verbose, save_suffix='_initC2', gaussian_weighting=True, path_output=path_output, metric=param.metric)
         init_disc = [z_peak, 2]
 
     # if manual mode, open viewer for user to click on C2/C3 disc
@@ -514,6 +526,8 @@ def vertebral_detection(fname, fname_seg, contrast, param, init_disc=[], verbose
     list_disc_z = []
     list_disc_value = []
     zrange = range(-10, 10)
+    # template patterns are the same when a disc is searched again (e.g., init disc when changing direction)
+    pattern_cache = {}
     direction = 'superior'
     search_next_disc = True
     while search_next_disc:
@@ -528,7 +542,7 @@ def vertebral_detection(fname, fname_seg, contrast, param, init_disc=[], verbose
         # find next disc
         # N.B. Do not search for C1/C2 disc (because poorly visible), use template distance instead
         if not current_disc in [1]:
-            current_z = compute_corr_3d(src=data, target=data_template, x=xc, xshift=0, xsize=param.size_RL, y=yc, yshift=param.shift_AP, ysize=param.size_AP, z=current_z, zshift=0, zsize=param.size_IS, xtarget=xct, ytarget=yct, ztarget=current_z_template, zrange=zrange, verbose=verbose, save_suffix='_disc' + str(current_disc), gaussian_weighting=False, path_output=path_output)
+            current_z = compute_corr_3d(src=data, target=data_template, x=xc, xshift=0, xsize=param.size_RL, y=yc, yshift=param.shift_AP, ysize=param.size_AP, z=current_z, zshift=0, zsize=param.size_IS, xtarget=xct, ytarget=yct, ztarget=current_z_template, zrange=zrange, verbose=verbose, save_suffix='_disc' + str(current_disc), gaussian_weighting=False, path_output=path_output, metric=param.metric, pattern_cache=pattern_cache)
 
         # display new disc
         if verbose == 2:
@@ -699,9 +713,10 @@ def clean_labeled_segmentation(fname_labeled_seg, fname_seg, fname_labeled_seg_n
     im_label.save()
 
 
-def compute_corr_3d(src=[], target=[], x=0, xshift=0, xsize=0, y=0, yshift=0, ysize=0, z=0, zshift=0, zsize=0, xtarget=0, ytarget=0, ztarget=0, zrange=[], verbose=1, save_suffix='', gaussian_weighting=True, path_output='../'):
+def compute_corr_3d(src=[], target=[], x=0, xshift=0, xsize=0, y=0, yshift=0, ysize=0, z=0, zshift=0, zsize=0, xtarget=0, ytarget=0, ztarget=0, zrange=[], verbose=1, save_suffix='', gaussian_weighting=True, path_output='../', metric='mi', pattern_cache=None):
     """
     Find z that maximizes correlation between src and target 3d data.
+    All z-shifts are evaluated at once (see get_sliding_chunks and compute_metric_chunks).
     :param src: 3d source data
     :param target: 3d target data
     :param x:
@@ -719,80 +734,41 @@ def compute_corr_3d(src=[], target=[], x=0, xshift=0, xsize=0, y=0, yshift=0, ys
     :param zrange:
     :param verbose:
     :param save_suffix:
+    :param metric: {'mi', 'corr'}: mutual information or normalized cross-correlation
+    :param pattern_cache: dict used to store template patterns between calls. None: no cache
     :return:
     """
     # parameters
     thr_corr = 0.2  # disc correlation threshold. Below this value, use template distance.
     # get dimensions from src
     nx, ny, nz = src.shape
-    # Get pattern from template
-    pattern = target[
-              xtarget - xsize: xtarget + xsize + 1,
-              ytarget + yshift - ysize: ytarget + yshift + ysize + 1,
-              ztarget + zshift - zsize: ztarget + zshift + zsize + 1]
-    pattern1d = pattern.ravel()
+    # Get pattern from template (the pattern only depends on the disc: it is cached across calls)
+    key_pattern = (xtarget, xsize, ytarget + yshift, ysize, ztarget + zshift, zsize, metric)
+    if pattern_cache is not None and key_pattern in pattern_cache:
+        pattern, pattern_feature = pattern_cache[key_pattern]
+    else:
+        pattern = target[
+                  xtarget - xsize: xtarget + xsize + 1,
+                  ytarget + yshift - ysize: ytarget + yshift + ysize + 1,
+                  ztarget + zshift - zsize: ztarget + zshift + zsize + 1]
+        pattern_feature = get_pattern_feature(pattern.ravel(), metric)
+        if pattern_cache is not None:
+            pattern_cache[key_pattern] = pattern, pattern_feature
+    # get subject patterns for all z in zrange (padded with zeros outside the image), as a (len(zrange), size) array
+    data_chunk2d = get_sliding_chunks(src, x, xsize, y + yshift, ysize, z, zsize, zrange)
     # initializations
     I_corr = np.zeros(len(zrange))
     allzeros = 0
-    # current_z = 0
-    ind_I = 0
-    # loop across range of z defined by src
-    for iz in zrange:
-        # if pattern extends towards the top part of the image, then crop and pad with zeros
-        if z + iz + zsize + 1 > nz:
-            # print 'iz='+str(iz)+': padding on top'
-            padding_size = z + iz + zsize + 1 - nz
-            data_chunk3d = src[
-                           x - xsize: x + xsize + 1,
-                           y + yshift - ysize: y + yshift + ysize + 1,
-                           z + iz - zsize: z + iz + zsize + 1 - padding_size]
-            data_chunk3d = np.pad(data_chunk3d, ((0, 0), (0, 0), (0, padding_size)), 'constant',
-                                  constant_values=0)
-        # if pattern extends towards bottom part of the image, then crop and pad with zeros
-        elif z + iz - zsize < 0:
-            # print 'iz='+str(iz)+': padding at bottom'
-            padding_size = abs(iz - zsize)
-            data_chunk3d = src[
-                           x - xsize: x + xsize + 1,
-                           y + yshift - ysize: y + yshift + ysize + 1,
-                           z + iz - zsize + padding_size: z + iz + zsize + 1]
-            data_chunk3d = np.pad(data_chunk3d, ((0, 0), (0, 0), (padding_size, 0)), 'constant',
-                                  constant_values=0)
-        else:
-            # print 'iz='+str(iz)+': no padding'
-            data_chunk3d = src[
-                           x - xsize: x + xsize + 1,
-                           y + yshift - ysize: y + yshift + ysize + 1,
-                           z + iz - zsize: z + iz + zsize + 1]
-        # if verbose == 2 and iz in range(0, nz, 10):
-        #     # display template and subject patterns
-        #     plt.figure(11)
-        #     plt.subplot(131)
-        #     plt.imshow(np.flipud(np.mean(pattern[:, :, :], axis=0).transpose()), origin='upper',
-        #                cmap=plt.cm.gray,
-        #                interpolation='none')
-        #     plt.title('Template pattern')
-        #     plt.subplot(132)
-        #     plt.imshow(np.flipud(np.mean(data_chunk3d[:, :, :], axis=0).transpose()), origin='upper',
-        #                cmap=plt.cm.gray,
-        #                interpolation='none')
-        #     plt.title('Subject pattern at iz=0')
-        #     # save figure
-        #     plt.figure(11), plt.savefig('../fig_pattern'+save_suffix+'_z'+str(iz)+'.png'), plt.close()
-        # convert subject pattern to 1d
-        data_chunk1d = data_chunk3d.ravel()
-        # check if data_chunk1d contains at least one non-zero value
-        # if np.any(data_chunk1d): --> old code which created issue #794 (jcohenadad 2016-04-05)
-        if (data_chunk1d.size == pattern1d.size) and np.any(data_chunk1d):
-            #I_corr[ind_I] = np.corrcoef(data_chunk1d, pattern1d)[0, 1]
-            # data_chunk2d = np.mean(data_chunk3d, 1)
-            # pattern2d = np.mean(pattern, 1)
-            I_corr[ind_I] = mutual_information(data_chunk1d, pattern1d, nbins=16, normalized=False)
-        else:
-            allzeros = 1
-            # sct.printv('.. WARNING: iz='+str(iz)+': Data only contains zero. Set correlation to 0.', verbose)
-        ind_I = ind_I + 1
-    # ind_y = ind_y + 1
+    # if the window is cropped along x or y (edge of the image), all patterns are considered as empty
+    # (see issue #794)
+    if data_chunk2d.shape[1] == pattern.size:
+        # only compute the metric on patterns that contain at least one non-zero value
+        ind_nonzero = np.any(data_chunk2d, axis=1)
+        allzeros = int(not ind_nonzero.all())
+        if ind_nonzero.any():
+            I_corr[ind_nonzero] = compute_metric_chunks(data_chunk2d[ind_nonzero], pattern_feature, metric)
+    else:
+        allzeros = 1
     if allzeros:
         sct.printv('.. WARNING: Data contained zero. We probably hit the edge of the image.', verbose)
 
@@ -854,6 +830,91 @@ def compute_corr_3d(src=[], target=[], x=0, xshift=0, xsize=0, y=0, yshift=0, ys
     return z + zrange[ind_peak] - zshift
 
 
+def get_sliding_chunks(src, x, xsize, y, ysize, z, zsize, zrange):
+    """
+    Extract the 3d chunks src[x-xsize:x+xsize+1, y-ysize:y+ysize+1, z+iz-zsize:z+iz+zsize+1] for all iz in zrange.
+    Chunks that extend outside the image along z are padded with zeros.
+    :return: 2d array (len(zrange), chunk size), each row is a raveled chunk
+    """
+    from numpy.lib.stride_tricks import as_strided
+    nz = src.shape[2]
+    zrange = np.asarray(zrange)
+    # z-extent of all chunks, and corresponding padding
+    zmin, zmax = z + zrange.min() - zsize, z + zrange.max() + zsize + 1
+    padding_bottom, padding_top = max(0, -zmin), max(0, zmax - nz)
+    data_block = src[x - xsize: x + xsize + 1, y - ysize: y + ysize + 1, max(zmin, 0): min(zmax, nz)]
+    if padding_bottom or padding_top:
+        data_block = np.pad(data_block, ((0, 0), (0, 0), (padding_bottom, padding_top)), 'constant', constant_values=0)
+    # sliding window along z (view, no copy): (nx, ny, nb_windows, 2 * zsize + 1)
+    nx_block, ny_block, nz_block = data_block.shape
+    length = 2 * zsize + 1
+    windows = as_strided(data_block, shape=(nx_block, ny_block, max(nz_block - length + 1, 0), length),
+                         strides=data_block.strides + (data_block.strides[2],))
+    # select windows from zrange, and ravel each chunk in the same order as the template pattern
+    windows = windows[:, :, zrange - zrange.min(), :]
+    return np.rollaxis(windows, 2).reshape(len(zrange), -1)
+
+
+def get_pattern_feature(pattern1d, metric='mi', nbins=16):
+    """
+    Pre-compute the part of the metric that only depends on the template pattern.
+    :return: 'mi': binned pattern. 'corr': standardized pattern
+    """
+    if metric == 'mi':
+        return digitize_rows(pattern1d[np.newaxis, :], nbins)[0]
+    elif metric == 'corr':
+        pattern1d = pattern1d - pattern1d.mean()
+        return pattern1d / max(np.linalg.norm(pattern1d), np.finfo(float).tiny)
+    else:
+        sct.printv('ERROR: metric ' + str(metric) + ' is not supported. Use mi or corr.', 1, 'error')
+
+
+def digitize_rows(data2d, nbins):
+    """
+    Bin each row of data2d in nbins between its min and max, with the same bin edges as numpy.histogram2d: the last
+    bin includes its right edge, and a constant row is binned in [value - 0.5, value + 0.5].
+    :return: int array of bin indices (same shape as data2d)
+    """
+    bins = np.empty(data2d.shape, dtype=int)
+    for i, row in enumerate(data2d):
+        row_min, row_max = row.min(), row.max()
+        if row_min == row_max:
+            row_min, row_max = row_min - 0.5, row_max + 0.5
+        edges = np.linspace(row_min, row_max, nbins + 1)
+        bins[i] = np.searchsorted(edges, row, side='right') - 1
+        # maximum value goes into the last bin
+        bins[i][row == edges[-1]] = nbins - 1
+    return bins
+
+
+def compute_metric_chunks(data_chunk2d, pattern_feature, metric='mi', nbins=16):
+    """
+    Compute the similarity between each row of data_chunk2d and the template pattern.
+    'mi' is the same as sct_maths.mutual_information(row, pattern, nbins=16), with the joint histograms of all rows
+    computed in one pass.
+    :param data_chunk2d: 2d array (nb_chunks, chunk size)
+    :param pattern_feature: output of get_pattern_feature()
+    :return: 1d array (nb_chunks)
+    """
+    nb_chunks = data_chunk2d.shape[0]
+    if metric == 'corr':
+        data_chunk2d = data_chunk2d - data_chunk2d.mean(axis=1)[:, np.newaxis]
+        norm = np.sqrt(np.sum(data_chunk2d ** 2, axis=1))
+        norm[norm == 0] = np.inf
+        return np.dot(data_chunk2d, pattern_feature) / norm
+    # joint histogram of each chunk with the pattern: (nb_chunks, nbins, nbins)
+    bins_chunk = digitize_rows(data_chunk2d, nbins)
+    ind_joint = (np.arange(nb_chunks)[:, np.newaxis] * nbins + bins_chunk) * nbins + pattern_feature
+    c_xy = np.bincount(ind_joint.ravel(), minlength=nb_chunks * nbins * nbins).reshape(nb_chunks, nbins, nbins)
+    # mutual information (natural logarithm, as sklearn.metrics.mutual_info_score)
+    p_xy = c_xy / c_xy.sum(axis=(1, 2)).astype(float)[:, np.newaxis, np.newaxis]
+    p_x_p_y = p_xy.sum(axis=2)[:, :, np.newaxis] * p_xy.sum(axis=1)[:, np.newaxis, :]
+    ind_nonzero = p_xy > 0
+    mi = np.zeros(p_xy.shape)
+    mi[ind_nonzero] = p_xy[ind_nonzero] * np.log(p_xy[ind_nonzero] / p_x_p_y[ind_nonzero])
+    return mi.sum(axis=(1, 2))
+
+
 def label_segmentation(fname_seg, list_disc_z, list_disc_value, verbose=1):
     """
     Label segmentation image
@@ -42,6 +42,7 @@ class Param:
         self.remove_temp_files = 1  # remove temporary files
         self.fname_mask = ''  # this field is needed in the function register@sct_register_multimodal
         self.padding = 10  # this field is needed in the function register@sct_register_multimodal
+        self.nb_cpu = None  # this field is needed in the function register@sct_register_multimodal
         self.verbose = 1  # verbose
         self.path_template = path_sct+'/data/PAM50'
         self.path_qc = os.path.abspath(os.curdir)+'/qc/'
@@ -15,9 +15,11 @@ import sys
 import numpy as np
 from msct_parser import Parser
 from msct_image import Image
-from sct_utils import printv, extract_fname
+from sct_utils import printv, extract_fname, add_suffix
 
 ALMOST_ZERO = 0.000000001
+# statistics available with -tstats (besides percentiles: 'pXX')
+LIST_TEMPORAL_STATS = ['mean', 'std', 'var', 'tsnr', 'min', 'max']
 
 
 class Param:
@@ -77,6 +79,11 @@ def get_parser():
                       description='Compute STD across dimension.',
                       mandatory=False,
                       example=['x', 'y', 'z', 't'])
+    parser.add_option(name='-tstats',
+                      type_value=[[','], 'str'],
+                      description='Compute statistics across time of 4D data, in a single pass over the time series: only a few volumes are loaded at once. Separate with ",". Available statistics: ' + ', '.join(LIST_TEMPORAL_STATS) + ', pXX (XX-th percentile, e.g. p50). If several statistics are requested, one file is created for each statistic, with the statistic name as suffix of the output file name.',
+                      mandatory=False,
+                      example='mean,std,tsnr')
     parser.add_option(name="-bin",
                       type_value='float',
                       description='Binarize image using specified threshold. E.g. -bin 0.5',
@@ -190,12 +197,33 @@ def main(args = None):
     verbose = int(arguments['-v'])
 
     # Open file(s)
-    im = Image(fname_in)
+    if '-tstats' in arguments:
+        # time series are read by chunks of volumes
+        im = Image(fname_in, mmap=True)
+    else:
+        im = Image(fname_in)
     data = im.data  # 3d or 4d numpy array
     dim = im.dim
 
     # run command
-    if '-otsu' in arguments:
+    if '-tstats' in arguments:
+        list_stats = arguments['-tstats']
+        for stat in list_stats:
+            if stat not in LIST_TEMPORAL_STATS and not is_percentile(stat):
+                printv(parser.usage.generate(error='ERROR: -tstats: unknown statistic: ' + stat))
+        dict_stats = temporal_stats(data, list_stats)
+        list_fname_out = []
+        for stat in list_stats:
+            fname_stat = fname_out if len(list_stats) == 1 else add_suffix(fname_out, '_' + stat)
+            # use header of input file
+            im_stat = Image(param=dict_stats[stat], hdr=im.hdr.copy(), orientation=im.orientation, absolutepath=fname_stat, dim=dim)
+            im_stat.save()
+            list_fname_out.append(fname_stat)
+        printv('\nDone! To view results, type:', verbose)
+        printv('fslview ' + ' '.join(list_fname_out) + ' &\n', verbose, 'info')
+        return
+
+    elif '-otsu' in arguments:
         param = arguments['-otsu']
         data_out = otsu(data, param)
 
@@ -492,6 +520,70 @@ def concatenate_along_4th_dimension(data1, data2):
     return np.concatenate((data1, data2), axis=3)
 
 
+def is_percentile(stat):
+    """
+    Check if a statistic name is a percentile, e.g.: 'p50'
+    """
+    try:
+        return stat[0] == 'p' and 0 <= float(stat[1:]) <= 100
+    except ValueError:
+        return False
+
+
+def temporal_stats(data, list_stats, chunk_size=10):
+    """
+    Compute statistics across time (4th dimension) of data, walking the time axis by chunks of volumes: mean and
+    variance are merged chunk by chunk (Welford's online algorithm, as generalized by Chan et al. for chunks).
+    If data is memory-mapped, only chunk_size volumes are loaded at once.
+    Percentiles need all time points of a voxel: they are computed slice by slice (along z).
+    :param data: 3d or 4d array
+    :param list_stats: list of statistics among LIST_TEMPORAL_STATS or 'pXX' (XX-th percentile)
+    :param chunk_size: number of volumes loaded at once
+    :return: dict of 3d arrays, with statistic names as keys
+    """
+    if len(np.shape(data)) == 3:
+        data = data[..., np.newaxis]
+    nt = data.shape[3]
+    n = 0
+    data_mean = np.zeros(data.shape[:3])
+    data_m2 = np.zeros(data.shape[:3])  # sum of squared differences to the mean
+    data_min, data_max = None, None
+    for t in range(0, nt, chunk_size):
+        chunk = np.asarray(data[..., t:t + chunk_size], dtype=float)
+        n_chunk = chunk.shape[3]
+        mean_chunk = np.mean(chunk, axis=3)
+        m2_chunk = np.sum(np.square(chunk - mean_chunk[..., np.newaxis]), axis=3)
+        delta = mean_chunk - data_mean
+        data_mean += delta * n_chunk / float(n + n_chunk)
+        data_m2 += m2_chunk + np.square(delta) * n * n_chunk / float(n + n_chunk)
+        n += n_chunk
+        if data_min is None:
+            data_min, data_max = np.min(chunk, axis=3), np.max(chunk, axis=3)
+        else:
+            data_min, data_max = np.minimum(data_min, np.min(chunk, axis=3)), np.maximum(data_max, np.max(chunk, axis=3))
+    data_var = data_m2 / n
+
+    dict_stats = {}
+    for stat in list_stats:
+        if stat == 'mean':
+            dict_stats[stat] = data_mean
+        elif stat == 'std':
+            dict_stats[stat] = np.sqrt(data_var)
+        elif stat == 'var':
+            dict_stats[stat] = data_var
+        elif stat == 'tsnr':
+            dict_stats[stat] = data_mean / np.sqrt(data_var)
+        elif stat == 'min':
+            dict_stats[stat] = data_min
+        elif stat == 'max':
+            dict_stats[stat] = data_max
+        elif is_percentile(stat):
+            dict_stats[stat] = np.zeros(data.shape[:3])
+            for iz in range(data.shape[2]):
+                dict_stats[stat][:, :, iz] = np.percentile(np.asarray(data[:, :, iz, :], dtype=float), float(stat[1:]), axis=2)
+    return dict_stats
+
+
 def denoise_nlmeans(data_in, patch_radius=1, block_radius=5):
     """
     data_in: nd_array to denoise
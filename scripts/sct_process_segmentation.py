@@ -614,33 +614,72 @@ def extract_centerline(fname_segmentation, remove_temp_files, verbose = 0, algo_
 
 # compute_csa
 # ==========================================================================================
+def compute_csa_slicewise(data_seg, px, py, centerline_deriv=None, axis_z=(0.0, 0.0, 1.0), verbose=1):
+    """
+    Compute the cross-sectional area (CSA) and the angle of the cord with respect to the z axis, for all slices at once.
+    :param data_seg: segmentation (RPI orientation), coded between 0 and 1 for partial volume effect
+    :param px, py: in-plane voxel size (in mm)
+    :param centerline_deriv: array-like of size (3, nb_slices) with the derivatives of the centerline for each slice
+    between the first and last slices of the segmentation. If None, CSA is not corrected for the angle.
+    :param axis_z: z axis of the image, in the same coordinate system as the derivatives
+    :return: csa (in mm^2), angles (in degrees) and index of the first slice of the segmentation
+    """
+    # Extract min and max index in Z direction
+    Z = np.nonzero(np.any(data_seg > 0, axis=(0, 1)))[0]
+    min_z_index, max_z_index = Z[0], Z[-1]
+    nb_slices = max_z_index - min_z_index + 1
+
+    if centerline_deriv is not None:
+        tangent_vect = np.asarray(centerline_deriv, dtype=np.float64)[:, :nb_slices]
+        if tangent_vect.shape[1] < nb_slices:
+            # in the case of problematic segmentation (e.g., non continuous segmentation often at the extremities), display a warning but do not crash
+            sct.printv('WARNING: Your segmentation does not seem continuous, which could cause wrong estimations at the problematic slices. Please check it, especially at the extremities.', verbose, 'warning')
+            tangent_vect = np.concatenate((tangent_vect, np.repeat(tangent_vect[:, -1:], nb_slices - tangent_vect.shape[1], axis=1)), axis=1)
+        # normalize the tangent vector to the centerline (i.e. its derivative) and compute the angle between the normal
+        # vector of the plane and the vector z
+        tangent_vect = tangent_vect / np.linalg.norm(tangent_vect, axis=0)
+        angles = np.arccos(np.clip(np.dot(np.asarray(axis_z), tangent_vect), -1.0, 1.0))
+    else:
+        angles = np.zeros(nb_slices)
+
+    # compute the number of voxels, assuming the segmentation is coded for partial volume effect between 0 and 1.
+    number_voxels = np.sum(data_seg[:, :, min_z_index:max_z_index + 1], axis=(0, 1))
+
+    # compute CSA, by scaling with voxel size (in mm) and adjusting for oblique plane
+    csa = number_voxels * px * py * np.cos(angles)
+
+    return csa, np.degrees(angles), min_z_index
+
+
+def fill_segmentation_slicewise(data_seg, values, min_z_index):
+    """
+    Replace the value of the voxels of the segmentation by a value per slice.
+    :param data_seg: segmentation (RPI orientation)
+    :param values: value for each slice, starting at slice min_z_index
+    :return: float32 array of the same size as data_seg
+    """
+    values_slices = np.zeros(data_seg.shape[2], dtype=np.float32)
+    values_slices[min_z_index:min_z_index + len(values)] = values
+    return np.where(data_seg > 0, values_slices, data_seg).astype(np.float32)
+
+
 def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_temp_files, step, smoothing_param, figure_fit, slices, vert_levels, fname_vertebral_labeling='', algo_fitting='hanning', type_window='hanning', window_length=80, angle_correction=True, use_phys_coord=True):
 
-    from math import degrees
     import pandas as pd
     import pickle
 
+    from sct_image import reorient_image
+
     # Extract path, file and extension
     fname_segmentation = os.path.abspath(fname_segmentation)
     # path_data, file_data, ext_data = sct.extract_fname(fname_segmentation)
 
-    # create temporary folder
-    sct.printv('\nCreate temporary folder...', verbose)
-    path_tmp = sct.slash_at_the_end('tmp.' + time.strftime("%y%m%d%H%M%S") + '_' + str(randint(1, 1000000)), 1)
-    sct.run('mkdir ' + path_tmp, verbose)
-
-    # Copying input data to tmp folder
-    sct.printv('\nCopying input data to tmp folder and convert to nii...', verbose)
-    sct.run('sct_convert -i ' + fname_segmentation + ' -o ' + path_tmp + 'segmentation.nii.gz', verbose)
-    # go to tmp folder
-    os.chdir(path_tmp)
-    # Change orientation of the input segmentation into RPI
-    sct.printv('\nChange orientation to RPI...', verbose)
-    sct.run('sct_image -i segmentation.nii.gz -setorient RPI -o segmentation_RPI.nii.gz', verbose)
-
-    # Open segmentation volume
-    sct.printv('\nOpen segmentation volume...', verbose)
-    im_seg = Image('segmentation_RPI.nii.gz')
+    # Open segmentation volume and change its orientation into RPI, in memory (no temporary files are created:
+    # remove_temp_files is not used)
+    sct.printv('\nOpen segmentation volume and change orientation to RPI...', verbose)
+    im_seg_original = Image(fname_segmentation)
+    orientation = im_seg_original.orientation
+    im_seg = reorient_image(im_seg_original, 'RPI')
     data_seg = im_seg.data
     # hdr_seg = im_seg.hdr
 
@@ -649,13 +688,9 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
     nx, ny, nz, nt, px, py, pz, pt = im_seg.dim
     sct.printv('  ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz), verbose)
 
-    # # Extract min and max index in Z direction
-    X, Y, Z = (data_seg > 0).nonzero()
-    min_z_index, max_z_index = min(Z), max(Z)
-
     if use_phys_coord:
         # fit centerline, smooth it and return the first derivative (in physical space)
-        x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = smooth_centerline('segmentation_RPI.nii.gz', algo_fitting=algo_fitting, type_window=type_window, window_length=window_length, nurbs_pts_number=3000, phys_coordinates=True, verbose=verbose, all_slices=False)
+        x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = smooth_centerline(im_seg, algo_fitting=algo_fitting, type_window=type_window, window_length=window_length, nurbs_pts_number=3000, phys_coordinates=True, verbose=verbose, all_slices=False)
         centerline = Centerline(x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv)
 
         # average centerline coordinates over slices of the image
@@ -669,7 +704,7 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
 
     else:
         # fit centerline, smooth it and return the first derivative (in voxel space but FITTED coordinates)
-        x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = smooth_centerline('segmentation_RPI.nii.gz', algo_fitting=algo_fitting, type_window=type_window, window_length=window_length, nurbs_pts_number=3000, phys_coordinates=False, verbose=verbose, all_slices=True)
+        x_centerline_fit, y_centerline_fit, z_centerline, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = smooth_centerline(im_seg, algo_fitting=algo_fitting, type_window=type_window, window_length=window_length, nurbs_pts_number=3000, phys_coordinates=False, verbose=verbose, all_slices=True)
 
         # correct centerline fitted coordinates according to the data resolution
         x_centerline_fit_rescorr, y_centerline_fit_rescorr, z_centerline_rescorr, x_centerline_deriv_rescorr, y_centerline_deriv_rescorr, z_centerline_deriv_rescorr = x_centerline_fit * px, y_centerline_fit * py, z_centerline * pz, x_centerline_deriv * px, y_centerline_deriv * py, z_centerline_deriv * pz
@@ -682,31 +717,12 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
     # Compute CSA
     sct.printv('\nCompute CSA...', verbose)
 
-    # Empty arrays in which CSA for each z slice will be stored
-    csa = np.zeros(max_z_index - min_z_index + 1)
-    angles = np.zeros(max_z_index - min_z_index + 1)
-
-    for iz in xrange(min_z_index, max_z_index + 1):
-        if angle_correction:
-            # in the case of problematic segmentation (e.g., non continuous segmentation often at the extremities), display a warning but do not crash
-            try:
-                # normalize the tangent vector to the centerline (i.e. its derivative)
-                tangent_vect = normalize(np.array([x_centerline_deriv_rescorr[iz - min_z_index], y_centerline_deriv_rescorr[iz - min_z_index], z_centerline_deriv_rescorr[iz - min_z_index]]))
-
-            except IndexError:
-                sct.printv('WARNING: Your segmentation does not seem continuous, which could cause wrong estimations at the problematic slices. Please check it, especially at the extremities.', type='warning')
-
-            # compute the angle between the normal vector of the plane and the vector z
-            angle = np.arccos(np.vdot(tangent_vect, axis_Z))
-        else:
-            angle = 0.0
-
-        # compute the number of voxels, assuming the segmentation is coded for partial volume effect between 0 and 1.
-        number_voxels = np.sum(data_seg[:, :, iz])
-
-        # compute CSA, by scaling with voxel size (in mm) and adjusting for oblique plane
-        csa[iz - min_z_index] = number_voxels * px * py * np.cos(angle)
-        angles[iz - min_z_index] = degrees(angle)
+    if angle_correction:
+        centerline_deriv = [x_centerline_deriv_rescorr, y_centerline_deriv_rescorr, z_centerline_deriv_rescorr]
+    else:
+        centerline_deriv = None
+    csa, angles, min_z_index = compute_csa_slicewise(data_seg, px, py, centerline_deriv, axis_Z, verbose)
+    max_z_index = min_z_index + len(csa) - 1
 
     sct.printv('\nSmooth CSA across slices...', verbose)
     if smoothing_param:
@@ -730,65 +746,12 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
     else:
         sct.printv('.. No smoothing!', verbose)
 
-    # output volume of csa values
-    sct.printv('\nCreate volume of CSA values...', verbose)
-    data_csa = data_seg.astype(np.float32, copy=False)
-    # loop across slices
-    for iz in range(min_z_index, max_z_index + 1):
-        # retrieve seg pixels
-        x_seg, y_seg = (data_csa[:, :, iz] > 0).nonzero()
-        seg = [[x_seg[i], y_seg[i]] for i in range(0, len(x_seg))]
-        # loop across pixels in segmentation
-        for i in seg:
-            # replace value with csa value
-            data_csa[i[0], i[1], iz] = csa[iz - min_z_index]
-    # replace data
-    im_seg.data = data_csa
-    # set original orientation
-    # TODO: FIND ANOTHER WAY!!
-    # im_seg.change_orientation(orientation) --> DOES NOT WORK!
-    # set file name -- use .gz because faster to write
-    im_seg.setFileName('csa_volume_RPI.nii.gz')
-    im_seg.changeType('float32')
-    # save volume
-    im_seg.save()
-
-    # output volume of csa values
-    sct.printv('\nCreate volume of angle values...', verbose)
-    data_angle = data_seg.astype(np.float32, copy=False)
-    # loop across slices
-    for iz in range(min_z_index, max_z_index + 1):
-        # retrieve seg pixels
-        x_seg, y_seg = (data_angle[:, :, iz] > 0).nonzero()
-        seg = [[x_seg[i], y_seg[i]] for i in range(0, len(x_seg))]
-        # loop across pixels in segmentation
-        for i in seg:
-            # replace value with csa value
-            data_angle[i[0], i[1], iz] = angles[iz - min_z_index]
-    # replace data
-    im_seg.data = data_angle
-    # set original orientation
-    # TODO: FIND ANOTHER WAY!!
-    # im_seg.change_orientation(orientation) --> DOES NOT WORK!
-    # set file name -- use .gz because faster to write
-    im_seg.setFileName('angle_volume_RPI.nii.gz')
-    im_seg.changeType('float32')
-    # save volume
-    im_seg.save()
-
-    # get orientation of the input data
-    im_seg_original = Image('segmentation.nii.gz')
-    orientation = im_seg_original.orientation
-    sct.run('sct_image -i csa_volume_RPI.nii.gz -setorient ' + orientation + ' -o csa_volume_in_initial_orientation.nii.gz')
-    sct.run('sct_image -i angle_volume_RPI.nii.gz -setorient ' + orientation + ' -o angle_volume_in_initial_orientation.nii.gz')
-
-    # come back to parent folder
-    os.chdir('..')
-
-    # Generate output files
-    sct.printv('\nGenerate output files...', verbose)
-    sct.generate_output_file(path_tmp + 'csa_volume_in_initial_orientation.nii.gz', output_folder + 'csa_image.nii.gz')  # extension already included in name_output
-    sct.generate_output_file(path_tmp + 'angle_volume_in_initial_orientation.nii.gz', output_folder + 'angle_image.nii.gz')  # extension already included in name_output
+    # output volumes of csa and angle values, in the orientation of the input segmentation
+    sct.printv('\nCreate volumes of CSA and angle values...', verbose)
+    for values, fname_out in [(csa, 'csa_image.nii.gz'), (angles, 'angle_image.nii.gz')]:
+        im_out = reorient_image(im_seg.view(fill_segmentation_slicewise(data_seg, values, min_z_index)), orientation)
+        im_out.setFileName(output_folder + fname_out)
+        im_out.save(type='float32')
     sct.printv('\n')
 
     # Create output text file
@@ -894,11 +857,6 @@ def compute_csa(fname_segmentation, output_folder, overwrite, verbose, remove_te
     elif (not (slices or vert_levels)) and (overwrite == 1):
         sct.printv('WARNING: Flag \"-overwrite\" is only available if you select (a) slice(s) or (a) vertebral level(s) (flag -z or -vert) ==> CSA estimation per slice will be output in .txt and .pickle files only.', type='warning')
 
-    # Remove temporary files
-    if remove_temp_files:
-        sct.printv('\nRemove temporary files...')
-        sct.run('rm -rf ' + path_tmp, error_exit='warning')
-
     # Sum up the output file names
     sct.printv('\nOutput a nifti file of CSA values along the segmentation: ' + output_folder + 'csa_image.nii.gz', param.verbose, 'info')
     sct.printv('Output result text file of CSA per slice: ' + output_folder + 'csa_per_slice.txt', param.verbose, 'info')
@@ -169,6 +169,11 @@ def get_parser(paramreg=None):
                       mandatory=False,
                       default_value='1',
                       example=['0', '1'])
+    parser.add_option(name="-cpu-nb",
+                      type_value="int",
+                      description="Number of CPU used for slicewise registration (ANTs algorithms with slicewise=1). 0: no multiprocessing. If not provided, it uses all the available cores.",
+                      mandatory=False,
+                      example="8")
     parser.add_option(name="-v",
                       type_value="multiple_choice",
                       description="""Verbose.""",
@@ -188,6 +193,7 @@ class Param:
         self.outSuffix  = "_reg"
         self.padding = 5
         self.path_qc = os.path.abspath(os.curdir) + '/qc/'
+        self.nb_cpu = None  # number of processes for slicewise registration. None: all the available cores
 
 # Parameters for registration
 
@@ -327,6 +333,8 @@ def main(args=None):
     interp = arguments['-x']
     remove_temp_files = int(arguments['-r'])
     verbose = int(arguments['-v'])
+    if '-cpu-nb' in arguments:
+        param.nb_cpu = arguments['-cpu-nb']
 
     # print arguments
     print '\nInput parameters:'
@@ -676,7 +684,8 @@ def register(src, dest, paramreg, param, i_step_str):
                                warp_inverse_out=warp_inverse_out,
                                ants_registration_params=ants_registration_params,
                                path_qc=param.path_qc,
-                               verbose=param.verbose)
+                               verbose=param.verbose,
+                               nb_cpu=param.nb_cpu)
 
     # slice-wise transfo
     elif paramreg.steps[i_step_str].algo in ['centermass', 'centermassrot', 'columnwise']:
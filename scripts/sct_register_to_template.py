@@ -43,6 +43,7 @@ class Param:
         self.path_qc = os.path.abspath(os.curdir) + '/qc/'
         self.zsubsample = '0.25'
         self.param_straighten = ''
+        self.nb_cpu = None  # this field is needed in the function register@sct_register_multimodal
 
 
 # get default parameters
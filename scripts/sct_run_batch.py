@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Run a processing pipeline on several subjects. Steps of the pipeline are run as a dependency graph: independent
+# steps and independent subjects are processed concurrently, and steps whose outputs are up to date are skipped.
+#
+# The pipeline is defined in a JSON file, with steps in the order they would be run for one subject (as in
+# batch_processing.sh). Each step has a command, a folder (relative to the subject folder) where it is run, and
+# the files it reads and writes (relative to this folder). A step depends on the previous steps that write one of
+# its inputs, and on the previous steps listed in "after". Steps run in the same folder are run one after the other
+# (scripts name their temporary folders after the current time). When several steps run at once, the cores are shared
+# between them: scripts that use a pool of processes get cpu_count / -cpu-nb cores (environment variable SCT_NB_CPU).
+# Example:
+#
+# {"steps": [
+#   {"name": "seg_t2", "folder": "t2", "cmd": "sct_propseg -i t2.nii.gz -c t2",
+#    "inputs": ["t2.nii.gz"], "outputs": ["t2_seg.nii.gz"]},
+#   {"name": "label_t2", "folder": "t2", "cmd": "sct_label_vertebrae -i t2.nii.gz -s t2_seg.nii.gz -c t2",
+#    "inputs": ["t2.nii.gz", "t2_seg.nii.gz"], "outputs": ["t2_seg_labeled.nii.gz"]},
+#   {"name": "seg_mt", "folder": "mt", "cmd": "sct_propseg -i mt1.nii.gz -c t2 -qc ~/qc/{subject}",
+#    "inputs": ["mt1.nii.gz"], "outputs": ["mt1_seg.nii.gz"]}
+# ]}
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2017 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import sys
+import os
+import json
+import time
+from msct_parser import Parser
+import sct_utils as sct
+
+
+class Param:
+    def __init__(self):
+        self.folder_out = 'batch_results/'
+        self.file_report = 'batch_report.csv'
+        self.force = 0
+        self.verbose = 1
+
+
+class Step:
+    def __init__(self, name, cmd, folder='', inputs=None, outputs=None, after=None):
+        self.name = name
+        self.cmd = cmd
+        self.folder = folder
+        self.inputs = inputs or []
+        self.outputs = outputs or []
+        self.after = after or []
+
+    def get_files(self, files):
+        """
+        :return: files of the step, relative to the subject folder
+        """
+        return [os.path.normpath(os.path.join(self.folder, fname)) for fname in files]
+
+
+def read_pipeline(fname_pipeline):
+    """
+    Read the pipeline definition
+    :param fname_pipeline: JSON file
+    :return: list of Step
+    """
+    with open(fname_pipeline) as f:
+        pipeline = json.load(f)
+    steps = []
+    for i, step in enumerate(pipeline['steps']):
+        if 'cmd' not in step:
+            sct.printv('ERROR: step #' + str(i) + ' of ' + fname_pipeline + ' has no command ("cmd").', 1, 'error')
+        name = str(step.get('name', 'step' + str(i)))
+        if name in [s.name for s in steps]:
+            sct.printv('ERROR: step name ' + name + ' is used more than once in ' + fname_pipeline + '.', 1, 'error')
+        for name_after in step.get('after', []):
+            if name_after not in [s.name for s in steps]:
+                sct.printv('ERROR: step ' + name + ' must be run after ' + name_after + ', which is not a previous step.', 1, 'error')
+        steps.append(Step(name, str(step['cmd']), str(step.get('folder', '')), [str(f) for f in step.get('inputs', [])],
+                          [str(f) for f in step.get('outputs', [])], [str(s) for s in step.get('after', [])]))
+    return steps
+
+
+def get_dependencies(steps):
+    """
+    Build the dependency graph of the pipeline. Steps only depend on previous steps, so the graph has no cycle.
+    :param steps: list of Step
+    :return: dict {step name: set of names of the steps it depends on}
+    """
+    dependencies = {}
+    for i, step in enumerate(steps):
+        inputs = set(step.get_files(step.inputs))
+        dependencies[step.name] = set(step.after)
+        for step_previous in steps[:i]:
+            if inputs.intersection(step_previous.get_files(step_previous.outputs)):
+                dependencies[step.name].add(step_previous.name)
+    return dependencies
+
+
+def get_folder_followers(steps):
+    """
+    Steps run in the same folder are run one after the other, in the order of the pipeline: many scripts name their
+    temporary folder after the current time (to the second), so two steps started at the same time in the same
+    folder would overwrite each other's temporary files.
+    :param steps: list of Step
+    :return: dict {step name: list of names of the steps that wait for it (next step in the same folder)}
+    """
+    followers = dict([(step.name, []) for step in steps])
+    last_step_in_folder = {}
+    for step in steps:
+        folder = os.path.normpath(step.folder)
+        if folder in last_step_in_folder:
+            followers[last_step_in_folder[folder]].append(step.name)
+        last_step_in_folder[folder] = step.name
+    return followers
+
+
+def is_up_to_date(path_subject, step):
+    """
+    Check if all outputs of a step exist and are newer than its inputs.
+    """
+    if not step.outputs:
+        return False
+    fname_outputs = [os.path.join(path_subject, fname) for fname in step.get_files(step.outputs)]
+    fname_inputs = [os.path.join(path_subject, fname) for fname in step.get_files(step.inputs)]
+    if not all([os.path.exists(fname) for fname in fname_outputs]):
+        return False
+    time_inputs = [os.path.getmtime(fname) for fname in fname_inputs if os.path.exists(fname)]
+    return not time_inputs or min([os.path.getmtime(fname) for fname in fname_outputs]) >= max(time_inputs)
+
+
+def run_step(args):
+    """
+    Run the command of a step and measure its wall time and peak memory.
+    :param args: subject, step name, command, folder where to run the command, log file
+    :return: subject, step name, status, wall time (s), peak resident memory of the command (MB)
+    """
+    subject, name, cmd, path_run, fname_log = args
+    start_time = time.time()
+    max_rss = 0.0
+    try:
+        with open(fname_log, 'w') as f_log:
+            f_log.write('# ' + cmd + '\n')
+            f_log.flush()
+            import subprocess
+            process = subprocess.Popen(cmd, shell=True, cwd=path_run, stdout=f_log, stderr=subprocess.STDOUT)
+            # wait4 returns the resources used by the command and the processes it launched
+            pid, status, rusage = os.wait4(process.pid, 0)
+        # ru_maxrss is in kB on Linux and in bytes on OSX
+        max_rss = rusage.ru_maxrss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+        status = 'done' if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0 else 'failed'
+    except Exception, e:
+        status = 'failed (' + str(e) + ')'
+    return subject, name, status, time.time() - start_time, max_rss
+
+
+def run_batch(path_data, subjects, steps, nb_cpu=None, path_log='', force=0, verbose=1):
+    """
+    Run the pipeline on all subjects
+    :param path_data: folder that contains one folder per subject
+    :param subjects: list of subject folder names
+    :param steps: list of Step (see read_pipeline)
+    :param nb_cpu: number of processes. 0 or 1: steps are run one after the other. None: all available cores.
+    When several steps run at once, the scripts of each step use cpu_count() / nb_cpu cores (environment variable
+    SCT_NB_CPU, see sct_utils.get_nb_cpu), unless SCT_NB_CPU is already set.
+    :param path_log: folder where the output of each step is written
+    :param force: if 1, run steps even if their outputs are up to date
+    :return: list of (subject, step name, status, wall time (s), peak memory (MB))
+    """
+    import Queue
+    from multiprocessing import Pool, cpu_count
+
+    dependencies = get_dependencies(steps)
+    followers = get_folder_followers(steps)
+    steps_by_name = dict([(step.name, step) for step in steps])
+    # steps that wait for other steps: steps whose inputs they read, and the previous step in the same folder
+    waiting = dict([((subject, name), set(dependencies[name])) for subject in subjects for name in dependencies])
+    for name in followers:
+        for name_follower in followers[name]:
+            for subject in subjects:
+                waiting[(subject, name_follower)].add(name)
+    dependents = dict([(name, [step.name for step in steps if name in dependencies[step.name]]) for name in dependencies])
+    results = []
+    finished = Queue.Queue()
+
+    nb_cpu = sct.get_nb_cpu(nb_cpu)
+    pool = None
+    if nb_cpu > 1:
+        # All scripts that are using multithreading with ITK must not use it when using multiprocessing
+        os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = '1'
+        # the cores are shared between the steps run at once (scripts that run a pool of processes use SCT_NB_CPU)
+        if 'SCT_NB_CPU' not in os.environ:
+            os.environ['SCT_NB_CPU'] = str(max(1, cpu_count() / nb_cpu))
+        pool = Pool(processes=nb_cpu, initializer=sct.init_worker)
+
+    def start(subject, name):
+        step = steps_by_name[name]
+        path_subject = os.path.join(path_data, subject)
+        if not force and is_up_to_date(path_subject, step):
+            finished.put((subject, name, 'skipped', 0.0, 0.0))
+            return
+        sct.printv('  ' + subject + ': ' + name + '...', verbose)
+        args = (subject, name, step.cmd.replace('{subject}', subject), os.path.join(path_subject, step.folder), os.path.join(path_log, subject + '_' + name + '.log'))
+        if pool is None:
+            finished.put(run_step(args))
+        else:
+            pool.apply_async(run_step, (args,), callback=finished.put)
+
+    def release(subject, name, list_names):
+        # the step is finished: start the steps of list_names that only waited for it. Return the number of started steps
+        nb_started = 0
+        for name_next in list_names:
+            if (subject, name_next) in waiting:
+                waiting[(subject, name_next)].discard(name)
+                if not waiting[(subject, name_next)]:
+                    del waiting[(subject, name_next)]
+                    start(subject, name_next)
+                    nb_started += 1
+        return nb_started
+
+    def cancel(subject, name):
+        # a step failed (or was not run): steps that depend on it are not run. The next step in the same folder does
+        # not read its outputs: it can be started. Return the number of started steps
+        nb_started = 0
+        for name_dependent in dependents[name]:
+            if (subject, name_dependent) in waiting:
+                del waiting[(subject, name_dependent)]
+                results.append((subject, name_dependent, 'not run', 0.0, 0.0))
+                nb_started += cancel(subject, name_dependent)
+        return nb_started + release(subject, name, followers[name])
+
+    try:
+        nb_running = 0
+        for (subject, name), deps in waiting.items():
+            if not deps:
+                del waiting[(subject, name)]
+                start(subject, name)
+                nb_running += 1
+        while nb_running:
+            # use a timeout, otherwise KeyboardInterrupt is not caught
+            result = finished.get(True, 9999999)
+            nb_running -= 1
+            results.append(result)
+            subject, name, status = result[:3]
+            if status not in ['done', 'skipped']:
+                sct.printv('WARNING: ' + subject + ': ' + name + ' ' + status + '. See ' + os.path.join(path_log, subject + '_' + name + '.log'), verbose, 'warning')
+                nb_running += cancel(subject, name)
+                continue
+            nb_running += release(subject, name, dependents[name] + followers[name])
+        if pool is not None:
+            pool.close()
+            pool.join()
+    except KeyboardInterrupt:
+        print "\nWarning: Caught KeyboardInterrupt, terminating workers"
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        sys.exit(2)
+
+    # sort results in the order of the pipeline
+    order_steps = dict([(step.name, i) for i, step in enumerate(steps)])
+    results.sort(key=lambda result: (subjects.index(result[0]), order_steps[result[1]]))
+    return results
+
+
+def get_parser():
+    param_default = Param()
+    parser = Parser(__file__)
+    parser.usage.set_description('Run a processing pipeline on several subjects. Steps of the pipeline are organized '
+                                 'as a dependency graph: independent steps and independent subjects are processed '
+                                 'concurrently, and steps whose outputs are newer than their inputs are skipped. '
+                                 'Wall time and peak memory of each step are reported.\n'
+                                 'The pipeline is a JSON file with a list of steps, each with a name, a command (cmd), '
+                                 'a folder in which it is run (relative to the subject folder), and the files it reads '
+                                 '(inputs) and writes (outputs), relative to this folder. A step depends on the previous '
+                                 'steps that write one of its inputs, and on the previous steps listed in "after". Steps run '
+                                 'in the same folder are run one after the other. '
+                                 '{subject} in a command is replaced by the name of the subject. Example:\n'
+                                 '{"steps": [{"name": "seg_t2", "folder": "t2", "cmd": "sct_propseg -i t2.nii.gz -c t2", '
+                                 '"inputs": ["t2.nii.gz"], "outputs": ["t2_seg.nii.gz"]}, ...]}')
+    parser.add_option(name="-d",
+                      type_value="folder",
+                      description="Dataset folder, containing one folder per subject.",
+                      mandatory=True,
+                      example="data/")
+    parser.add_option(name="-p",
+                      type_value="file",
+                      description="Pipeline definition (JSON file).",
+                      mandatory=True,
+                      example="pipeline.json")
+    parser.add_option(name="-subj",
+                      type_value=[[','], 'str'],
+                      description="Subjects to process (names of folders in the dataset). Default: all subjects.",
+                      mandatory=False,
+                      example="subject01,subject02")
+    parser.add_option(name="-cpu-nb",
+                      type_value="int",
+                      description="Number of steps run at once. 0: no multiprocessing. If not provided, "
+                                  "it uses all the available cores. The scripts of each step then use (number of "
+                                  "cores / cpu-nb) processes, unless the environment variable SCT_NB_CPU is set.",
+                      mandatory=False,
+                      example='8')
+    parser.add_option(name="-f",
+                      type_value="multiple_choice",
+                      description="Force running all steps, even if their outputs are up to date.",
+                      mandatory=False,
+                      default_value=str(param_default.force),
+                      example=['0', '1'])
+    parser.add_option(name="-ofolder",
+                      type_value="folder_creation",
+                      description="Output folder for log files and report.",
+                      mandatory=False,
+                      default_value=param_default.folder_out,
+                      example="batch_results")
+    parser.add_option(name="-v",
+                      type_value="multiple_choice",
+                      description="Verbose. 0: nothing, 1: basic.",
+                      mandatory=False,
+                      default_value=str(param_default.verbose),
+                      example=['0', '1'])
+    return parser
+
+
+def main(args=None):
+    if not args:
+        args = sys.argv[1:]
+    parser = get_parser()
+    arguments = parser.parse(args)
+    path_data = sct.slash_at_the_end(arguments['-d'], 1)
+    steps = read_pipeline(arguments['-p'])
+    nb_cpu = arguments['-cpu-nb'] if '-cpu-nb' in arguments else None
+    force = int(arguments['-f'])
+    path_out = sct.slash_at_the_end(arguments['-ofolder'], 1)
+    verbose = int(arguments['-v'])
+
+    if '-subj' in arguments:
+        subjects = arguments['-subj']
+    else:
+        subjects = sorted([subject for subject in os.listdir(path_data) if not subject.startswith('.') and os.path.isdir(path_data + subject)])
+    for subject in subjects:
+        if not os.path.isdir(path_data + subject):
+            sct.printv('ERROR: subject folder ' + path_data + subject + ' does not exist.', 1, 'error')
+
+    path_log = path_out + 'log/'
+    sct.create_folder(path_log)
+
+    sct.printv('\nRun ' + str(len(steps)) + ' steps on ' + str(len(subjects)) + ' subjects...', verbose)
+    start_time = time.time()
+    results = run_batch(path_data, subjects, steps, nb_cpu, path_log, force, verbose)
+
+    # report
+    fname_report = path_out + Param().file_report
+    with open(fname_report, 'w') as f:
+        f.write('subject,step,status,wall time (s),peak memory (MB)\n')
+        for subject, name, status, duration, max_rss in results:
+            f.write('%s,%s,%s,%.2f,%.1f\n' % (subject, name, status, duration, max_rss))
+    sct.printv('\n%-20s %-20s %-10s %12s %12s' % ('Subject', 'Step', 'Status', 'Time (s)', 'Memory (MB)'), verbose)
+    for subject, name, status, duration, max_rss in results:
+        sct.printv('%-20s %-20s %-10s %12.1f %12.1f' % (subject, name, status, duration, max_rss), verbose, 'normal' if status in ['done', 'skipped'] else 'warning')
+    sct.printv('\nFinished! Elapsed time: ' + str(int(round(time.time() - start_time))) + 's', verbose)
+    sct.printv('Report saved in: ' + fname_report, verbose, 'info')
+
+
+if __name__ == "__main__":
+    main()
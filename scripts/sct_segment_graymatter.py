@@ -14,11 +14,12 @@
 '''
 INFORMATION:
 The model used in this function is compound of:
-  - a dictionary: a list of slices of WM/GM contrasted images with their manual segmentations [slices.pklz]
-  - a model representing this dictionary in a reduced space (a PCA or an isomap model as implemented in sk-learn) [fitted_model.pklz]
-  - the dictionary data fitted to this model (i.e. in the model space) [fitted_data.pklz]
-  - the averaged median intensity in the white and gray matter in the model [intensities.pklz]
+  - a dictionary: a list of slices of WM/GM contrasted images with their manual segmentations [im.npy, im_M.npy, gm_seg.npy, wm_seg.npy, gm_seg_M.npy, wm_seg_M.npy, mean_image.npy]
+  - a model representing this dictionary in a reduced space (a PCA or an isomap model as implemented in sk-learn) [fitted_model.pkl]
+  - the dictionary data fitted to this model (i.e. in the model space) [fitted_data.npy]
+  - the averaged median intensity in the white and gray matter in the model, the slice levels and the model format version [model_info.npz]
   - an information file indicating which parameters were used to construct this model, and te date of computation [info.txt]
+Models saved in the former format (gzipped pickles: slices.pklz, fitted_model.pklz, fitted_data.pklz, intensities.pklz) can still be used, or converted with msct_multiatlas_seg -convert-model.
 
 A constructed model is provided in the toolbox here: $PATH_SCT/data/gm_model.
 It's made from T2* images of 80 subjects and computed with the parameters that gives the best gray matter segmentation results.
@@ -45,14 +46,13 @@ import shutil
 import sys
 import time
 import copy
-from math import exp
 
 import numpy as np
 
 import sct_maths
 import sct_process_segmentation
 import sct_register_multimodal
-from msct_gmseg_utils import (apply_transfo, average_gm_wm, binarize,
+from msct_gmseg_utils import (apply_transfo, binarize,
                               normalize_slice, pre_processing, register_data)
 from msct_image import Image
 from msct_multiatlas_seg import Model, Param, ParamData, ParamModel
@@ -135,6 +135,12 @@ def get_parser():
                       mandatory=False,
                       default_value=ParamSeg().thr_similarity,
                       example=0.6)
+    parser.add_option(name="-max-sim",
+                      type_value='int',
+                      description="Maximum number of dictionary slices (the most similar ones) used to segment each slice. 0: no limit",
+                      mandatory=False,
+                      default_value=ParamSeg().max_nb_similar,
+                      example=50)
     parser.add_option(name="-model",
                       type_value="folder",
                       description="Path to the computed model",
@@ -200,6 +206,7 @@ class ParamSeg:
         self.weight_level = 2.5  # gamma
         self.weight_coord = 0.0065  # tau --> need to be validated for specific dataset
         self.thr_similarity = 0.0005  # epsilon but on normalized to 1 similarities (by slice of dic and slice of target)
+        self.max_nb_similar = 0  # maximum number of dictionary slices selected per target slice (0: no limit)
         # TODO = find the best thr
 
         self.type_seg = 'prob'  # 'prob' or 'bin'
@@ -374,44 +381,64 @@ class SegmentGM:
         self.projected_target = projected_target_slices
 
     def compute_similarities(self):
-        list_dic_indexes_by_slice = []
-        for i, target_coord in enumerate(self.projected_target):
-            list_dic_similarities = []
-            for j, dic_coord in enumerate(self.model.fitted_data):
-                # compute square norm using coordinates in the model space
-                square_norm = np.linalg.norm((target_coord - dic_coord), 2)
-                # compute similarity with or without levels
-                if self.param_seg.fname_level is not None:
-                    # EQUATION WITH LEVELS
-                    similarity = exp(-self.param_seg.weight_level * abs(self.target_im[i].level - self.model.slices[j].level)) * exp(-self.param_seg.weight_coord * square_norm)
-                else:
-                    # EQUATION WITHOUT LEVELS
-                    similarity = exp(-self.param_seg.weight_coord * square_norm)
-                # add similarity to list
-                list_dic_similarities.append(similarity)
-            list_norm_similarities = [float(s) / sum(list_dic_similarities) for s in list_dic_similarities]
-            # select indexes of most similar slices
-            list_dic_indexes = []
-            for j, norm_sim in enumerate(list_norm_similarities):
-                if norm_sim >= self.param_seg.thr_similarity:
-                    list_dic_indexes.append(j)
-            # save list of indexes into list by slice
-            list_dic_indexes_by_slice.append(list_dic_indexes)
+        """
+        Similarities between all target slices and all model slices, computed in matrix form.
+        :return: list (one per target slice) of indexes of the most similar model slices
+        """
+        from scipy.spatial.distance import cdist
+        # euclidean distance using coordinates in the model space: (nb target slices, nb model slices)
+        square_norm = cdist(np.asarray(self.projected_target), np.asarray(self.model.fitted_data))
+        # compute similarity with or without levels
+        similarities = np.exp(-self.param_seg.weight_coord * square_norm)
+        if self.param_seg.fname_level is not None:
+            # EQUATION WITH LEVELS
+            level_target = np.array([target_slice.level for target_slice in self.target_im], dtype=float)
+            level_model = np.array([dic_slice.level for dic_slice in self.model.slices], dtype=float)
+            similarities *= np.exp(-self.param_seg.weight_level * np.abs(level_target[:, np.newaxis] - level_model[np.newaxis, :]))
+        # normalize similarities to 1 for each target slice
+        similarities /= np.sum(similarities, axis=1)[:, np.newaxis]
+        # select indexes of most similar slices
+        selection = similarities >= self.param_seg.thr_similarity
+        if self.param_seg.max_nb_similar > 0:
+            # only keep the most similar slices (top-k)
+            ind_top = np.argsort(-similarities, axis=1, kind='mergesort')[:, :self.param_seg.max_nb_similar]
+            mask_top = np.zeros(selection.shape, dtype=bool)
+            mask_top[np.arange(selection.shape[0])[:, np.newaxis], ind_top] = True
+            selection &= mask_top
+        # target slices without any model slice above the threshold: keep the most similar model slice
+        ind_empty = np.where(~np.any(selection, axis=1))[0]
+        if len(ind_empty) > 0:
+            printv('WARNING: No model slice has a similarity above ' + str(self.param_seg.thr_similarity) + ' for target slices ' + str(ind_empty.tolist()) + ': the most similar model slice is used.', self.param.verbose, 'warning')
+            selection[ind_empty, np.argmax(similarities[ind_empty], axis=1)] = True
+        list_dic_indexes_by_slice = [np.where(selection_slice)[0].tolist() for selection_slice in selection]
 
         return list_dic_indexes_by_slice
 
     def label_fusion(self, list_dic_indexes_by_slice):
+        """
+        Average GM segmentations of the selected model slices, for all target slices at once:
+        (target x model selection matrix) . (sum of manual GM segmentations of each model slice)
+        """
+        if not all(list_dic_indexes_by_slice[target_slice.id] for target_slice in self.target_im):
+            printv('ERROR: No model slice was selected for some target slices.', self.param.verbose, 'error')
+        # only model slices selected by at least one target slice are used
+        list_ind_used = sorted(set([j for list_dic_indexes in list_dic_indexes_by_slice for j in list_dic_indexes]))
+        position = dict((j, k) for k, j in enumerate(list_ind_used))
+        # sum and number of manual GM segmentations (in model space) of each model slice
+        sum_gm = np.array([np.sum(self.model.slices[j].gm_seg_M, axis=0) for j in list_ind_used])
+        nb_gm = np.array([len(self.model.slices[j].gm_seg_M) for j in list_ind_used], dtype=float)
+        # selection matrix
+        selection = np.zeros((len(self.target_im), len(list_ind_used)))
         for target_slice in self.target_im:
-            # get list of slices corresponding to the indexes
-            list_dic_slices = [self.model.slices[j] for j in list_dic_indexes_by_slice[target_slice.id]]
-            # average slices GM and WM
-            # WM is not used anymore here, but the average_gm_wm() function is used in other parts of the code that need both the GM and WM averages
-            data_mean_gm, data_mean_wm = average_gm_wm(list_dic_slices)
-            # set negative values to 0
-            data_mean_gm[data_mean_gm < 0] = 0
+            selection[target_slice.id, [position[j] for j in list_dic_indexes_by_slice[target_slice.id]]] = 1
+        # average slices GM (same as msct_gmseg_utils.average_gm_wm(), which gives the same weight to each manual segmentation)
+        data_mean_gm = np.tensordot(selection, sum_gm, axes=1) / np.dot(selection, nb_gm)[:, np.newaxis, np.newaxis]
+        # set negative values to 0
+        data_mean_gm[data_mean_gm < 0] = 0
 
+        for target_slice in self.target_im:
             # store segmentation into target_im
-            target_slice.set(gm_seg_m=data_mean_gm)
+            target_slice.set(gm_seg_m=data_mean_gm[target_slice.id])
 
     def warp_back_seg(self, path_warp):
         # get 3D images from list of slices
@@ -705,6 +732,8 @@ def main(args=None):
         param_seg.weight_coord = arguments['-w-coordi']
     if '-thr-sim' in arguments:
         param_seg.thr_similarity = arguments['-thr-sim']
+    if '-max-sim' in arguments:
+        param_seg.max_nb_similar = arguments['-max-sim']
     if '-model' in arguments:
         param_model.path_model_to_load = os.path.abspath(arguments['-model'])
     if '-res-type' in arguments:
@@ -17,6 +17,8 @@ import shutil
 import time
 import commands
 import sys
+from collections import OrderedDict
+from copy import deepcopy
 from msct_parser import Parser
 from nibabel import Nifti1Image, save
 from scipy import ndimage
@@ -27,8 +29,83 @@ from math import sqrt
 import numpy as np
 
 
+# maximum number of centerlines kept in memory by smooth_centerline
+NB_CENTERLINES_CACHE = 10
+_centerline_cache = OrderedDict()
+
+
+def get_centerline_key(fname_centerline, params):
+    """
+    Key of a centerline in the cache of smooth_centerline: content of the centerline (file or Image) and fitting parameters
+    :param fname_centerline: file name or Image
+    :param params: tuple of the fitting parameters
+    :return: key, or None if the input is not an image
+    """
+    import hashlib
+    from msct_image import Image, is_memory_image
+    if isinstance(fname_centerline, str) and os.path.isfile(fname_centerline) and not is_memory_image(fname_centerline):
+        from msct_cache import hash_file
+        return 'file:' + hash_file(fname_centerline), params
+    if isinstance(fname_centerline, str):
+        fname_centerline = Image(fname_centerline)
+    if isinstance(fname_centerline, Image):
+        data = np.ascontiguousarray(fname_centerline.data)
+        sha1 = hashlib.sha1(data)
+        sha1.update(repr((data.dtype.str, data.shape, list(fname_centerline.dim))))
+        sha1.update(np.ascontiguousarray(fname_centerline.hdr.get_best_affine()))
+        return 'data:' + sha1.hexdigest(), params
+    return None
+
+
+def get_centerline_coordinates(data, remove_outliers=False):
+    """
+    Get the center of mass of the non-empty axial slices of a centerline/segmentation. The masses and weighted sums of
+    all the slices are computed at once on the whole volume.
+    :param data: 3D array
+    :param remove_outliers: remove the slices of each half of the centerline that contain several objects, or whose
+    center of mass is too far from the next slice (towards the middle of the centerline)
+    :return: x_centerline, y_centerline, z_centerline (arrays)
+    """
+    nx, ny, nz = data.shape[:3]
+    # mass of each xz and yz line, then of each slice
+    mass_xz = data.sum(axis=1, dtype=np.float64)
+    mass_yz = data.sum(axis=0, dtype=np.float64)
+    mass_z = mass_xz.sum(axis=0)
+    # N.B. len(z_centerline) can be smaller than nz in case the centerline is smaller than the input volume
+    z_centerline = np.flatnonzero(np.any(data, axis=(0, 1)))
+    x_centerline = np.dot(np.arange(nx), mass_xz[:, z_centerline]) / mass_z[z_centerline]
+    y_centerline = np.dot(np.arange(ny), mass_yz[:, z_centerline]) / mass_z[z_centerline]
+
+    if remove_outliers:
+        nz_nonz = len(z_centerline)
+        # count the objects of each slice: the volume is labeled at once, without connecting the slices
+        structure = np.zeros((3, 3, 3), dtype=int)
+        structure[:, :, 1] = ndimage.generate_binary_structure(2, 1)
+        labeled_array, num_f = ndimage.measurements.label(data, structure)
+        z_objects = [obj[2].start for obj in ndimage.find_objects(labeled_array)]
+        num_features = np.bincount(z_objects, minlength=nz)[z_centerline]
+
+        distances = np.sqrt(np.diff(x_centerline) ** 2 + np.diff(y_centerline) ** 2)
+        mean_distances = np.mean(distances)
+        std_distances = np.std(distances)
+        # distance to the next slice (ascending verification) or to the previous slice (descending verification)
+        distances_neighbour = np.zeros(nz_nonz)
+        distances_neighbour[:nz_nonz / 2] = distances[:nz_nonz / 2]
+        distances_neighbour[nz_nonz / 2 + 1:] = distances[nz_nonz / 2:]
+        is_outlier = (num_features > 1) | (np.abs(distances_neighbour - mean_distances) > 3 * std_distances)
+        is_outlier[nz_nonz / 2:nz_nonz / 2 + 1] = False
+
+        x_centerline = x_centerline[~is_outlier]
+        y_centerline = y_centerline[~is_outlier]
+        z_centerline = z_centerline[~is_outlier]
+
+    return x_centerline, y_centerline, z_centerline
+
+
 def smooth_centerline(fname_centerline, algo_fitting='hanning', type_window='hanning', window_length=80, verbose=0, nurbs_pts_number=1000, all_slices=True, phys_coordinates=False, remove_outliers=False):
     """
+    The result is kept in memory: calling the function again with the same centerline (same file content or same
+    image) and the same parameters returns a copy of it.
     :param fname_centerline: centerline in RPI orientation, or an Image
     :return: x_centerline_fit, y_centerline_fit, z_centerline_fit, x_centerline_deriv, y_centerline_deriv, z_centerline_deriv
     """
@@ -39,6 +116,11 @@ def smooth_centerline(fname_centerline, algo_fitting='hanning', type_window='han
 
     sct.printv('\nSmooth centerline/segmentation...', verbose)
 
+    key = get_centerline_key(fname_centerline, (algo_fitting, type_window, window_length, nurbs_pts_number, all_slices, phys_coordinates, remove_outliers))
+    if key is not None and key in _centerline_cache:
+        sct.printv('.. Centerline already computed with the same parameters', verbose)
+        return deepcopy(_centerline_cache[key])
+
     # get dimensions (again!)
     from msct_image import Image
     file_image = None
@@ -54,60 +136,21 @@ def smooth_centerline(fname_centerline, algo_fitting='hanning', type_window='han
     # open centerline
     data = file_image.data
 
-    # loop across z and associate x,y coordinate with the point having maximum intensity
-    # N.B. len(z_centerline) = nz_nonz can be smaller than nz in case the centerline is smaller than the input volume
-    z_centerline = [iz for iz in range(0, nz, 1) if data[:, :, iz].any()]
+    # get center of mass of the centerline/segmentation and remove outliers
+    sct.printv('.. Get center of mass of the centerline/segmentation...', verbose)
+    x_centerline, y_centerline, z_centerline = get_centerline_coordinates(data, remove_outliers=remove_outliers)
+    if not remove_outliers:
+        x_centerline, y_centerline, z_centerline = x_centerline.tolist(), y_centerline.tolist(), z_centerline.tolist()
     nz_nonz = len(z_centerline)
-    x_centerline = [0 for _ in range(0, nz_nonz, 1)]
-    y_centerline = [0 for _ in range(0, nz_nonz, 1)]
-    x_centerline_fit = [0 for _ in range(0, nz_nonz, 1)]
-    y_centerline_fit = [0 for _ in range(0, nz_nonz, 1)]
-    z_centerline_fit = [0 for _ in range(0, nz_nonz, 1)]
-    x_centerline_deriv = [0 for _ in range(0, nz_nonz, 1)]
-    y_centerline_deriv = [0 for _ in range(0, nz_nonz, 1)]
-    z_centerline_deriv = [0 for _ in range(0, nz_nonz, 1)]
-    num_features = [0 for _ in range(0, nz_nonz, 1)]
-    distances = []
 
     if nz_nonz <= 5 and algo_fitting == 'nurbs':
         sct.printv('WARNING: switching to hanning smoothing due to low number of slices.', verbose=verbose, type='warning')
         algo_fitting = 'hanning'
 
-    # get center of mass of the centerline/segmentation and remove outliers
-    sct.printv('.. Get center of mass of the centerline/segmentation...', verbose)
-    for iz in range(0, nz_nonz, 1):
-        slice = np.array(data[:, :, z_centerline[iz]])
-        labeled_array, num_f = ndimage.measurements.label(slice)
-        num_features[iz] = num_f
-        x_centerline[iz], y_centerline[iz] = ndimage.measurements.center_of_mass(slice)
-        if iz != 0:
-            distances.append(sqrt((x_centerline[iz] - x_centerline[iz - 1]) ** 2 + (y_centerline[iz] - y_centerline[iz - 1]) ** 2))
-
-    if remove_outliers:
-        mean_distances = np.mean(distances)
-        std_distances = np.std(distances)
-        indices_to_remove = []
-
-        # ascending verification
-        for iz in range(0, nz_nonz / 2, 1):
-            distance = sqrt((x_centerline[iz] - x_centerline[iz + 1]) ** 2 + (y_centerline[iz] - y_centerline[iz + 1]) ** 2)
-            if num_features[iz] > 1 or abs(distance - mean_distances) > 3 * std_distances:
-                indices_to_remove.append(iz)
-
-        # descending verification
-        for iz in range(nz_nonz - 1, nz_nonz / 2, -1):
-            distance = sqrt((x_centerline[iz] - x_centerline[iz - 1]) ** 2 + (y_centerline[iz] - y_centerline[iz - 1]) ** 2)
-            if num_features[iz] > 1 or abs(distance - mean_distances) > 3 * std_distances:
-                indices_to_remove.append(iz)
-
-        x_centerline = np.delete(x_centerline, indices_to_remove)
-        y_centerline = np.delete(y_centerline, indices_to_remove)
-        z_centerline = np.delete(z_centerline, indices_to_remove)
-
     if phys_coordinates:
         sct.printv('.. Computing physical coordinates of centerline/segmentation...', verbose)
         coord_centerline = np.array(zip(x_centerline, y_centerline, z_centerline))
-        phys_coord_centerline = np.asarray(file_image.transfo_pix2phys(coord_centerline))
+        phys_coord_centerline = file_image.transfo_pix2phys_array(coord_centerline)
         x_centerline = phys_coord_centerline[:, 0]
         y_centerline = phys_coord_centerline[:, 1]
         z_centerline = phys_coord_centerline[:, 2]
@@ -171,8 +214,13 @@ def smooth_centerline(fname_centerline, algo_fitting='hanning', type_window='han
     else:
         sct.printv("ERROR: wrong algorithm for fitting", 1, "error")
 
-    return x_centerline_fit, y_centerline_fit, z_centerline_fit, \
-            x_centerline_deriv, y_centerline_deriv, z_centerline_deriv
+    result = x_centerline_fit, y_centerline_fit, z_centerline_fit, \
+             x_centerline_deriv, y_centerline_deriv, z_centerline_deriv
+    if key is not None:
+        if len(_centerline_cache) >= NB_CENTERLINES_CACHE:
+            _centerline_cache.popitem(last=False)
+        _centerline_cache[key] = deepcopy(result)
+    return result
 
 
 class SpinalCordStraightener(object):
@@ -216,6 +264,8 @@ class SpinalCordStraightener(object):
         self.elapsed_time = 0.0
         self.elapsed_time_accuracy = 0.0
 
+        self.nb_cpu = None  # number of processes used to compute the warping fields. None: all the available cores.
+
     def straighten(self):
         # Initialization
         fname_anat = self.input_filename
@@ -528,7 +578,7 @@ class SpinalCordStraightener(object):
                 dy_straight = [0.0] * number_of_points
                 dz_straight = [1.0] * number_of_points
                 coord_straight = np.array(zip(ix_straight, iy_straight, iz_straight))
-                coord_phys_straight = np.asarray(image_centerline_straight.transfo_pix2phys(coord_straight))
+                coord_phys_straight = image_centerline_straight.transfo_pix2phys_array(coord_straight)
 
                 centerline_straight = Centerline(coord_phys_straight[:, 0], coord_phys_straight[:, 1], coord_phys_straight[:, 2],
                                                  dx_straight, dy_straight, dz_straight)
@@ -574,59 +624,25 @@ class SpinalCordStraightener(object):
             lookup_straight2curved = np.array(lookup_straight2curved)
 
             # Create volumes containing curved and straight warping fields
+            # The warping fields are memory-mapped (float32, as written in the output files), so that they can be
+            # filled by several processes, each one computing a chunk of slices.
             time_generation_volumes = time.time()
-            data_warp_curved2straight = np.zeros((nx_s, ny_s, nz_s, 1, 3))
-            data_warp_straight2curved = np.zeros((nx, ny, nz, 1, 3))
+            data_warp_curved2straight = np.memmap('tmp.curve2straight.dat', dtype=np.float32, mode='w+', shape=(nx_s, ny_s, nz_s, 1, 3))
+            data_warp_straight2curved = np.memmap('tmp.straight2curve.dat', dtype=np.float32, mode='w+', shape=(nx, ny, nz, 1, 3))
 
             # 5. compute transformations
             # Curved and straight images and the same dimensions, so we compute both warping fields at the same time.
             # b. determine which plane of spinal cord centreline it is included
-            # print nx * ny * nz, nx_s * ny_s * nz_s
-
+            _warp_generation.update({'curved2straight': (image_centerline_straight, centerline_straight, centerline, lookup_straight2curved, 'tmp.curve2straight.dat', data_warp_curved2straight.shape),
+                                     'straight2curved': (image_centerline_pad, centerline, centerline_straight, lookup_curved2straight, 'tmp.straight2curve.dat', data_warp_straight2curved.shape),
+                                     'threshold_distance': self.threshold_distance})
+            list_chunks = []
             if self.curved2straight:
-                for u in range(nz_s):
-                    # print u+1, '/', nz_s
-                    x_s, y_s, z_s = np.mgrid[0:nx_s, 0:ny_s, u:u + 1]
-                    indexes_straight = np.array(zip(x_s.ravel(), y_s.ravel(), z_s.ravel()))
-                    physical_coordinates_straight = image_centerline_straight.transfo_pix2phys(indexes_straight)
-                    nearest_indexes_straight = centerline_straight.find_nearest_indexes(physical_coordinates_straight)
-                    distances_straight = centerline_straight.get_distances_from_planes(physical_coordinates_straight, nearest_indexes_straight)
-                    indexes_out_distance_straight = np.logical_or(distances_straight > self.threshold_distance, distances_straight < -self.threshold_distance)
-                    projected_points_straight = centerline_straight.get_projected_coordinates_on_planes(physical_coordinates_straight, nearest_indexes_straight)
-                    coord_in_planes_straight = centerline_straight.get_in_plans_coordinates(projected_points_straight, nearest_indexes_straight)
-
-                    coord_straight2curved = centerline.get_inverse_plans_coordinates(coord_in_planes_straight, lookup_straight2curved[nearest_indexes_straight])
-                    displacements_straight = coord_straight2curved - physical_coordinates_straight
-                    # for some reason, displacement in Z is inverted. Probably due to left/right-handed definition of referential.
-                    #displacements_straight[:, 0] = -displacements_straight[:, 0]
-                    displacements_straight[:, 2] = -displacements_straight[:, 2]
-                    displacements_straight[indexes_out_distance_straight] = [100000.0, 100000.0, 100000.0]
-
-                    data_warp_curved2straight[indexes_straight[:, 0], indexes_straight[:, 1], indexes_straight[:, 2], 0, :] = -displacements_straight
-
+                list_chunks += get_warp_chunks('curved2straight', nx_s, ny_s, nz_s)
             if self.straight2curved:
-                for u in range(nz):
-                    # print u + 1, '/', nz
-                    x, y, z = np.mgrid[0:nx, 0:ny, u:u + 1]
-                    indexes = np.array(zip(x.ravel(), y.ravel(), z.ravel()))
-                    physical_coordinates = image_centerline_pad.transfo_pix2phys(indexes)
-                    nearest_indexes_curved = centerline.find_nearest_indexes(physical_coordinates)
-                    distances_curved = centerline.get_distances_from_planes(physical_coordinates, nearest_indexes_curved)
-                    indexes_out_distance_curved = np.logical_or(distances_curved > self.threshold_distance, distances_curved < -self.threshold_distance)
-                    projected_points_curved = centerline.get_projected_coordinates_on_planes(physical_coordinates, nearest_indexes_curved)
-                    coord_in_planes_curved = centerline.get_in_plans_coordinates(projected_points_curved, nearest_indexes_curved)
-
-                    coord_curved2straight = centerline_straight.points[lookup_curved2straight[nearest_indexes_curved]]
-                    coord_curved2straight[:, 0:2] += coord_in_planes_curved[:, 0:2]
-                    coord_curved2straight[:, 2] += distances_curved
-
-                    displacements_curved = coord_curved2straight - physical_coordinates
-                    # for some reason, displacement in Z is inverted. Probably due to left/right-hended definition of referential.
-                    #displacements_curved[:, 0] = -displacements_curved[:, 0]
-                    displacements_curved[:, 2] = -displacements_curved[:, 2]
-                    displacements_curved[indexes_out_distance_curved] = [100000.0, 100000.0, 100000.0]
-
-                    data_warp_straight2curved[indexes[:, 0], indexes[:, 1], indexes[:, 2], 0, :] = -displacements_curved
+                list_chunks += get_warp_chunks('straight2curved', nx, ny, nz)
+            compute_warp_chunks(list_chunks, nb_cpu=self.nb_cpu, verbose=verbose)
+            _warp_generation.clear()
 
             # Creation of the safe zone based on pre-calculated safe boundaries
             coord_bound_curved_inf, coord_bound_curved_sup = image_centerline_pad.transfo_phys2pix([[0, 0, bound_curved[0]]]), image_centerline_pad.transfo_phys2pix([[0, 0, bound_curved[1]]])
@@ -752,6 +768,76 @@ class SpinalCordStraightener(object):
             Image(fname_straight).save_quality_control(plane='sagittal', n_slices=1, path_output=self.path_output)
 
 
+# number of voxels in a chunk of slices processed at once when computing the warping fields
+NB_VOXELS_WARP_CHUNK = 200000
+# data shared with the processes computing the warping fields (set before the processes are forked), indexed by
+# direction: (image of the space of the warping field, centerline in this space, centerline in the other space,
+# look-up table between the centerline points, memory-mapped warping field file name, warping field shape)
+_warp_generation = {}
+
+
+def get_warp_chunks(direction, nx, ny, nz):
+    """
+    Split the slices of a warping field in chunks of about NB_VOXELS_WARP_CHUNK voxels
+    :return: list of (direction, z_start, z_stop), see compute_warp_chunk()
+    """
+    nz_chunk = max(1, NB_VOXELS_WARP_CHUNK / (nx * ny))
+    return [(direction, z, min(z + nz_chunk, nz)) for z in range(0, nz, nz_chunk)]
+
+
+def compute_warp_chunk(args):
+    """
+    Compute the warping field on a chunk of slices and write it into the memory-mapped warping field.
+    For each voxel: find the nearest centerline plane, compute the voxel coordinates in this plane and find the
+    corresponding point in the other space.
+    :param args: tuple (direction, z_start, z_stop), direction: 'curved2straight' or 'straight2curved'
+    """
+    direction, z_start, z_stop = args
+    image, centerline_src, centerline_dest, lookup, fname_warp, shape_warp = _warp_generation[direction]
+    nx, ny = shape_warp[0], shape_warp[1]
+    # voxel indexes of the chunk
+    indexes = np.indices((nx, ny, z_stop - z_start)).reshape(3, -1).transpose()
+    indexes[:, 2] += z_start
+    physical_coordinates = image.transfo_pix2phys_array(indexes)
+    nearest_indexes = centerline_src.find_nearest_indexes(physical_coordinates)
+    distances = centerline_src.get_distances_from_planes(physical_coordinates, nearest_indexes)
+    indexes_out_distance = np.abs(distances) > _warp_generation['threshold_distance']
+    projected_points = centerline_src.get_projected_coordinates_on_planes(physical_coordinates, nearest_indexes)
+    coord_in_planes = centerline_src.get_in_plans_coordinates(projected_points, nearest_indexes)
+
+    if direction == 'curved2straight':
+        coord_dest = centerline_dest.get_inverse_plans_coordinates(coord_in_planes, lookup[nearest_indexes])
+    else:
+        coord_dest = centerline_dest.points[lookup[nearest_indexes]]
+        coord_dest[:, 0:2] += coord_in_planes[:, 0:2]
+        coord_dest[:, 2] += distances
+
+    displacements = coord_dest - physical_coordinates
+    # for some reason, displacement in Z is inverted. Probably due to left/right-handed definition of referential.
+    displacements[:, 2] = -displacements[:, 2]
+    displacements[indexes_out_distance] = [100000.0, 100000.0, 100000.0]
+
+    data_warp = np.memmap(fname_warp, dtype=np.float32, mode='r+', shape=shape_warp)
+    data_warp[:, :, z_start:z_stop, 0, :] = -displacements.reshape(nx, ny, z_stop - z_start, 3)
+    data_warp.flush()
+    del data_warp
+
+
+def compute_warp_chunks(list_chunks, nb_cpu=None, verbose=1):
+    """
+    Compute chunks of the warping fields, on a pool of processes
+    :param list_chunks: list of arguments of compute_warp_chunk()
+    :param nb_cpu: number of processes. None: all the available cores. 0 or 1: no multiprocessing.
+    """
+    nb_cpu = min(sct.get_nb_cpu(nb_cpu), len(list_chunks))
+    if nb_cpu <= 1:
+        for chunk in list_chunks:
+            compute_warp_chunk(chunk)
+        return
+    sct.printv('Compute warping fields by chunks of slices (' + str(len(list_chunks)) + ' chunks) using ' + str(nb_cpu) + ' processes...', verbose)
+    sct.run_pool(compute_warp_chunk, list_chunks, nb_cpu)
+
+
 def get_parser():
     # Initialize parser
     parser = Parser(__file__)
@@ -865,6 +951,11 @@ def get_parser():
                       mandatory=False,
                       example=['0', '1'],
                       default_value='0')
+    parser.add_option(name="-cpu-nb",
+                      type_value="int",
+                      description="Number of CPU used for computing the warping fields in parallel. 0: no multiprocessing. If not provided, it uses all the available cores.",
+                      mandatory=False,
+                      example='4')
 
     return parser
 
@@ -909,8 +1000,8 @@ if __name__ == "__main__":
         sc_straight.path_output = './'
     if "-v" in arguments:
         sc_straight.verbose = int(arguments["-v"])
-    # if "-cpu-nb" in arguments:
-    #     sc_straight.cpu_number = int(arguments["-cpu-nb"])
+    if "-cpu-nb" in arguments:
+        sc_straight.nb_cpu = arguments["-cpu-nb"]
     if '-qc' in arguments:
         sc_straight.qc = int(arguments['-qc'])
 
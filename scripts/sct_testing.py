@@ -134,7 +134,10 @@ def downloaddata():
 # ==========================================================================================
 def fill_functions():
     functions = [
+        'msct_cache',
+        'msct_multiatlas_seg',
         'sct_apply_transfo',
+        'sct_compute_hausdorff_distance',
         # 'sct_check_atlas_integrity',
         'sct_compute_mtr',
         'sct_concat_transfo',
@@ -164,6 +167,7 @@ def fill_functions():
         'sct_register_multimodal',
         'sct_register_to_template',
         'sct_resample',
+        'sct_run_batch',
         'sct_segment_graymatter',
         'sct_smooth_spinalcord',
         'sct_straighten_spinalcord',
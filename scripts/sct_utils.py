@@ -82,20 +82,29 @@ def run(cmd, verbose=1, error_exit='error', raise_exception=False):
     #     printv(sys._getframe().f_back.f_code.co_name, 1, 'process')
     if verbose:
         printv(cmd, 1, 'code')
-    process = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    output_final = ''
-    while True:
-        output = process.stdout.readline()
-        if output == '' and process.poll() is not None:
-            break
-        if output:
-            if verbose == 2:
-                print output.strip()
-            output_final += output.strip() + '\n'
-    status_output = process.returncode
-    # process.stdin.close()
-    # process.stdout.close()
-    # process.terminate()
+    args = split_inprocess_command(cmd)
+    if args is not None:
+        # sct_* script that can run in the current interpreter (no new python process, no extra nifti I/O)
+        status_output, output_final = run_main(args[0], args[1:], verbose=verbose)
+        output_final += '\n'
+    else:
+        # images that only live in memory (see call()) must be on disk before another process can read them
+        if 'msct_image' in sys.modules:
+            sys.modules['msct_image'].flush_memory_images(cmd)
+        process = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output_final = ''
+        while True:
+            output = process.stdout.readline()
+            if output == '' and process.poll() is not None:
+                break
+            if output:
+                if verbose == 2:
+                    print output.strip()
+                output_final += output.strip() + '\n'
+        status_output = process.returncode
+        # process.stdin.close()
+        # process.stdout.close()
+        # process.terminate()
 
     # need to remove the last \n character in the output -> return output_final[0:-1]
     if status_output:
@@ -112,6 +121,221 @@ def run(cmd, verbose=1, error_exit='error', raise_exception=False):
         return status_output, output_final[0:-1]
 
 
+#=======================================================================================================================
+# run sct_* scripts in the current interpreter
+#=======================================================================================================================
+# scripts for which main(args) only depends on args (no module-level state, no sys.argv) and can therefore be called
+# in-process by run(). Set the environment variable SCT_RUN_INPROCESS=0 to always spawn a new process.
+INPROCESS_SCRIPTS = ['sct_convert', 'sct_image', 'sct_label_utils', 'sct_maths']
+
+
+def split_inprocess_command(cmd):
+    """
+    Check if a command line can be dispatched in-process by run().
+    :param cmd: command line, e.g. 'sct_maths -i data.nii -mean t -o data_mean.nii'
+    :return: list of arguments (script name first) or None if the command must run in a new process
+    """
+    import shlex
+    if os.environ.get('SCT_RUN_INPROCESS', '1') == '0':
+        return None
+    # pipes, redirections, sequences and variables need a shell
+    if re.search(r'[|&;<>`$*?]', cmd):
+        return None
+    try:
+        args = shlex.split(cmd)
+    except ValueError:
+        return None
+    if not args or args[0] not in INPROCESS_SCRIPTS:
+        return None
+    return args
+
+
+def run_main(script_name, args, verbose=1):
+    """
+    Run the main() function of a sct_* script in the current interpreter and capture what it prints.
+    :param script_name: name of the script, e.g. 'sct_maths'
+    :param args: list of arguments, as in sys.argv[1:]
+    :param verbose: if 2, print the output of the script
+    :return: status, output (same as run())
+    """
+    import importlib
+    import traceback
+    from StringIO import StringIO
+    import msct_cache
+
+    # stderr is merged into the output and the working folder is restored, as when the script runs in a subprocess
+    stdout_orig, stderr_orig = sys.stdout, sys.stderr
+    path_orig = os.getcwd()
+    sys.stdout = sys.stderr = StringIO()
+    # the outputs of this run can be cached (see msct_cache)
+    msct_cache.push_entry(script_name)
+    status = 1
+    try:
+        importlib.import_module(script_name).main(args)
+        status = 0
+    except SystemExit, e:
+        if e.code is None:
+            status = 0
+        elif isinstance(e.code, int):
+            status = e.code
+        else:
+            print e.code
+            status = 1
+    except Exception:
+        print traceback.format_exc()
+        status = 1
+    finally:
+        output = '\n'.join([line.strip() for line in sys.stdout.getvalue().strip().split('\n')])
+        sys.stdout, sys.stderr = stdout_orig, stderr_orig
+        os.chdir(path_orig)
+        msct_cache.pop_entry(status == 0)
+    if verbose == 2 and output:
+        print output
+    return status, output
+
+
+def call(script_name, args, verbose=1):
+    """
+    Call a sct_* script in the current interpreter, passing and returning images in memory.
+    Arguments that are msct_image.Image objects are handed over to the script without being written to disk, and the
+    files written to output options (type 'file_output') are returned as Image objects instead of being saved. An image
+    is only written to disk if the script needs to pass it to an external program (see run()).
+
+    Example:
+    im_rpi, = sct.call('sct_image', ['-i', im, '-setorient', 'RPI', '-o', 'data_rpi.nii'])
+
+    :param script_name: name of the script, e.g. 'sct_maths'
+    :param args: list of arguments (str or Image)
+    :param verbose:
+    :return: list of output images, in the order of the output options in args (None if an output was not created)
+    """
+    import importlib
+    import msct_image
+    from msct_image import Image
+
+    module = importlib.import_module(script_name)
+    options = module.get_parser().options
+
+    args_str, fname_memory, fname_capture = [], [], []
+    for i, arg in enumerate(args):
+        if isinstance(arg, Image):
+            arg = msct_image.register_memory_image(arg)
+            fname_memory.append(arg)
+        elif i > 0 and args[i - 1] in options and options[args[i - 1]].type_value == 'file_output':
+            fname_capture.append(msct_image.capture_memory_image(arg))
+        args_str.append(str(arg))
+
+    try:
+        if verbose:
+            printv(script_name + ' ' + ' '.join(args_str), 1, 'code')
+        module.main(args_str)
+        im_out = []
+        for fname in fname_capture:
+            im = msct_image.release_memory_image(fname)
+            if im is None and os.path.isfile(fname):
+                im = Image(fname)
+            im_out.append(im)
+    finally:
+        for fname in fname_memory + fname_capture:
+            msct_image.release_memory_image(fname)
+    return im_out
+
+
+#=======================================================================================================================
+# run a function on a pool of processes
+#=======================================================================================================================
+def get_nb_cpu(nb_cpu=None):
+    """
+    :param nb_cpu: number of processes. None: the value of the environment variable SCT_NB_CPU if it is set (see
+    sct_run_batch), else all the available cores. 0 or 1: no multiprocessing.
+    :return: number of processes
+    """
+    if nb_cpu is None:
+        from multiprocessing import cpu_count
+        nb_cpu = os.environ.get('SCT_NB_CPU', cpu_count())
+    return int(nb_cpu)
+
+
+def init_worker():
+    # workers ignore Ctrl+C: the main process catches KeyboardInterrupt and terminates them
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def run_pool(func, list_args, nb_cpu):
+    """
+    Call func on each element of list_args, on a pool of nb_cpu processes. Ctrl+C terminates the workers and exits, an
+    exception raised by a worker terminates the workers and exits with an error.
+    func must not call sys.exit() (e.g. through run()), otherwise the pool waits for the worker forever.
+    :param func: function of one argument, defined at the top level of a module (it is pickled)
+    :param list_args: list of arguments
+    :param nb_cpu: number of processes
+    :return: list of results, in the order of list_args
+    """
+    from multiprocessing import Pool
+    pool = Pool(processes=nb_cpu, initializer=init_worker)
+    try:
+        list_results = pool.map_async(func, list_args).get(9999999)
+        pool.close()
+        pool.join()
+    except KeyboardInterrupt:
+        print "\nWarning: Caught KeyboardInterrupt, terminating workers"
+        pool.terminate()
+        pool.join()
+        sys.exit(2)
+    except Exception as e:
+        pool.terminate()
+        pool.join()
+        printv('\nERROR in ' + func.__module__ + '.' + func.__name__ + ': ' + str(e), 1, 'error')
+    return list_results
+
+
+def iter_pool(func, iter_args, nb_cpu, nb_pending=None):
+    """
+    Same as run_pool(), but the arguments are read from an iterator and the results are yielded in order, as they are
+    computed. At most nb_pending arguments are submitted to the pool at once, so that memory stays bounded when the
+    arguments are large (Pool.imap would read the whole iterator ahead). A single pool is used for all the arguments.
+    :param func: function of one argument, defined at the top level of a module (it is pickled)
+    :param iter_args: iterable of arguments (e.g. a generator)
+    :param nb_cpu: number of processes
+    :param nb_pending: maximum number of arguments submitted and not yet yielded. Default: 2 * nb_cpu
+    :return: generator of results, in the order of iter_args
+    """
+    from collections import deque
+    from multiprocessing import Pool
+    if nb_pending is None:
+        nb_pending = 2 * nb_cpu
+    pool = Pool(processes=nb_cpu, initializer=init_worker)
+    pending = deque()
+    done = False
+    try:
+        for args in iter_args:
+            pending.append(pool.apply_async(func, (args,)))
+            if len(pending) >= nb_pending:
+                yield pending.popleft().get(9999999)
+        while pending:
+            yield pending.popleft().get(9999999)
+        pool.close()
+        pool.join()
+        done = True
+    except KeyboardInterrupt:
+        print "\nWarning: Caught KeyboardInterrupt, terminating workers"
+        pool.terminate()
+        pool.join()
+        done = True
+        sys.exit(2)
+    except Exception as e:
+        pool.terminate()
+        pool.join()
+        done = True
+        printv('\nERROR in ' + func.__module__ + '.' + func.__name__ + ': ' + str(e), 1, 'error')
+    finally:
+        # the generator was not consumed until the end (e.g. exception in the caller)
+        if not done:
+            pool.terminate()
+            pool.join()
+
+
 #=======================================================================================================================
 # check RAM usage
 # work only on Mac OSX
@@ -274,7 +498,7 @@ def check_file_exist(fname, verbose=1):
         fname_to_test = fname[1:]
     else:
         fname_to_test = fname
-    if os.path.isfile(fname_to_test):
+    if os.path.isfile(fname_to_test) or ('msct_image' in sys.modules and sys.modules['msct_image'].is_memory_image(fname_to_test)):
         if verbose:
             printv('  OK: ' + fname, verbose, 'normal')
         return True
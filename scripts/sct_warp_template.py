@@ -46,12 +46,13 @@ class Param:
         self.list_labels_nn = ['_level.nii.gz', '_levels.nii.gz', '_csf.nii.gz', '_CSF.nii.gz', '_cord.nii.gz']  # list of files for which nn interpolation should be used. Default = linear.
         self.verbose = 1  # verbose
         self.qc = 1
+        self.batch = 1  # warp all label files in the same process (the warping field is only read once)
 
 
 # MAIN
 # ==========================================================================================
 class WarpTemplate:
-    def __init__(self, fname_src, fname_transfo, warp_atlas, warp_spinal_levels, folder_out, path_template, verbose, qc):
+    def __init__(self, fname_src, fname_transfo, warp_atlas, warp_spinal_levels, folder_out, path_template, verbose, qc, batch=1):
 
         # Initialization
         self.fname_src = fname_src
@@ -65,6 +66,7 @@ class WarpTemplate:
         self.folder_spinal_levels = param.folder_spinal_levels
         self.verbose = verbose
         self.qc = qc
+        self.batch = batch
         start_time = time.time()
 
         # add slash at the end of folder name (in case there is no slash)
@@ -88,19 +90,28 @@ class WarpTemplate:
             sct.run('rm -rf ' + self.folder_out)
         sct.run('mkdir ' + self.folder_out)
 
+        # Compute where to sample the template for each voxel of the destination image (affine transformations
+        # are not supported in batch mode: sct_apply_transfo is called for each file)
+        coord_sampling = None
+        if self.batch and sct.extract_fname(self.fname_transfo)[2] in ['.nii', '.nii.gz']:
+            sct.printv('\nCompute sampling coordinates from warping field...', self.verbose)
+            from msct_image import Image
+            from sct_apply_transfo import get_sampling_coordinates
+            coord_sampling = get_sampling_coordinates(self.fname_transfo, Image(self.fname_src))
+
         # Warp template objects
         sct.printv('\nWARP TEMPLATE:', self.verbose)
-        warp_label(self.path_template, self.folder_template, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out)
+        warp_label(self.path_template, self.folder_template, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out, coord_sampling)
 
         # Warp atlas
         if self.warp_atlas == 1:
             sct.printv('\nWARP ATLAS OF WHITE MATTER TRACTS:', self.verbose)
-            warp_label(self.path_template, self.folder_atlas, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out)
+            warp_label(self.path_template, self.folder_atlas, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out, coord_sampling)
 
         # Warp spinal levels
         if self.warp_spinal_levels == 1:
             sct.printv('\nWARP SPINAL LEVELS:', self.verbose)
-            warp_label(self.path_template, self.folder_spinal_levels, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out)
+            warp_label(self.path_template, self.folder_spinal_levels, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out, coord_sampling)
 
         # to view results
         sct.printv('\nDone! To view results, type:', self.verbose)
@@ -120,7 +131,7 @@ class WarpTemplate:
 
 # Warp labels
 # ==========================================================================================
-def warp_label(path_label, folder_label, file_label, fname_src, fname_transfo, path_out):
+def warp_label(path_label, folder_label, file_label, fname_src, fname_transfo, path_out, coord_sampling=None):
     """
     Warp label files according to info_label.txt file
     :param path_label:
@@ -129,6 +140,9 @@ def warp_label(path_label, folder_label, file_label, fname_src, fname_transfo, p
     :param fname_src:
     :param fname_transfo:
     :param path_out:
+    :param coord_sampling: sampling coordinates computed from the warping field (see
+    sct_apply_transfo.get_sampling_coordinates). If provided, files are warped in this process instead of calling
+    sct_apply_transfo for each file.
     :return:
     """
     # read label file and check if file exists
@@ -146,13 +160,25 @@ def warp_label(path_label, folder_label, file_label, fname_src, fname_transfo, p
     else:
         # create output folder
         sct.run('mkdir ' + path_out + folder_label, param.verbose)
+        if coord_sampling is not None:
+            from msct_image import Image
+            from sct_apply_transfo import resample_on_coordinates
+            im_dest = Image(fname_src)
+            hdr_out = im_dest.hdr.copy()
+            hdr_out.set_data_dtype('float32')
         # Warp label
         for i in xrange(0, len(template_label_file)):
             fname_label = path_label + folder_label + template_label_file[i]
             # check if file exists
             # sct.check_file_exist(fname_label)
             # apply transfo
-            sct.run('sct_apply_transfo -i ' + fname_label + ' -o ' + path_out + folder_label + template_label_file[i] + ' -d ' + fname_src + ' -w ' + fname_transfo + ' -x ' + get_interp(template_label_file[i]), param.verbose)
+            if coord_sampling is not None:
+                sct.printv('  ' + template_label_file[i] + ' (' + get_interp(template_label_file[i]) + ')', param.verbose)
+                data_out = resample_on_coordinates(Image(fname_label), coord_sampling, get_interp(template_label_file[i]))
+                im_out = Image(data_out, hdr=hdr_out.copy(), orientation=im_dest.orientation, absolutepath=path_out + folder_label + template_label_file[i], dim=im_dest.dim)
+                im_out.save(verbose=0)
+            else:
+                sct.run('sct_apply_transfo -i ' + fname_label + ' -o ' + path_out + folder_label + template_label_file[i] + ' -d ' + fname_src + ' -w ' + fname_transfo + ' -x ' + get_interp(template_label_file[i]), param.verbose)
         # Copy list.txt
         sct.run('cp ' + path_label + folder_label + param.file_info_label + ' ' + path_out + folder_label, 0)
 
@@ -266,6 +292,12 @@ def get_parser():
                       mandatory=False,
                       example=['0', '1'],
                       default_value='1')
+    parser.add_option(name='-batch',
+                      type_value='multiple_choice',
+                      description='Warp all files in a single process, reading the warping field only once. 0: call sct_apply_transfo for each file.',
+                      mandatory=False,
+                      example=['0', '1'],
+                      default_value=str(param_default.batch))
     parser.add_option(name="-v",
                       type_value="multiple_choice",
                       description="""Verbose.""",
@@ -292,9 +324,10 @@ def main(args=None):
     path_template = sct.slash_at_the_end(arguments['-t'], 1)
     verbose = int(arguments['-v'])
     qc = int(arguments['-qc'])
+    batch = int(arguments['-batch'])
 
     # call main function
-    WarpTemplate(fname_src, fname_transfo, warp_atlas, warp_spinal_levels, folder_out, path_template, verbose, qc)
+    WarpTemplate(fname_src, fname_transfo, warp_atlas, warp_spinal_levels, folder_out, path_template, verbose, qc, batch)
 
 
 # START PROGRAM
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Test the cache of the outputs of sct_* scripts (msct_cache): store, hit, eviction
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2017 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import commands
+import json
+import os
+import shutil
+
+
+def read_entries(path_cache):
+    """
+    :return: dict {key: list of files stored in the entry}
+    """
+    dict_entries = {}
+    for key in os.listdir(path_cache):
+        fname_manifest = os.path.join(path_cache, key, 'manifest.json')
+        if os.path.isfile(fname_manifest):
+            with open(fname_manifest) as f:
+                dict_entries[key] = [fname for fname, fname_cache in json.load(f)['files']]
+    return dict_entries
+
+
+def test(path_data):
+
+    folder_data = 'mt/'
+    file_data = ['mtr.nii.gz']
+
+    output = ''
+    status = 0
+
+    path_cache = os.path.abspath('cache_outputs')
+    if os.path.isdir(path_cache):
+        shutil.rmtree(path_cache)
+    os.mkdir(path_cache)
+    # file of the working folder that is not an output of the runs
+    with open('not_an_output.txt', 'w') as f:
+        f.write('not an output')
+
+    def run_cached(threshold, fname_out, cache_size=None):
+        cmd = 'SCT_CACHE_DIR=' + path_cache + ('' if cache_size is None else ' SCT_CACHE_SIZE=' + str(cache_size)) \
+              + ' sct_maths -i ' + path_data + folder_data + file_data[0] \
+              + ' -thr ' + str(threshold) \
+              + ' -o ' + fname_out
+        s, o = commands.getstatusoutput(cmd)
+        return s, '\n====================================================================================================\n'+cmd+'\n====================================================================================================\n\n' + o
+
+    # store: only the declared output is stored
+    s, o = run_cached(1, 'mtr_thr1.nii.gz')
+    status += s
+    output += o
+    dict_entries = read_entries(path_cache)
+    if s == 0 and dict_entries.values() != [['mtr_thr1.nii.gz']]:
+        status = 99
+        output += '\nWRONG RESULT: the cache should contain one entry with mtr_thr1.nii.gz: ' + str(dict_entries)
+
+    # hit: the output is restored from the cache
+    if status == 0:
+        with open('mtr_thr1.nii.gz', 'rb') as f:
+            data_out = f.read()
+        os.remove('mtr_thr1.nii.gz')
+        s, o = run_cached(1, 'mtr_thr1.nii.gz')
+        status += s
+        output += o
+        if s == 0 and 'Outputs restored from cache' not in o:
+            status = 99
+            output += '\nWRONG RESULT: the outputs were not restored from the cache.'
+        elif s == 0 and (not os.path.isfile('mtr_thr1.nii.gz') or open('mtr_thr1.nii.gz', 'rb').read() != data_out):
+            status = 99
+            output += '\nWRONG RESULT: the restored output differs from the output of the first run.'
+
+    # eviction: the cache can only hold one entry, the least recently used one is removed
+    if status == 0:
+        key_first = dict_entries.keys()[0]
+        with open(os.path.join(path_cache, key_first, 'manifest.json')) as f:
+            size_entry = json.load(f)['size']
+        s, o = run_cached(2, 'mtr_thr2.nii.gz', cache_size=1.5 * size_entry / 1024.0 ** 2)
+        status += s
+        output += o
+        dict_entries = read_entries(path_cache)
+        if s == 0 and dict_entries.values() != [['mtr_thr2.nii.gz']]:
+            status = 99
+            output += '\nWRONG RESULT: the first entry should have been evicted: ' + str(dict_entries)
+
+    return status, output
+
+if __name__ == "__main__":
+    # call main function
+    test()
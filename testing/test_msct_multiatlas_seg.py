@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Test function msct_multiatlas_seg
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2017 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import commands
+import gzip
+import os
+import pickle
+
+import numpy as np
+
+
+def create_model_pklz(path_model, nb_slices=6, size=10):
+    """
+    Create a small random model saved in the former format (gzipped pickles)
+    :return: slices, intensities, fitted_data
+    """
+    import pandas as pd
+    from sklearn import decomposition
+    from msct_gmseg_utils import Slice
+
+    rng = np.random.RandomState(0)
+    slices = []
+    for j in range(nb_slices):
+        # one or two manual segmentations per slice
+        nb_seg = 1 + j % 2
+        slices.append(Slice(slice_id=j, im=rng.rand(size, size), gm_seg=rng.rand(nb_seg, size, size), wm_seg=rng.rand(nb_seg, size, size),
+                            im_m=rng.rand(size, size), gm_seg_m=rng.rand(nb_seg, size, size), wm_seg_m=rng.rand(nb_seg, size, size), level=j % 3 + 1))
+    intensities = pd.DataFrame(rng.rand(3, 4), index=[1, 2, 3], columns=['GM', 'WM', 'MIN', 'MAX'])
+    fitted_model = decomposition.PCA(n_components=3)
+    fitted_data = fitted_model.fit_transform(np.array([dic_slice.im_M.flatten() for dic_slice in slices]))
+
+    if not os.path.isdir(path_model):
+        os.makedirs(path_model)
+    for fname, obj in [('slices.pklz', slices), ('intensities.pklz', intensities), ('fitted_model.pklz', fitted_model), ('fitted_data.pklz', fitted_data)]:
+        pickle.dump(obj, gzip.open(os.path.join(path_model, fname), 'wb'), protocol=2)
+    return slices, intensities, fitted_data
+
+
+def test(path_data=''):
+
+    output = ''
+    status = 0
+
+    path_model_pklz = 'gm_model_pklz'
+    path_model_converted = 'gm_model_converted'
+    slices, intensities, fitted_data = create_model_pklz(path_model_pklz)
+
+    cmd = 'msct_multiatlas_seg -convert-model ' + path_model_pklz \
+          + ' -o ' + path_model_converted \
+          + ' -v 0'
+    output += '\n====================================================================================================\n'+cmd+'\n====================================================================================================\n\n'  # copy command
+    s, o = commands.getstatusoutput(cmd)
+    status += s
+    output += o
+
+    if s == 0:
+        # the converted model must be loaded from the arrays (not from the .pklz) and contain the same data
+        from msct_multiatlas_seg import Model, Param, ParamModel, MODEL_INFO_FILE
+        if not os.path.isfile(os.path.join(path_model_converted, MODEL_INFO_FILE)):
+            status = 99
+            output += '\nWRONG RESULT: ' + MODEL_INFO_FILE + ' was not created.'
+            return status, output
+        param_model = ParamModel()
+        param_model.path_model_to_load = os.path.abspath(path_model_converted)
+        param = Param()
+        param.verbose = 0
+        model = Model(param_model=param_model, param=param)
+        model.load_model()
+
+        list_error = []
+        if len(model.slices) != len(slices):
+            list_error.append('number of slices: ' + str(len(model.slices)) + ' instead of ' + str(len(slices)))
+        else:
+            for dic_slice, dic_slice_converted in zip(slices, model.slices):
+                if dic_slice_converted.id != dic_slice.id or dic_slice_converted.level != dic_slice.level:
+                    list_error.append('slice ' + str(dic_slice.id) + ': id or level')
+                for attr in ['im', 'im_M', 'gm_seg', 'wm_seg', 'gm_seg_M', 'wm_seg_M']:
+                    if not np.array_equal(getattr(dic_slice_converted, attr), getattr(dic_slice, attr)):
+                        list_error.append('slice ' + str(dic_slice.id) + ': ' + attr)
+        if not np.allclose(model.mean_image, np.mean([dic_slice.im for dic_slice in slices], axis=0)):
+            list_error.append('mean image')
+        if not np.array_equal(model.intensities.values, intensities.values) or list(model.intensities.index) != list(intensities.index) or list(model.intensities.columns) != list(intensities.columns):
+            list_error.append('intensities')
+        if not np.array_equal(model.fitted_data, fitted_data):
+            list_error.append('fitted data')
+        if list_error:
+            status = 99
+            output += '\nWRONG RESULT: the converted model differs from the original model: ' + ', '.join(list_error)
+
+    return status, output
+
+if __name__ == "__main__":
+    # call main function
+    test()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Test function sct_compute_hausdorff_distance
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2017 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import commands
+from time import sleep
+
+import nibabel as nib
+import numpy as np
+
+
+def test(path_data):
+
+    folder_data = 't2/'
+    file_data = ['t2_seg.nii.gz']
+
+    output = ''
+    status = 0
+
+    # distance between the 3D volumes: the distance of an image to itself must be 0
+    cmd = 'sct_compute_hausdorff_distance -i ' + path_data + folder_data + file_data[0] \
+          + ' -d ' + path_data + folder_data + file_data[0] \
+          + ' -thinning 0' \
+          + ' -3d 1' \
+          + ' -o hausdorff_distance_3d.txt'
+    output += '\n====================================================================================================\n'+cmd+'\n====================================================================================================\n\n'  # copy command
+    s, o = commands.getstatusoutput(cmd)
+    status += s
+    output += o
+
+    if s == 0:
+        with open('hausdorff_distance_3d.txt') as f:
+            res = f.readline()
+        output += '\n' + res
+        if not res.startswith('3D Hausdorff\'s distance : ') or float(res.split(':')[1].split()[0]) != 0:
+            status = 99
+            output += '\nWRONG RESULT: the 3D Hausdorff\'s distance of an image to itself should be 0.'
+
+    # distance between a segmentation and a copy shifted by 4 voxels of 0.5 mm: the thinned segmentations are shifted
+    # the same way, so the distance is 2 mm with or without thinning
+    x, y = np.indices((40, 40))
+    data_seg = np.zeros((40, 40, 10), dtype=np.uint8)
+    data_seg[(x - 20) ** 2 + (y - 20) ** 2 <= 36, 2:8] = 1
+    affine = np.diag([0.5, 0.5, 0.5, 1])
+    nib.save(nib.Nifti1Image(data_seg, affine), 'seg.nii.gz')
+    nib.save(nib.Nifti1Image(np.roll(data_seg, 4, axis=0), affine), 'seg_shifted.nii.gz')
+    for thinning in ['0', '1']:
+        sleep(1)  # otherwise the next run will try to create a temporary folder with the same name
+        cmd = 'sct_compute_hausdorff_distance -i seg.nii.gz' \
+              + ' -d seg_shifted.nii.gz' \
+              + ' -thinning ' + thinning \
+              + ' -3d 1' \
+              + ' -resampling 0.5' \
+              + ' -o hausdorff_distance_shifted_' + thinning + '.txt'
+        output += '\n====================================================================================================\n'+cmd+'\n====================================================================================================\n\n'  # copy command
+        s, o = commands.getstatusoutput(cmd)
+        status += s
+        output += o
+
+        if s == 0:
+            with open('hausdorff_distance_shifted_' + thinning + '.txt') as f:
+                res = f.readline()
+            output += '\n' + res
+            if not res.startswith('3D Hausdorff\'s distance : ') or abs(float(res.split(':')[1].split()[0]) - 2) > 1e-6:
+                status = 99
+                output += '\nWRONG RESULT: the 3D Hausdorff\'s distance to the shifted segmentation should be 2 mm (-thinning ' + thinning + ').'
+
+    return status, output
+
+if __name__ == "__main__":
+    # call main function
+    test()
@@ -13,6 +13,8 @@
 
 #import sct_utils as sct
 import commands
+import numpy as np
+import nibabel as nib
 
 
 def test(path_data):
@@ -32,6 +34,27 @@ def test(path_data):
     status += s
     output += o
 
+    # statistics across time, computed by chunks of volumes: compare with numpy on the whole time series
+    folder_data = 'dmri/'
+    file_data = ['dmri.nii.gz']
+    cmd = 'sct_maths -i ' + path_data + folder_data + file_data[0] \
+                + ' -o test_tstats.nii.gz' \
+                + ' -tstats mean,std,p50'
+    output += '\n====================================================================================================\n'+cmd+'\n====================================================================================================\n\n'  # copy command
+
+    s, o = commands.getstatusoutput(cmd)
+    status += s
+    output += o
+
+    if s == 0:
+        data = nib.load(path_data + folder_data + file_data[0]).get_data().astype(float)
+        expected = {'mean': np.mean(data, axis=3), 'std': np.std(data, axis=3), 'p50': np.percentile(data, 50, axis=3)}
+        for stat in expected:
+            data_stat = nib.load('test_tstats_' + stat + '.nii.gz').get_data()
+            if not np.allclose(data_stat, expected[stat], rtol=1e-4, atol=1e-3):
+                status = 99
+                output += '\nWRONG RESULT: -tstats ' + stat + ' differs from numpy (max difference: ' + str(np.max(np.abs(data_stat - expected[stat]))) + ')'
+
     return status, output
 
 if __name__ == "__main__":
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Test function sct_run_batch
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2017 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+import commands
+import json
+import os
+import shutil
+
+
+def read_report(fname_report):
+    # {(subject, step): status}
+    with open(fname_report) as f:
+        lines = f.read().splitlines()[1:]
+    return dict([((line.split(',')[0], line.split(',')[1]), line.split(',')[2]) for line in lines])
+
+
+def test(path_data):
+
+    folder_data = 't2/'
+    file_data = ['t2.nii.gz']
+
+    output = ''
+    status = 0
+
+    # dataset of two subjects
+    subjects = ['subject01', 'subject02']
+    for subject in subjects:
+        if not os.path.isdir('batch_data/' + subject + '/' + folder_data):
+            os.makedirs('batch_data/' + subject + '/' + folder_data)
+        shutil.copy(path_data + folder_data + file_data[0], 'batch_data/' + subject + '/' + folder_data)
+        if os.path.isfile('batch_data/' + subject + '/' + folder_data + 'order.txt'):
+            os.remove('batch_data/' + subject + '/' + folder_data + 'order.txt')
+
+    # pipeline: thr depends on copy (through its input), after_fail is not run because fail fails. copy and other are
+    # independent, but they are run in the same folder: they must not run at the same time
+    cmd_order = 'echo start >> order.txt && sleep 1 && echo end >> order.txt'
+    pipeline = {'steps': [
+        {'name': 'copy', 'folder': 't2', 'cmd': cmd_order + ' && cp t2.nii.gz t2_copy.nii.gz',
+         'inputs': ['t2.nii.gz'], 'outputs': ['t2_copy.nii.gz']},
+        {'name': 'other', 'folder': 't2', 'cmd': cmd_order},
+        {'name': 'thr', 'folder': 't2', 'cmd': 'sct_maths -i t2_copy.nii.gz -thr 100 -o t2_thr.nii.gz',
+         'inputs': ['t2_copy.nii.gz'], 'outputs': ['t2_thr.nii.gz']},
+        {'name': 'fail', 'folder': 't2', 'cmd': 'false'},
+        {'name': 'after_fail', 'folder': 't2', 'cmd': 'echo {subject}', 'after': ['fail']}]}
+    with open('batch_pipeline.json', 'w') as f:
+        json.dump(pipeline, f)
+
+    expected = [{'copy': 'done', 'other': 'done', 'thr': 'done', 'fail': 'failed', 'after_fail': 'not run'},
+                # outputs are up to date: steps are skipped
+                {'copy': 'skipped', 'other': 'done', 'thr': 'skipped', 'fail': 'failed', 'after_fail': 'not run'}]
+
+    for i, expected_status in enumerate(expected):
+        cmd = 'sct_run_batch -d batch_data -p batch_pipeline.json -cpu-nb 2 -ofolder batch_results'
+        output += '\n====================================================================================================\n'+cmd+'\n====================================================================================================\n\n'  # copy command
+        s, o = commands.getstatusoutput(cmd)
+        status += s
+        output += o
+        if s != 0:
+            break
+
+        report = read_report('batch_results/batch_report.csv')
+        for subject in subjects:
+            for name in expected_status:
+                if report.get((subject, name)) != expected_status[name]:
+                    status = 99
+                    output += '\nWRONG RESULT: run ' + str(i + 1) + ', ' + subject + ', ' + name + ': ' + str(report.get((subject, name))) + ' instead of ' + expected_status[name]
+            if i == 0:
+                with open('batch_data/' + subject + '/' + folder_data + 'order.txt') as f:
+                    order = f.read().split()
+                if order != ['start', 'end'] * 2:
+                    status = 99
+                    output += '\nWRONG RESULT: ' + subject + ': steps run in the same folder overlap: ' + ' '.join(order)
+
+    return status, output
+
+if __name__ == "__main__":
+    # call main function
+    test()